@@ -0,0 +1,100 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import threading
+
+import numpy as np
+
+# Maximum number of different buffer shapes kept in pool (old resolutions are dropped)
+MAX_KEYS = 32
+
+
+class BufferPool:
+    def __init__(self):
+        """
+        Initializes BufferPool class (reusable numpy buffers grouped by shape and data type)
+        """
+        self.free_buffers = {}
+        self.lock = threading.Lock()
+        self.allocations_counter = 0
+
+    def get_allocations_counter(self):
+        """
+        :return: total number of buffers allocated by the pool
+        """
+        return self.allocations_counter
+
+    def acquire(self, shape, dtype=np.uint8):
+        """
+        Takes free buffer with the same shape and data type or allocates new one
+        :param shape: buffer shape
+        :param dtype: buffer data type
+        :return: uninitialized numpy array
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            buffers = self.free_buffers.get(key)
+            if buffers:
+                return buffers.pop()
+
+            # Drop buffers of old resolutions
+            if key not in self.free_buffers and len(self.free_buffers) >= MAX_KEYS:
+                self.free_buffers.clear()
+
+            self.free_buffers.setdefault(key, [])
+            self.allocations_counter += 1
+
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buffer):
+        """
+        Returns buffer to the pool
+        :param buffer: numpy array acquired from pool (or allocated outside the pool)
+        :return:
+        """
+        if buffer is None:
+            return
+        key = (buffer.shape, buffer.dtype.str)
+        with self.lock:
+            self.free_buffers.setdefault(key, []).append(buffer)
+
+    def reuse(self, buffer, shape, dtype=np.uint8):
+        """
+        Returns the same buffer if it has required shape and data type or allocates new one
+        (for long-living buffers outside of the pool)
+        :param buffer: numpy array or None
+        :param shape: required shape
+        :param dtype: required data type
+        :return: numpy array
+        """
+        if buffer is not None and buffer.shape == tuple(shape) and buffer.dtype == np.dtype(dtype):
+            return buffer
+        with self.lock:
+            self.allocations_counter += 1
+        return np.empty(shape, dtype=dtype)
+
+    def clear(self):
+        """
+        Drops all free buffers
+        :return:
+        """
+        with self.lock:
+            self.free_buffers.clear()
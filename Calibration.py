@@ -0,0 +1,277 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+
+# Iterations and precision of points undistortion used to build undistortion table
+UNDISTORT_CRITERIA = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 20, 0.01)
+
+STOP_TIMEOUT = 5
+
+
+def lookup(table, points, offset):
+    """
+    Takes bilinear interpolated values of 2-channel table at points positions
+    :param table: (height, width, 2) float32 table
+    :param points: (N, 2) float32 points
+    :param offset: offset of points in table (in pixels)
+    :return: (N, 2) float32 values
+    """
+    points = np.asarray(points, dtype=np.float32).reshape((1, -1, 2))
+    if offset != 0:
+        points = points + np.float32(offset)
+    return cv2.remap(table, points, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE).reshape((-1, 2))
+
+
+class Calibration:
+    def __init__(self, file_name: str):
+        """
+        Initializes Calibration class (camera calibration and lens distortion tables built once per frame size)
+        :param file_name: calibration file (camera_matrix and dist_coeff)
+        """
+        self.file_name = file_name
+
+        self.camera_matrix = None
+        self.camera_distortions = None
+
+        # Tables and their key (width, height, scale x, scale y)
+        self.tables = None
+        self.key = None
+
+        self.build_key = None
+        self.thread = None
+
+    def load(self):
+        """
+        Reads calibration file
+        :return: True if calibration was read
+        """
+        self.camera_matrix = None
+        self.camera_distortions = None
+        self.tables = None
+        self.key = None
+        self.build_key = None
+        if not os.path.exists(self.file_name):
+            return False
+
+        cv_file = cv2.FileStorage(self.file_name, cv2.FILE_STORAGE_READ)
+        camera_matrix = cv_file.getNode("camera_matrix").mat()
+        camera_distortions = cv_file.getNode("dist_coeff").mat()
+        cv_file.release()
+        if camera_matrix is None or camera_distortions is None:
+            logging.error("Wrong calibration file " + self.file_name)
+            return False
+
+        self.camera_matrix = camera_matrix
+        self.camera_distortions = camera_distortions
+        return True
+
+    def get_camera_matrix(self):
+        """
+        :return: camera matrix or None
+        """
+        return self.camera_matrix
+
+    def get_camera_distortions(self):
+        """
+        :return: distortion coefficients or None
+        """
+        return self.camera_distortions
+
+    def get_tables(self, width: int, height: int, scale=(1., 1.)):
+        """
+        Returns distortion tables. Starts building of the tables in background thread if they have different size
+        :param width: frame width
+        :param height: frame height
+        :param scale: (x, y) scale of the frame relative to calibrated camera frame
+        :return: undistortion table (height, width, 2) (undistorted position of each frame pixel),
+        distortion table (height + 2 * padding, width + 2 * padding, 2) (frame position of each undistorted pixel
+        shifted by padding), padding or None if calibration is not loaded or tables are not ready yet
+        """
+        if self.camera_matrix is None:
+            return None
+        # Key is written after tables
+        key = self.key
+        tables = self.tables
+        if key != (width, height, scale[0], scale[1]):
+            self.build((width, height, scale[0], scale[1]))
+            return None
+        return tables
+
+    def undistort_points(self, points, width: int, height: int, scale=(1., 1.)):
+        """
+        Converts frame points into undistorted positions with bilinear lookup in undistortion table
+        :param points: (N, 2) float32 frame points
+        :param width: frame width
+        :param height: frame height
+        :param scale: (x, y) scale of the frame relative to calibrated camera frame
+        :return: (N, 2) float32 undistorted points or None if tables are not ready
+        """
+        tables = self.get_tables(width, height, scale)
+        if tables is None:
+            return None
+        return lookup(tables[0], points, 0.)
+
+    def distort_points(self, points, width: int, height: int, scale=(1., 1.)):
+        """
+        Converts undistorted points into frame positions with bilinear lookup in distortion table
+        :param points: (N, 2) float32 undistorted points
+        :param width: frame width
+        :param height: frame height
+        :param scale: (x, y) scale of the frame relative to calibrated camera frame
+        :return: (N, 2) float32 frame points or None if tables are not ready
+        """
+        tables = self.get_tables(width, height, scale)
+        if tables is None:
+            return None
+        return lookup(tables[1], points, tables[2])
+
+    def build(self, key):
+        """
+        Starts tables building thread (if not started)
+        :param key: (width, height, scale x, scale y)
+        :return:
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        if key == self.build_key:
+            return
+        self.build_key = key
+        self.thread = threading.Thread(target=self.build_thread, args=(key,))
+        self.thread.start()
+        logging.info("Calibration tables building thread: " + self.thread.getName())
+
+    def stop(self):
+        """
+        Waits for building thread
+        :return:
+        """
+        if self.thread is not None:
+            self.thread.join(STOP_TIMEOUT)
+            self.thread = None
+
+    def get_cache_file(self, key):
+        """
+        :param key: (width, height, scale x, scale y)
+        :return: name of cache file
+        """
+        return os.path.splitext(self.file_name)[0] + "_" + str(key[0]) + "x" + str(key[1]) + ".npz"
+
+    def build_thread(self, key):
+        """
+        Builds (or loads from cache file) distortion tables
+        :param key: (width, height, scale x, scale y)
+        :return:
+        """
+        # noinspection PyBroadException
+        try:
+            camera_matrix, camera_distortions = self.camera_matrix, self.camera_distortions
+
+            # Pixels of scaled frame (pixel centers are aligned as in resize())
+            scale_matrix = np.array([[key[2], 0., 0.5 * key[2] - 0.5],
+                                     [0., key[3], 0.5 * key[3] - 0.5],
+                                     [0., 0., 1.]])
+            scaled_matrix = scale_matrix @ np.array(camera_matrix, dtype=np.float64)
+
+            tables = self.load_cache(key, scaled_matrix, camera_distortions)
+            if tables is None:
+                tables = self.build_tables(key, scaled_matrix, camera_distortions)
+                self.save_cache(key, scaled_matrix, camera_distortions, tables)
+
+            if camera_matrix is self.camera_matrix:
+                self.tables = tables
+                self.key = key
+                logging.info("Calibration tables ready: " + str(key[0]) + "x" + str(key[1])
+                             + " (padding: " + str(tables[2]) + " px)")
+        except Exception as e:
+            logging.exception(e)
+
+    @staticmethod
+    def build_tables(key, camera_matrix, camera_distortions):
+        """
+        Builds undistortion table for each frame pixel and distortion table with initUndistortRectifyMap()
+        :param key: (width, height, scale x, scale y)
+        :param camera_matrix: camera matrix
+        :param camera_distortions: distortion coefficients
+        :return: undistortion table, distortion table, padding
+        """
+        width, height = key[:2]
+
+        # Undistorted position of each frame pixel
+        grid = np.mgrid[0:height, 0:width][::-1].astype(np.float32).transpose((1, 2, 0))
+        undistortion_table = cv2.undistortPointsIter(grid.reshape((-1, 1, 2)), camera_matrix, camera_distortions,
+                                                     None, camera_matrix, UNDISTORT_CRITERIA).reshape(grid.shape)
+
+        # Undistorted frame is bigger (or smaller) than frame. Distortion table covers it with padding
+        padding = int(np.ceil(np.max(np.abs(undistortion_table - grid))))
+        padded_matrix = np.array(camera_matrix, dtype=np.float64)
+        padded_matrix[0, 2] += padding
+        padded_matrix[1, 2] += padding
+        distortion_table, _ = cv2.initUndistortRectifyMap(camera_matrix, camera_distortions, None, padded_matrix,
+                                                          (width + padding * 2, height + padding * 2),
+                                                          cv2.CV_32FC2)
+        return undistortion_table, distortion_table, padding
+
+    def load_cache(self, key, camera_matrix, camera_distortions):
+        """
+        Loads cache file if it is newer than calibration file and has the same calibration and size
+        :param key: (width, height, scale x, scale y)
+        :param camera_matrix: camera matrix
+        :param camera_distortions: distortion coefficients
+        :return: undistortion table, distortion table, padding or None
+        """
+        cache_file = self.get_cache_file(key)
+        # noinspection PyBroadException
+        try:
+            if not os.path.exists(cache_file) or os.path.getmtime(cache_file) < os.path.getmtime(self.file_name):
+                return None
+            with np.load(cache_file) as cache:
+                if not np.array_equal(cache["camera_matrix"], camera_matrix) \
+                        or not np.array_equal(cache["camera_distortions"], camera_distortions) \
+                        or cache["undistortion_table"].shape != (key[1], key[0], 2):
+                    return None
+                logging.info("Calibration tables loaded from " + cache_file)
+                return cache["undistortion_table"], cache["distortion_table"], int(cache["padding"])
+        except Exception as e:
+            logging.exception(e)
+        return None
+
+    def save_cache(self, key, camera_matrix, camera_distortions, tables):
+        """
+        Writes tables into cache file
+        :param key: (width, height, scale x, scale y)
+        :param camera_matrix: camera matrix
+        :param camera_distortions: distortion coefficients
+        :param tables: undistortion table, distortion table, padding
+        :return:
+        """
+        # noinspection PyBroadException
+        try:
+            np.savez(self.get_cache_file(key), camera_matrix=camera_matrix, camera_distortions=camera_distortions,
+                     undistortion_table=tables[0], distortion_table=tables[1], padding=tables[2])
+        except Exception as e:
+            logging.exception(e)
+
@@ -0,0 +1,209 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+# Number of preallocated frame buffers (3 is enough for grabber to always have free buffer)
+BUFFERS_NUMBER = 3
+
+# How long read() waits for a frame newer than the previous one (in seconds)
+READ_TIMEOUT = 1.
+
+# How long to wait for grabber thread on stop (in seconds)
+STOP_TIMEOUT = 2.
+
+# Delay after unsuccessful grab (in seconds)
+GRAB_ERROR_DELAY = 0.01
+
+
+class CameraSource:
+    def __init__(self, video_capture, buffers_number=BUFFERS_NUMBER):
+        """
+        Initializes CameraSource class (grabs camera frames in background thread into ring of buffers)
+        :param video_capture: opened cv2.VideoCapture object
+        :param buffers_number: number of buffers in ring (at least 3)
+        """
+        self.video_capture = video_capture
+        self.buffers_number = max(buffers_number, 3)
+
+        self.buffers = [None] * self.buffers_number
+        self.timestamps = [0.] * self.buffers_number
+        self.sequences = [0] * self.buffers_number
+        self.newest_index = -1
+        self.reading_index = -1
+        self.sequence = 0
+        self.last_read_sequence = 0
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.grab_errors = 0
+        self.condition = threading.Condition()
+        self.properties_queue = queue.Queue()
+        self.grabber_thread_running = False
+        self.thread = None
+
+    def get_frames_captured(self):
+        """
+        :return: number of frames retrieved from camera
+        """
+        return self.frames_captured
+
+    def get_frames_dropped(self):
+        """
+        :return: number of frames that were overwritten by newer ones without being read
+        """
+        return self.frames_dropped
+
+    def get_grab_errors(self):
+        """
+        :return: number of unsuccessful grabs
+        """
+        return self.grab_errors
+
+    def start(self):
+        """
+        Starts grabber thread
+        :return:
+        """
+        if self.grabber_thread_running:
+            return
+        self.grabber_thread_running = True
+        self.thread = threading.Thread(target=self.grabber_thread)
+        self.thread.start()
+        logging.info("Camera grabber thread: " + self.thread.getName())
+
+    def stop(self):
+        """
+        Stops grabber thread (video_capture must be released after this call)
+        :return:
+        """
+        self.grabber_thread_running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(STOP_TIMEOUT)
+            self.thread = None
+
+    def read(self, dst=None, timeout=READ_TIMEOUT):
+        """
+        Copies the newest frame. Waits for the next frame only if newest frame was already read
+        :param dst: optional preallocated array to copy frame into
+        :param timeout: maximum time to wait for new frame (in seconds)
+        :return: ret, frame, capture timestamp
+        """
+        with self.condition:
+            # Wait for a new frame
+            if self.sequence <= self.last_read_sequence:
+                self.condition.wait(timeout)
+
+            # No new frame
+            if self.newest_index < 0 or self.sequence <= self.last_read_sequence:
+                return False, None, 0.
+
+            # Lock buffer for reading
+            self.reading_index = self.newest_index
+            self.last_read_sequence = self.sequences[self.reading_index]
+            source = self.buffers[self.reading_index]
+            timestamp = self.timestamps[self.reading_index]
+
+        # Copy frame outside of lock
+        try:
+            if dst is None or dst.shape != source.shape or dst.dtype != source.dtype:
+                dst = np.empty_like(source)
+            np.copyto(dst, source)
+        finally:
+            with self.condition:
+                self.reading_index = -1
+
+        return True, dst, timestamp
+
+    def set(self, camera_property: int, value):
+        """
+        Sets camera property. Property is applied in grabber thread between grabs (VideoCapture is not thread-safe)
+        :param camera_property: cv2.CAP_PROP_...
+        :param value: property value
+        :return: True if property was queued
+        """
+        self.properties_queue.put((camera_property, value))
+        return True
+
+    def apply_properties(self):
+        """
+        Applies queued camera properties (must be called from grabber thread)
+        :return:
+        """
+        while True:
+            try:
+                camera_property, value = self.properties_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.video_capture.set(camera_property, value)
+
+    def grabber_thread(self):
+        """
+        Grabs frames from camera into free buffer
+        :return:
+        """
+        while self.grabber_thread_running:
+            try:
+                # Apply property changes
+                self.apply_properties()
+
+                # Wait for the next frame from camera driver
+                if not self.video_capture.grab():
+                    self.grab_errors += 1
+                    time.sleep(GRAB_ERROR_DELAY)
+                    continue
+                timestamp = time.time()
+
+                # Select buffer that is neither newest nor being read
+                with self.condition:
+                    write_index = 0
+                    while write_index == self.newest_index or write_index == self.reading_index:
+                        write_index += 1
+
+                # Decode frame into preallocated buffer
+                ret, frame = self.video_capture.retrieve(self.buffers[write_index])
+                if not ret or frame is None:
+                    self.grab_errors += 1
+                    continue
+
+                # Publish new frame
+                with self.condition:
+                    self.buffers[write_index] = frame
+                    self.timestamps[write_index] = timestamp
+                    if self.sequence > self.last_read_sequence:
+                        self.frames_dropped += 1
+                    self.sequence += 1
+                    self.sequences[write_index] = self.sequence
+                    self.newest_index = write_index
+                    self.frames_captured += 1
+                    self.condition.notify_all()
+
+            except Exception as e:
+                logging.exception(e)
+                time.sleep(GRAB_ERROR_DELAY)
+
+        logging.warning("Camera grabber thread exited")
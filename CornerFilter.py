@@ -0,0 +1,122 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import math
+
+import numpy as np
+
+# Time step if timestamps are not increasing (in seconds)
+DEFAULT_TIME_STEP = 1. / 30.
+
+# Reset filter if there were no updates for this time (in seconds)
+RESET_TIMEOUT = 1.
+
+
+def smoothing_factor(cutoff, time_step: float):
+    """
+    Calculates exponential smoothing factor of low-pass filter
+    :param cutoff: cutoff frequency (in Hz), float or numpy array
+    :param time_step: time since previous sample (in seconds)
+    :return: smoothing factor (float or numpy array)
+    """
+    tau = 1. / (2. * math.pi * cutoff)
+    return 1. / (1. + tau / time_step)
+
+
+class CornerFilter:
+    def __init__(self, points_number=4):
+        """
+        Initializes CornerFilter class (One-Euro filter with constant-velocity prediction of screen corners)
+        :param points_number: number of filtered points
+        """
+        self.points_number = points_number
+
+        self.min_cutoff = 1.
+        self.beta = 0.
+        self.derivative_cutoff = 1.
+
+        self.points = np.zeros((self.points_number, 2), dtype=np.float32)
+        self.velocity = np.zeros((self.points_number, 2), dtype=np.float32)
+        self.timestamp = 0.
+        self.initialized = False
+
+    def set_parameters(self, min_cutoff: float, beta: float, derivative_cutoff: float):
+        """
+        Sets filter parameters
+        :param min_cutoff: minimum cutoff frequency (in Hz). Lower values - less jitter at low speed
+        :param beta: speed coefficient. Higher values - less lag at high speed
+        :param derivative_cutoff: cutoff frequency of velocity filter (in Hz)
+        :return:
+        """
+        self.min_cutoff = max(min_cutoff, 1e-3)
+        self.beta = max(beta, 0.)
+        self.derivative_cutoff = max(derivative_cutoff, 1e-3)
+
+    def reset(self):
+        """
+        Forgets previous points (next update will be returned without filtering)
+        :return:
+        """
+        self.velocity.fill(0.)
+        self.initialized = False
+
+    def update(self, points, timestamp: float):
+        """
+        Filters new points
+        :param points: (points_number, 2) array of new points
+        :param timestamp: time of the points (in seconds)
+        :return: (points_number, 2) float32 array of filtered points
+        """
+        points = np.asarray(points, dtype=np.float32).reshape((self.points_number, 2))
+
+        # Calculate time step
+        time_step = timestamp - self.timestamp
+        if self.initialized and time_step > RESET_TIMEOUT:
+            self.reset()
+        if time_step <= 0.:
+            time_step = DEFAULT_TIME_STEP
+        self.timestamp = timestamp
+
+        # First points
+        if not self.initialized:
+            np.copyto(self.points, points)
+            self.initialized = True
+            return self.points.copy()
+
+        # Filter velocity
+        velocity = (points - self.points) / time_step
+        alpha = smoothing_factor(self.derivative_cutoff, time_step)
+        self.velocity += alpha * (velocity - self.velocity)
+
+        # Filter points with speed-dependent cutoff
+        alpha = smoothing_factor(self.min_cutoff + self.beta * np.abs(self.velocity), time_step)
+        self.points += alpha * (points - self.points)
+
+        return self.points.copy()
+
+    def predict(self, timestamp: float):
+        """
+        Extrapolates filtered points with constant velocity
+        :param timestamp: time of prediction (in seconds)
+        :return: (points_number, 2) float32 array of predicted points
+        """
+        time_step = max(timestamp - self.timestamp, 0.)
+        return self.points + self.velocity * np.float32(time_step)
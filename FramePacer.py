@@ -0,0 +1,126 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+
+# Overrun policies
+# Late frames are started immediately until schedule is restored (average fps is kept)
+PACING_CATCH_UP = 0
+# Missed deadlines are skipped and next frame is aligned to the schedule (no bursts of frames)
+PACING_DROP = 1
+
+# Maximum number of frame periods that can be caught up (schedule is restarted if exceeded)
+MAX_CATCH_UP_FRAMES = 3
+
+# Sleep time if pacing is disabled (max fps <= 0) (in seconds)
+IDLE_INTERVAL = 0.1
+
+# Jitter filter factor
+JITTER_FILTER = 0.95
+
+
+class FramePacer:
+    def __init__(self):
+        """
+        Initializes FramePacer class (waits for absolute frame deadlines on monotonic clock)
+        """
+        self.period = 0.
+        self.policy = PACING_DROP
+
+        self.deadline = 0.
+
+        # Statistics (in seconds)
+        self.jitter_mean = 0.
+        self.jitter_max = 0.
+        self.overruns_counter = 0
+        self.dropped_counter = 0
+
+    def set_parameters(self, maximum_fps: float, policy: int):
+        """
+        Sets pacing parameters. Schedule is restarted if frame rate changed
+        :param maximum_fps: frame rate (<= 0 - output is stopped)
+        :param policy: PACING_CATCH_UP or PACING_DROP
+        :return:
+        """
+        period = 1. / maximum_fps if maximum_fps > 0 else 0.
+        if period != self.period:
+            self.period = period
+            self.deadline = 0.
+        self.policy = policy
+
+    def get_statistics(self):
+        """
+        :return: filtered mean and maximum wake up delay after deadline (in milliseconds),
+        number of frames started after the next deadline, number of skipped deadlines
+        """
+        return self.jitter_mean * 1000., self.jitter_max * 1000., self.overruns_counter, self.dropped_counter
+
+    def reset(self):
+        """
+        Restarts schedule and statistics
+        :return:
+        """
+        self.deadline = 0.
+        self.jitter_mean = 0.
+        self.jitter_max = 0.
+        self.overruns_counter = 0
+        self.dropped_counter = 0
+
+    def wait(self):
+        """
+        Sleeps until the next frame deadline
+        :return: True if it's time to start new frame, False if pacing is disabled (slept IDLE_INTERVAL)
+        """
+        if self.period <= 0.:
+            time.sleep(IDLE_INTERVAL)
+            self.deadline = 0.
+            return False
+
+        # First frame
+        time_now = time.monotonic()
+        if self.deadline <= 0.:
+            self.deadline = time_now + self.period
+            return True
+
+        # Sleep once until deadline
+        if time_now < self.deadline:
+            time.sleep(self.deadline - time_now)
+            time_now = time.monotonic()
+
+        # Wake up delay
+        jitter = time_now - self.deadline
+        if self.jitter_mean == 0.:
+            self.jitter_mean = jitter
+        self.jitter_mean = self.jitter_mean * JITTER_FILTER + jitter * (1. - JITTER_FILTER)
+        self.jitter_max = max(self.jitter_max * JITTER_FILTER, jitter)
+
+        # Previous frame took longer than one period
+        missed_deadlines = int(jitter / self.period)
+        if missed_deadlines > 0:
+            self.overruns_counter += 1
+
+            # Skip missed deadlines (or restart schedule if it can't be caught up)
+            if self.policy == PACING_DROP or missed_deadlines > MAX_CATCH_UP_FRAMES:
+                self.dropped_counter += missed_deadlines
+                self.deadline += missed_deadlines * self.period
+
+        self.deadline += self.period
+        return True
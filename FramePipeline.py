@@ -0,0 +1,256 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+# How long stage thread waits for new frame before checking running flag (in seconds)
+QUEUE_GET_TIMEOUT = 0.1
+
+# How long to wait for each stage thread on stop (in seconds)
+STAGE_JOIN_TIMEOUT = 2.
+
+# Stage time filter factor
+STAGE_TIME_FILTER = 0.9
+
+
+class LatestQueue:
+    def __init__(self, maxsize=1, on_drop=None):
+        """
+        Initializes LatestQueue class (bounded queue where the newest item always wins)
+        :param maxsize: maximum number of items in queue
+        :param on_drop: function that will be called with every dropped item
+        """
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.dropped_counter = 0
+
+    def put(self, item):
+        """
+        Puts new item into queue. Drops the oldest item if queue is full
+        :param item: any object
+        :return:
+        """
+        dropped_item = None
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                dropped_item = self.items.popleft()
+                self.dropped_counter += 1
+            self.items.append(item)
+            self.condition.notify()
+
+        # Notify about dropped item outside of lock
+        if dropped_item is not None and self.on_drop is not None:
+            self.on_drop(dropped_item)
+
+    def get(self, timeout=None):
+        """
+        Retrieves the oldest item from queue
+        :param timeout: maximum time to wait for item (in seconds)
+        :return: item or None if queue is still empty after timeout
+        """
+        with self.condition:
+            if not self.items:
+                self.condition.wait(timeout)
+            if self.items:
+                return self.items.popleft()
+            return None
+
+    def clear(self):
+        """
+        Drops all items from queue
+        :return:
+        """
+        with self.condition:
+            dropped_items = list(self.items)
+            self.items.clear()
+
+        if self.on_drop is not None:
+            for dropped_item in dropped_items:
+                self.on_drop(dropped_item)
+
+
+class FramePipeline:
+    def __init__(self, stages, queue_size=1, on_drop=None):
+        """
+        Initializes FramePipeline class
+        :param stages: list of (name, function) tuples. First stage is called with None and must return new frame,
+        every next stage is called with frame from previous stage. Stage can return None to drop the frame
+        :param queue_size: size of queues between stages
+        :param on_drop: function that will be called with every frame dropped between stages or failed in a stage
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_drop = on_drop
+
+        self.queues = []
+        self.threads = []
+        self.running = False
+        self.stage_times = {}
+        for name, _ in self.stages:
+            self.stage_times[name] = 0.
+
+    def is_running(self):
+        return self.running
+
+    def get_stage_times(self):
+        """
+        :return: dictionary of filtered stage processing times (in seconds)
+        """
+        return self.stage_times.copy()
+
+    def reset_stage_times(self):
+        """
+        Restarts filtering of stage times (next measured time of each stage is taken as is)
+        :return:
+        """
+        for name in self.stage_times:
+            self.stage_times[name] = 0.
+
+    def get_dropped_counter(self):
+        """
+        :return: total number of frames dropped between stages
+        """
+        dropped_counter = 0
+        for queue in self.queues:
+            dropped_counter += queue.dropped_counter
+        return dropped_counter
+
+    def start(self):
+        """
+        Starts each stage in its own thread
+        :return:
+        """
+        if self.running:
+            return
+
+        # Create queues between stages
+        self.queues = []
+        for _ in range(len(self.stages) - 1):
+            self.queues.append(LatestQueue(self.queue_size, self.on_drop))
+
+        # Start threads
+        self.running = True
+        self.threads = []
+        for index in range(len(self.stages)):
+            thread = threading.Thread(target=self.stage_thread, args=(index,))
+            thread.start()
+            self.threads.append(thread)
+            logging.info("Pipeline stage " + self.stages[index][0] + " thread: " + thread.getName())
+
+    def stop(self):
+        """
+        Stops stages threads
+        :return:
+        """
+        if not self.running:
+            return
+
+        # Clear flag and wait for threads
+        self.running = False
+        for thread in self.threads:
+            thread.join(STAGE_JOIN_TIMEOUT)
+        self.threads = []
+
+        # Drop unprocessed frames
+        for queue in self.queues:
+            queue.clear()
+
+        logging.info("Pipeline stopped")
+
+    def process_sequential(self):
+        """
+        Runs all stages one after another in the current thread (single-threaded mode)
+        :return: frame from the last stage or None if it was dropped
+        """
+        frame = None
+        for index in range(len(self.stages)):
+            try:
+                frame = self.run_stage(index, frame)
+            except Exception:
+                # Return buffers of failed frame to the pool
+                self.drop(frame)
+                raise
+            if frame is None:
+                break
+        return frame
+
+    def drop(self, frame):
+        """
+        Passes frame that will not be processed further to on_drop function
+        :param frame: dropped frame or None
+        :return:
+        """
+        if frame is not None and self.on_drop is not None:
+            self.on_drop(frame)
+
+    def run_stage(self, index: int, frame):
+        """
+        Runs single stage and measures its time
+        :param index: index of stage
+        :param frame: frame from previous stage (or None for the first one)
+        :return: processed frame
+        """
+        name, function = self.stages[index]
+        time_started = time.time()
+        frame = function(frame)
+        stage_time = time.time() - time_started
+
+        # Filter stage time
+        if self.stage_times[name] == 0:
+            self.stage_times[name] = stage_time
+        self.stage_times[name] = self.stage_times[name] * STAGE_TIME_FILTER + stage_time * (1. - STAGE_TIME_FILTER)
+
+        return frame
+
+    def stage_thread(self, index: int):
+        """
+        Stage loop (multi-threaded mode)
+        :param index: index of stage
+        :return:
+        """
+        while self.running:
+            try:
+                # Retrieve frame from previous stage
+                frame = None
+                if index > 0:
+                    frame = self.queues[index - 1].get(QUEUE_GET_TIMEOUT)
+                    if frame is None:
+                        continue
+
+                # Process frame
+                frame = self.run_stage(index, frame)
+
+                # Push to the next stage
+                if frame is not None and index < len(self.stages) - 1:
+                    self.queues[index].put(frame)
+
+            # Stage error (return buffers of failed frame to the pool)
+            except Exception as e:
+                logging.exception(e)
+                self.drop(frame)
+
+        logging.warning("Pipeline stage " + self.stages[index][0] + " exited")
@@ -0,0 +1,578 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# Minimum padding around marker search window (in pixels)
+ROI_MIN_PADDING = 16
+
+# Allowed downscale factors of detection pyramid
+PYRAMID_SCALES = [1, 2, 4]
+
+# Scales above 2 are used only if the smallest marker from the previous full scan stays at least this size
+# on downscaled image (in pixels). Smaller markers lose their corners accuracy at coarse levels
+MIN_COARSE_MARKER_SIZE = 24
+
+# Size of corner refinement window per pyramid scale (in full resolution pixels)
+REFINE_WINDOW_PER_SCALE = 2
+
+# Corner refinement termination criteria
+REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+
+# Statistics filter factor
+STATISTICS_FILTER = 0.9
+
+# Lucas-Kanade optical flow parameters
+FLOW_WINDOW = (21, 21)
+FLOW_LEVELS = 3
+FLOW_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 20, 0.03)
+
+# Padding of optical flow window around each marker (in pixels). Flow is calculated only inside these windows,
+# so markers moved by more than this between frames are lost
+FLOW_ROI_PADDING = 32
+
+# Number of tiles along each side of frame in parallel detection (2 - four corner regions)
+PARALLEL_TILES = 2
+
+# Detections of the same marker with centers closer than this (relative to marker size) are merged
+DUPLICATE_DISTANCE = 0.5
+
+
+class MarkerDetector:
+    def __init__(self, aruco_dict, parameters):
+        """
+        Initializes MarkerDetector class
+        :param aruco_dict: ARUco dictionary
+        :param parameters: ARUco detector parameters
+        """
+        self.aruco_dict = aruco_dict
+        self.parameters = parameters
+
+        self.camera_matrix = None
+        self.camera_distortions = None
+        self.tracking_enabled = False
+        self.marker_ids = []
+        self.roi_padding = 0.
+        self.full_scan_interval = 0
+        self.pyramid_scale = 1
+        self.parameters_coarse = None
+        self.flow_frames = 0
+        self.flow_max_error = 0.
+        self.parallel_threads = 0
+        self.tile_overlap = 0.
+        self.executor = None
+        self.executor_threads = 0
+
+        self.gray_small = None
+        self.marker_size = 0.
+
+        self.pyramid_statistics = {}
+        for scale in PYRAMID_SCALES:
+            self.pyramid_statistics[scale] = [0., 0.]
+        self.last_corners = {}
+        self.previous_gray = None
+        self.marker_size = 0.
+        self.frames_since_full_scan = 0
+        self.frames_since_detection = 0
+        self.full_scans_counter = 0
+        self.roi_scans_counter = 0
+        self.flow_tracks_counter = 0
+        self.flow_rejects_counter = 0
+        self.flow_error = 0.
+
+    def set_calibration(self, camera_matrix, camera_distortions):
+        """
+        Sets camera calibration
+        :param camera_matrix: camera matrix or None
+        :param camera_distortions: distortion coefficients or None
+        :return:
+        """
+        self.camera_matrix = camera_matrix
+        self.camera_distortions = camera_distortions
+
+    def set_tracking(self, tracking_enabled: bool, marker_ids, roi_padding: float, full_scan_interval: int):
+        """
+        Sets ROI tracking parameters
+        :param tracking_enabled: True to search markers only around their previous positions
+        :param marker_ids: list of markers to track
+        :param roi_padding: padding around previous marker position (relative to marker size)
+        :param full_scan_interval: scan full frame every N frames
+        :return:
+        """
+        # Track each marker only once
+        marker_ids = list(dict.fromkeys(marker_ids))
+
+        if marker_ids != self.marker_ids or not tracking_enabled:
+            self.reset()
+        self.tracking_enabled = tracking_enabled
+        self.marker_ids = marker_ids
+        self.roi_padding = roi_padding
+        self.full_scan_interval = full_scan_interval
+
+    def set_pyramid_scale(self, pyramid_scale: int):
+        """
+        Sets downscale factor for full frame scans (markers corners are refined at full resolution)
+        :param pyramid_scale: 1, 2 or 4 (4 is limited by size of markers, see get_coarse_scale())
+        :return:
+        """
+        if pyramid_scale not in PYRAMID_SCALES:
+            pyramid_scale = 1
+        self.pyramid_scale = pyramid_scale
+        self.update_coarse_parameters()
+
+    def update_coarse_parameters(self):
+        """
+        Copies detector parameters for downscaled image without corner refinement
+        (corners are refined only once at full resolution). Must be called after parameters change
+        :return:
+        """
+        self.parameters_coarse = cv2.aruco.DetectorParameters_create()
+        for name in dir(self.parameters):
+            if not name.startswith("_") and not callable(getattr(self.parameters, name)):
+                setattr(self.parameters_coarse, name, getattr(self.parameters, name))
+        self.parameters_coarse.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_NONE
+
+    def set_flow(self, flow_frames: int, flow_max_error: float):
+        """
+        Sets optical flow tracking parameters
+        :param flow_frames: propagate markers corners with optical flow for N frames between detections (0 - disabled)
+        :param flow_max_error: maximum forward-backward tracking error (in pixels) before immediate re-detection
+        :return:
+        """
+        self.flow_frames = flow_frames
+        self.flow_max_error = flow_max_error
+        if self.flow_frames <= 0:
+            self.previous_gray = None
+
+    def set_parallel(self, parallel_threads: int, tile_overlap: float):
+        """
+        Sets parallel detection parameters
+        :param parallel_threads: number of threads that detect markers in frame tiles and ROIs concurrently
+        (0 - detect in the calling thread)
+        :param tile_overlap: overlap of tiles (relative to frame size). Must be bigger than marker size
+        :return:
+        """
+        self.parallel_threads = max(parallel_threads, 0)
+        self.tile_overlap = tile_overlap
+
+    def update_executor(self):
+        """
+        Replaces thread pool if number of parallel threads changed. Must be called from the thread that detects
+        markers (set_parallel() only records number of threads, so thread pool is never changed during detection)
+        :return:
+        """
+        parallel_threads = self.parallel_threads
+        if parallel_threads == self.executor_threads:
+            return
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if parallel_threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers=parallel_threads, thread_name_prefix="MarkerDetector")
+        self.executor_threads = parallel_threads
+
+    def get_pyramid_scale(self):
+        return self.pyramid_scale
+
+    def get_coarse_scale(self):
+        """
+        Limits pyramid scale so markers from the previous full scan stay at least MIN_COARSE_MARKER_SIZE
+        on downscaled image. Scale is limited to 2 while size of markers is unknown
+        :return: downscale factor for the next full scan
+        """
+        scale = self.pyramid_scale
+        while scale > 2 and self.marker_size / scale < MIN_COARSE_MARKER_SIZE:
+            scale //= 2
+        return scale
+
+    def get_pyramid_statistics(self):
+        """
+        :return: dictionary {scale: [filtered full scan time (s), filtered corner refinement shift (px)]}
+        """
+        statistics = {}
+        for scale in self.pyramid_statistics:
+            statistics[scale] = list(self.pyramid_statistics[scale])
+        return statistics
+
+    def get_statistics(self):
+        """
+        :return: number of full-frame scans, number of ROI scans, number of optical flow tracked frames,
+        number of rejected optical flow results and the last optical flow error (in pixels)
+        """
+        return self.full_scans_counter, self.roi_scans_counter, \
+            self.flow_tracks_counter, self.flow_rejects_counter, self.flow_error
+
+    def reset(self):
+        """
+        Forgets previous markers positions (next detection will scan full frame)
+        :return:
+        """
+        self.last_corners = {}
+        self.previous_gray = None
+        self.frames_since_full_scan = 0
+        self.frames_since_detection = 0
+
+    def detect_markers(self, image, parameters=None, offset=(0, 0)):
+        """
+        Runs ARUco detector on image
+        :param image: gray image
+        :param parameters: detector parameters (None to use default)
+        :param offset: x, y position of image inside the frame (to shift camera matrix principal point)
+        :return: corners, ids
+        """
+        if parameters is None:
+            parameters = self.parameters
+        if self.camera_matrix is not None and self.camera_distortions is not None:
+            camera_matrix = self.camera_matrix
+            if offset[0] != 0 or offset[1] != 0:
+                camera_matrix = camera_matrix.copy()
+                camera_matrix[0, 2] -= offset[0]
+                camera_matrix[1, 2] -= offset[1]
+            corners, ids, _ = cv2.aruco.detectMarkers(image=image, dictionary=self.aruco_dict,
+                                                      parameters=parameters,
+                                                      cameraMatrix=camera_matrix,
+                                                      distCoeff=self.camera_distortions)
+        else:
+            corners, ids, _ = cv2.aruco.detectMarkers(image, self.aruco_dict, parameters=parameters)
+        return corners, ids
+
+    def detect_markers_region(self, image, rect, parameters=None):
+        """
+        Runs ARUco detector on part of the image
+        :param image: gray image
+        :param rect: x, y, w, h of region
+        :param parameters: detector parameters (None to use default)
+        :return: corners (in image coordinates), ids
+        """
+        x, y, w, h = rect
+        corners, ids = self.detect_markers(image[y: y + h, x: x + w], parameters, (x, y))
+        if ids is not None and (x != 0 or y != 0):
+            corners = tuple(marker_corners + np.array([x, y], dtype=np.float32) for marker_corners in corners)
+        return corners, ids
+
+    def get_tiles(self, image_width: int, image_height: int):
+        """
+        Splits frame into overlapping tiles
+        :param image_width: frame width
+        :param image_height: frame height
+        :return: list of (x, y, w, h)
+        """
+        tiles = []
+        overlap_x = int(image_width * self.tile_overlap / 2)
+        overlap_y = int(image_height * self.tile_overlap / 2)
+        for row in range(PARALLEL_TILES):
+            y_start = max(image_height * row // PARALLEL_TILES - overlap_y, 0)
+            y_end = min(image_height * (row + 1) // PARALLEL_TILES + overlap_y, image_height)
+            for column in range(PARALLEL_TILES):
+                x_start = max(image_width * column // PARALLEL_TILES - overlap_x, 0)
+                x_end = min(image_width * (column + 1) // PARALLEL_TILES + overlap_x, image_width)
+                tiles.append((x_start, y_start, x_end - x_start, y_end - y_start))
+        return tiles
+
+    def detect_markers_parallel(self, image, parameters=None):
+        """
+        Runs ARUco detector on overlapping tiles of image concurrently and merges duplicate detections
+        :param image: gray image
+        :param parameters: detector parameters (None to use default)
+        :return: corners, ids
+        """
+        if self.executor is None:
+            return self.detect_markers(image, parameters)
+
+        # Detect in each tile (OpenCV releases GIL inside detector)
+        futures = [self.executor.submit(self.detect_markers_region, image, tile, parameters)
+                   for tile in self.get_tiles(image.shape[1], image.shape[0])]
+
+        # Merge detections of the same marker from overlapping tiles
+        corners = []
+        ids = []
+        centers = []
+        for future in futures:
+            tile_corners, tile_ids = future.result()
+            if tile_ids is None:
+                continue
+            for marker_corners, marker_id in zip(tile_corners, tile_ids.reshape(-1).tolist()):
+                center = np.mean(marker_corners[0], axis=0)
+                size = np.linalg.norm(marker_corners[0][0] - marker_corners[0][2])
+                duplicate = False
+                for i in range(len(ids)):
+                    if ids[i][0] == marker_id and np.linalg.norm(centers[i] - center) < size * DUPLICATE_DISTANCE:
+                        duplicate = True
+                        break
+                if not duplicate:
+                    corners.append(marker_corners)
+                    ids.append([marker_id])
+                    centers.append(center)
+
+        if len(ids) == 0:
+            return (), None
+        return tuple(corners), np.array(ids, dtype=np.int32)
+
+    def detect(self, gray):
+        """
+        Finds ARUco markers
+        :param gray: gray image (already inverted if needed)
+        :return: corners, ids (in the same format as cv2.aruco.detectMarkers)
+        """
+        corners, ids = None, None
+
+        # Apply number of parallel threads
+        self.update_executor()
+
+        # Propagate corners from previous frame with optical flow
+        if self.flow_frames > 0 and self.is_flow_possible(gray):
+            corners, ids = self.track_flow(gray)
+            if ids is not None:
+                self.frames_since_full_scan += 1
+                self.frames_since_detection += 1
+                self.flow_tracks_counter += 1
+
+        # Try to find markers around their previous positions
+        if ids is None and self.tracking_enabled and self.is_tracking_possible():
+            corners, ids = self.detect_roi(gray)
+            if ids is not None:
+                self.frames_since_full_scan += 1
+                self.frames_since_detection = 0
+                self.roi_scans_counter += 1
+
+        # Scan full frame
+        if ids is None:
+            corners, ids = self.detect_pyramid(gray)
+            self.full_scans_counter += 1
+            self.frames_since_full_scan = 0
+            self.frames_since_detection = 0
+            self.remember_corners(corners, ids)
+
+        # Keep current frame for optical flow
+        if self.flow_frames > 0:
+            if self.previous_gray is None or self.previous_gray.shape != gray.shape:
+                self.previous_gray = np.empty_like(gray)
+            np.copyto(self.previous_gray, gray)
+
+        return corners, ids
+
+    def is_flow_possible(self, gray):
+        """
+        :param gray: current gray image
+        :return: True if all markers corners from previous frame are known and it's not time for detection
+        """
+        if self.previous_gray is None or self.previous_gray.shape != gray.shape \
+                or self.frames_since_detection >= self.flow_frames:
+            return False
+        if self.full_scan_interval > 0 and self.frames_since_full_scan >= self.full_scan_interval:
+            return False
+        for marker_id in self.marker_ids:
+            if marker_id not in self.last_corners:
+                return False
+        return len(self.marker_ids) > 0
+
+    def track_flow(self, gray):
+        """
+        Propagates markers corners from previous frame with pyramidal Lucas-Kanade optical flow.
+        Flow is calculated only inside padded window around each marker, so pyramids are built only for these windows
+        :param gray: current gray image
+        :return: corners, ids or None, None if tracking is lost or forward-backward error is too big
+        """
+        image_height, image_width = gray.shape[:2]
+        next_corners = []
+        self.flow_error = 0.
+        for marker_id in self.marker_ids:
+            points = self.last_corners[marker_id].astype(np.float32).reshape((-1, 1, 2))
+
+            # Window around marker
+            x, y, w, h = cv2.boundingRect(points)
+            x_start = max(x - FLOW_ROI_PADDING, 0)
+            y_start = max(y - FLOW_ROI_PADDING, 0)
+            x_end = min(x + w + FLOW_ROI_PADDING, image_width)
+            y_end = min(y + h + FLOW_ROI_PADDING, image_height)
+            if x_end <= x_start or y_end <= y_start:
+                self.flow_rejects_counter += 1
+                return None, None
+            offset = np.array([x_start, y_start], dtype=np.float32)
+            points_roi = points - offset
+
+            previous_roi = self.previous_gray[y_start:y_end, x_start:x_end]
+            roi = gray[y_start:y_end, x_start:x_end]
+
+            # Forward flow
+            next_points, status, _ = cv2.calcOpticalFlowPyrLK(previous_roi, roi, points_roi, None,
+                                                              winSize=FLOW_WINDOW, maxLevel=FLOW_LEVELS,
+                                                              criteria=FLOW_CRITERIA)
+            if next_points is None or not status.all():
+                self.flow_rejects_counter += 1
+                return None, None
+
+            # Backward flow to estimate tracking error
+            back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(roi, previous_roi, next_points, None,
+                                                                   winSize=FLOW_WINDOW, maxLevel=FLOW_LEVELS,
+                                                                   criteria=FLOW_CRITERIA)
+            if back_points is None or not back_status.all():
+                self.flow_rejects_counter += 1
+                return None, None
+            self.flow_error = max(self.flow_error, float(np.max(np.linalg.norm(back_points - points_roi, axis=2))))
+            if self.flow_error > self.flow_max_error:
+                self.flow_rejects_counter += 1
+                return None, None
+
+            next_corners.append((next_points + offset).reshape((1, 4, 2)))
+
+        # Update positions
+        ids = []
+        for i in range(len(self.marker_ids)):
+            self.last_corners[self.marker_ids[i]] = next_corners[i][0]
+            ids.append([self.marker_ids[i]])
+
+        return tuple(next_corners), np.array(ids, dtype=np.int32)
+
+    def detect_pyramid(self, gray):
+        """
+        Finds markers on downscaled image and refines their corners on full resolution image
+        :param gray: gray image
+        :return: corners, ids
+        """
+        time_started = time.time()
+        scale = self.get_coarse_scale()
+        refinement_shift = 0.
+
+        # Full resolution
+        if scale <= 1:
+            corners, ids = self.detect_markers_parallel(gray)
+
+        else:
+            # Detect on downscaled image
+            small_shape = (gray.shape[0] // scale, gray.shape[1] // scale)
+            if self.gray_small is None or self.gray_small.shape != small_shape:
+                self.gray_small = np.empty(small_shape, dtype=np.uint8)
+            gray_small = cv2.resize(gray, (small_shape[1], small_shape[0]), dst=self.gray_small,
+                                    interpolation=cv2.INTER_AREA)
+            corners_small, ids = self.detect_markers_parallel(gray_small, self.parameters_coarse)
+
+            corners = corners_small
+            if ids is not None:
+                # Scale corners back (pixel centers)
+                points = np.concatenate(corners_small).reshape((-1, 1, 2)).astype(np.float32)
+                points = (points + 0.5) * scale - 0.5
+                points_coarse = points.copy()
+
+                # Refine at full resolution
+                window = REFINE_WINDOW_PER_SCALE * scale
+                cv2.cornerSubPix(gray, points, (window, window), (-1, -1), REFINE_CRITERIA)
+                refinement_shift = float(np.mean(np.linalg.norm(points - points_coarse, axis=2)))
+
+                corners = tuple(points.reshape((-1, 1, 4, 2)))
+
+        # Remember size of the smallest marker to limit the next scale
+        if ids is not None:
+            sides = np.diff(np.concatenate(corners).reshape((-1, 4, 2))[:, [0, 1, 2, 3, 0]], axis=1)
+            self.marker_size = float(np.min(np.linalg.norm(sides, axis=2)))
+
+        # Update statistics
+        statistics = self.pyramid_statistics.setdefault(scale, [0., 0.])
+        scan_time = time.time() - time_started
+        if statistics[0] == 0:
+            statistics[0] = scan_time
+            statistics[1] = refinement_shift
+        statistics[0] = statistics[0] * STATISTICS_FILTER + scan_time * (1. - STATISTICS_FILTER)
+        statistics[1] = statistics[1] * STATISTICS_FILTER + refinement_shift * (1. - STATISTICS_FILTER)
+
+        return corners, ids
+
+    def is_tracking_possible(self):
+        """
+        :return: True if all markers positions are known and it's not time for full scan
+        """
+        if self.full_scan_interval > 0 and self.frames_since_full_scan >= self.full_scan_interval:
+            return False
+        for marker_id in self.marker_ids:
+            if marker_id not in self.last_corners:
+                return False
+        return True
+
+    def remember_corners(self, corners, ids):
+        """
+        Saves positions of tracked markers
+        :param corners: markers corners
+        :param ids: markers ids
+        :return:
+        """
+        self.last_corners = {}
+        if ids is None:
+            return
+        ids_list = ids.reshape((len(ids))).tolist()
+        for marker_id in self.marker_ids:
+            if ids_list.count(marker_id) == 1:
+                self.last_corners[marker_id] = corners[ids_list.index(marker_id)][0]
+
+    def get_roi(self, marker_corners, image_width: int, image_height: int):
+        """
+        Calculates padded search window around marker
+        :param marker_corners: 4 marker corners
+        :param image_width: frame width
+        :param image_height: frame height
+        :return: x, y, w, h
+        """
+        x, y, w, h = cv2.boundingRect(marker_corners)
+        padding = max(int(max(w, h) * self.roi_padding), ROI_MIN_PADDING)
+        x_start = max(x - padding, 0)
+        y_start = max(y - padding, 0)
+        x_end = min(x + w + padding, image_width)
+        y_end = min(y + h + padding, image_height)
+        return x_start, y_start, x_end - x_start, y_end - y_start
+
+    def detect_roi(self, gray):
+        """
+        Searches each tracked marker only inside padded window around its previous position
+        :param gray: gray image
+        :return: corners, ids or None, None if at least one marker is lost
+        """
+        rects = []
+        for marker_id in self.marker_ids:
+            x, y, w, h = self.get_roi(self.last_corners[marker_id].astype(np.float32), gray.shape[1], gray.shape[0])
+            if w <= 0 or h <= 0:
+                return None, None
+            rects.append((x, y, w, h))
+
+        # Detect inside windows (concurrently if thread pool is enabled)
+        if self.executor is not None:
+            results = list(self.executor.map(lambda rect: self.detect_markers_region(gray, rect), rects))
+        else:
+            results = [self.detect_markers_region(gray, rect) for rect in rects]
+
+        corners = []
+        ids = []
+        for marker_id, (roi_corners, roi_ids) in zip(self.marker_ids, results):
+            if roi_ids is None:
+                return None, None
+            roi_ids_list = roi_ids.reshape((len(roi_ids))).tolist()
+            if roi_ids_list.count(marker_id) != 1:
+                return None, None
+            corners.append(roi_corners[roi_ids_list.index(marker_id)])
+            ids.append([marker_id])
+
+        # Update positions
+        for i in range(len(ids)):
+            self.last_corners[ids[i][0]] = corners[i][0]
+
+        return tuple(corners), np.array(ids, dtype=np.int32)
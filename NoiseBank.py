@@ -0,0 +1,227 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Number of generated frames if noise file can't be read
+GENERATED_FRAMES_NUMBER = 30
+
+STOP_TIMEOUT = 5
+
+# Delay before building the bank again after error (in seconds)
+BUILD_RETRY_DELAY = 5
+
+
+class NoiseBank:
+    def __init__(self, file_name: str):
+        """
+        Initializes NoiseBank class (noise video frames decoded once at output size and kept in memory)
+        :param file_name: noise video file
+        """
+        self.file_name = file_name
+
+        self.frames_number = 0
+        self.cache_enabled = False
+
+        # Decoded frames (frames_number, height, width) and their size (width, height, frames_number)
+        self.frames = None
+        self.key = None
+
+        self.build_key = None
+        self.build_error_time = 0
+        self.thread = None
+
+    def set_parameters(self, frames_number: int, cache_enabled: bool):
+        """
+        Sets bank parameters. Bank will be rebuilt on the next get_frame() if frames number changed
+        :param frames_number: maximum number of decoded frames (0 - all frames of the file)
+        :param cache_enabled: keep decoded frames in cache file next to noise file and map it on the next start
+        :return:
+        """
+        self.frames_number = max(frames_number, 0)
+        self.cache_enabled = cache_enabled
+
+    def get_frame(self, index: int, width: int, height: int):
+        """
+        Returns noise frame. Starts building of the bank in background thread if it has different size
+        :param index: frame counter (will be wrapped)
+        :param width: output width
+        :param height: output height
+        :return: single-channel noise image (read-only) or None if bank is not ready yet
+        """
+        frames, key = self.frames, self.key
+        if key != (width, height, self.frames_number):
+            self.build((width, height, self.frames_number))
+            if key is None or key[:2] != (width, height):
+                return None
+        return frames[index % len(frames)]
+
+    def build(self, key):
+        """
+        Starts bank building thread (if not started)
+        :param key: (width, height, frames_number)
+        :return:
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        if key == self.build_key:
+            return
+        if time.time() - self.build_error_time < BUILD_RETRY_DELAY:
+            return
+        self.build_key = key
+        self.thread = threading.Thread(target=self.build_thread, args=(key,))
+        self.thread.start()
+        logging.info("Noise bank building thread: " + self.thread.getName())
+
+    def stop(self):
+        """
+        Waits for building thread and forgets frames
+        :return:
+        """
+        if self.thread is not None:
+            self.thread.join(STOP_TIMEOUT)
+            self.thread = None
+        self.frames = None
+        self.key = None
+        self.build_key = None
+        self.build_error_time = 0
+
+    def get_cache_file(self, key):
+        """
+        :param key: (width, height, frames_number)
+        :return: name of cache file
+        """
+        return os.path.splitext(self.file_name)[0] + "_" + str(key[0]) + "x" + str(key[1]) + "_" \
+            + str(key[2]) + ".npy"
+
+    def build_thread(self, key):
+        """
+        Decodes (or maps from cache file) noise frames
+        :param key: (width, height, frames_number)
+        :return:
+        """
+        # noinspection PyBroadException
+        try:
+            frames = None
+            if self.cache_enabled:
+                frames = self.load_cache(key)
+            if frames is None:
+                frames = self.decode(key)
+                if frames is None:
+                    logging.warning("Can't read " + self.file_name + "! Generating noise")
+                    frames = np.random.randint(0, 256, (GENERATED_FRAMES_NUMBER, key[1], key[0]), dtype=np.uint8)
+                elif self.cache_enabled:
+                    frames = self.save_cache(key, frames)
+
+            self.frames = frames
+            self.key = key
+            logging.info("Noise bank ready: " + str(len(frames)) + " frames "
+                         + str(key[0]) + "x" + str(key[1]) + " (" + str(frames.nbytes // 1048576) + " MB)")
+        except Exception as e:
+            logging.exception(e)
+
+            # Forget failed bank, so it will be built again (key is cleared first, frames are read before key)
+            self.key = None
+            self.frames = None
+            self.build_error_time = time.time()
+            self.build_key = None
+
+    def decode(self, key):
+        """
+        Decodes noise file and crops or resizes each frame to (width, height)
+        :param key: (width, height, frames_number)
+        :return: (frames_number, height, width) uint8 array or None
+        """
+        width, height, frames_number = key
+        if not os.path.exists(self.file_name):
+            return None
+        video_capture = cv2.VideoCapture(self.file_name)
+        frames_list = []
+        try:
+            while video_capture.isOpened() and (frames_number <= 0 or len(frames_list) < frames_number):
+                ret, frame = video_capture.read()
+                if not ret or frame is None or frame.shape[0] <= 1 or frame.shape[1] <= 1:
+                    break
+
+                # Take first channel
+                frame = frame[:, :, 0]
+
+                # Crop or resize
+                if width <= frame.shape[1] and height <= frame.shape[0]:
+                    frame = frame[0:height, 0:width].copy()
+                else:
+                    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                frames_list.append(frame)
+        finally:
+            video_capture.release()
+
+        if len(frames_list) == 0:
+            return None
+
+        # Copy into one contiguous array
+        frames = np.empty((len(frames_list), height, width), dtype=np.uint8)
+        for i in range(len(frames_list)):
+            frames[i] = frames_list[i]
+        return frames
+
+    def load_cache(self, key):
+        """
+        Maps cache file if it is newer than noise file and has the same size
+        :param key: (width, height, frames_number)
+        :return: (frames_number, height, width) uint8 array or None
+        """
+        cache_file = self.get_cache_file(key)
+        # noinspection PyBroadException
+        try:
+            if not os.path.exists(cache_file) \
+                    or (os.path.exists(self.file_name)
+                        and os.path.getmtime(cache_file) < os.path.getmtime(self.file_name)):
+                return None
+            frames = np.load(cache_file, mmap_mode="r")
+            if frames.ndim == 3 and frames.shape[1:] == (key[1], key[0]) and frames.dtype == np.uint8 \
+                    and len(frames) > 0:
+                logging.info("Noise bank mapped from " + cache_file)
+                return frames
+        except Exception as e:
+            logging.exception(e)
+        return None
+
+    def save_cache(self, key, frames):
+        """
+        Writes frames into cache file and maps it
+        :param key: (width, height, frames_number)
+        :param frames: (frames_number, height, width) uint8 array
+        :return: mapped array (or frames if file can't be written)
+        """
+        cache_file = self.get_cache_file(key)
+        # noinspection PyBroadException
+        try:
+            np.save(cache_file, frames)
+            return np.load(cache_file, mmap_mode="r")
+        except Exception as e:
+            logging.exception(e)
+            return frames
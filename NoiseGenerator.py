@@ -0,0 +1,103 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import numpy as np
+
+# Number of pre-generated tiles
+TILES_NUMBER = 16
+
+
+class NoiseGenerator:
+    def __init__(self):
+        """
+        Initializes NoiseGenerator class (uniform noise generated at output size with PCG64 generator)
+        """
+        self.tile_size = 0
+        self.seed = -1
+
+        self.random_generator = np.random.Generator(np.random.PCG64())
+
+        # Reusable output buffer (as uint64 to fill it with raw generator output)
+        self.buffer = np.empty(0, dtype=np.uint64)
+
+        # Pre-generated tiles (TILES_NUMBER, 2 * tile_size, 2 * tile_size)
+        self.tiles = None
+
+    def set_parameters(self, tile_size: int, seed: int):
+        """
+        Sets generator parameters. Generator is restarted if seed changed
+        :param tile_size: 0 - generate every pixel of each frame, > 0 - fill frames with randomly shifted
+        pre-generated tiles of this size (in pixels)
+        :param seed: seed of random generator (< 0 - random seed)
+        :return:
+        """
+        tile_size = max(tile_size, 0)
+        if seed != self.seed:
+            self.seed = seed
+            self.random_generator = np.random.Generator(np.random.PCG64(seed if seed >= 0 else None))
+            self.tiles = None
+        if tile_size != self.tile_size:
+            self.tile_size = tile_size
+            self.tiles = None
+
+    def get_frame(self, width: int, height: int):
+        """
+        Generates next noise frame. Returned image is valid until the next get_frame() call
+        :param width: output width
+        :param height: output height
+        :return: single-channel noise image
+        """
+        size = width * height
+
+        # Allocate new buffer only if size changed
+        if len(self.buffer) != (size + 7) // 8:
+            self.buffer = np.empty((size + 7) // 8, dtype=np.uint64)
+        frame = self.buffer.view(np.uint8)[:size].reshape((height, width))
+
+        # Generate every pixel (8 pixels from each 64-bit raw number). random_raw() has no output argument, so its
+        # result is copied into reusable buffer (frame stays the same array for the next stages)
+        if self.tile_size <= 0:
+            np.copyto(self.buffer, self.random_generator.bit_generator.random_raw(len(self.buffer)))
+            return frame
+
+        # Generate tiles pool
+        tile_size = self.tile_size
+        if self.tiles is None:
+            self.tiles = self.random_generator.integers(0, 256, (TILES_NUMBER, tile_size * 2, tile_size * 2),
+                                                        dtype=np.uint8)
+
+        # Random tile and shift of each cell
+        rows = (height + tile_size - 1) // tile_size
+        columns = (width + tile_size - 1) // tile_size
+        indexes = self.random_generator.integers(0, TILES_NUMBER, rows * columns)
+        shifts = self.random_generator.integers(0, tile_size, (rows * columns, 2))
+
+        # Fill frame
+        cell = 0
+        for y in range(0, height, tile_size):
+            cell_height = min(tile_size, height - y)
+            for x in range(0, width, tile_size):
+                cell_width = min(tile_size, width - x)
+                shift_y, shift_x = shifts[cell]
+                frame[y:y + cell_height, x:x + cell_width] \
+                    = self.tiles[indexes[cell], shift_y:shift_y + cell_height, shift_x:shift_x + cell_width]
+                cell += 1
+        return frame
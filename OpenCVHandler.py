@@ -20,25 +20,34 @@
 """
 
 import logging
-import os
 import threading
 import time
 import traceback
 
 import cv2
 import numpy as np
-import qimage2ndarray
 import win32gui
-from PIL import ImageGrab
 from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtWidgets import QApplication
-from imutils.video import FileVideoStream
 
+import BufferPool
+import Calibration
+import CameraSource
 import Controller
+import CornerFilter
+import FramePacer
+import FramePipeline
+import MarkerDetector
+import NoiseBank
+import NoiseGenerator
+import OutputEffects
+import QualityGovernor
+import WindowCapture
+import WindowCompositor
 import winguiauto
 from qt_thread_updater import get_updater
 
 VIDEO_NOISE_FILE = "noise.avi"
+CAMERA_CALIBRATION_FILE = "camera_calibration.yaml"
 
 DEFAULT_DETECTOR_PARAMETERS = "10, 30, 1, 0.05, 5, 0.1, 4, 0.35, 0.6, 10, 23"
 
@@ -50,8 +59,26 @@ PREVIEW_ARUCO = 3
 FAKE_MODE_ARUCO = 0
 FAKE_MODE_FLICKER = 1
 
-WINDOW_CAPTURE_QT = 0
-WINDOW_CAPTURE_OLD = 1
+WINDOW_CAPTURE_QT = WindowCapture.WINDOW_CAPTURE_QT
+WINDOW_CAPTURE_OLD = WindowCapture.WINDOW_CAPTURE_OLD
+
+PIPELINE_SINGLE_THREAD = 0
+PIPELINE_MULTI_THREAD = 1
+
+NOISE_SOURCE_FILE = 0
+NOISE_SOURCE_GENERATED = 1
+
+PACING_CATCH_UP = FramePacer.PACING_CATCH_UP
+PACING_DROP = FramePacer.PACING_DROP
+
+# How often OpenCV thread checks pipeline mode in multi-threaded mode (in seconds)
+PIPELINE_MODE_CHECK_INTERVAL = 0.1
+
+# Number of rotated final output frames (HTTP stream and virtual camera may still send previous one)
+FINAL_OUTPUT_BUFFERS = 3
+
+# Number of sampled pixels along each side of marker to calculate brightness gradient
+GRADIENT_SAMPLE_SIZE = 24
 
 TIME_DEBUG = False
 
@@ -69,18 +96,48 @@ def _map(x, in_min, in_max, out_min, out_max):
     return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
 
 
-def resize_keep_ratio(source_image, target_width, target_height, interpolation=cv2.INTER_AREA):
+def resize_keep_ratio(source_image, target_width, target_height, interpolation=cv2.INTER_AREA, dst=None):
     """
     Resize image and keeps aspect ratio (background fills with black)
+    :param dst: optional preallocated (target_height, target_width, channels) array
     """
-    border_v = 0
-    border_h = 0
     if (target_height / target_width) >= (source_image.shape[0] / source_image.shape[1]):
-        border_v = int((((target_height / target_width) * source_image.shape[1]) - source_image.shape[0]) / 2)
+        width = target_width
+        height = max(min(int(round(source_image.shape[0] * target_width / source_image.shape[1])), target_height), 1)
     else:
-        border_h = int((((target_width / target_height) * source_image.shape[0]) - source_image.shape[1]) / 2)
-    output_image = cv2.copyMakeBorder(source_image, border_v, border_v, border_h, border_h, cv2.BORDER_CONSTANT, 0)
-    return cv2.resize(output_image, (target_width, target_height), interpolation)
+        height = target_height
+        width = max(min(int(round(source_image.shape[1] * target_height / source_image.shape[0])), target_width), 1)
+    border_top = (target_height - height) // 2
+    border_left = (target_width - width) // 2
+
+    output_shape = (target_height, target_width) + source_image.shape[2:]
+    if dst is None or dst.shape != output_shape or dst.dtype != source_image.dtype:
+        dst = np.empty(output_shape, dtype=source_image.dtype)
+
+    # Black borders
+    dst[:border_top] = 0
+    dst[border_top + height:] = 0
+    dst[border_top:border_top + height, :border_left] = 0
+    dst[border_top:border_top + height, border_left + width:] = 0
+
+    # Resize into the center
+    cv2.resize(source_image, (width, height), dst=dst[border_top:border_top + height, border_left:border_left + width],
+               interpolation=interpolation)
+    return dst
+
+
+def get_bgr_frame(frame, dst=None):
+    """
+    Converts I420 output frame to BGR
+    :param frame: BGR or I420 (2D) image or None
+    :param dst: optional preallocated BGR array
+    :return: BGR image (the same frame if it is not I420) or None
+    """
+    if frame is not None and frame.ndim == 2:
+        if dst is not None and dst.shape != (frame.shape[0] * 2 // 3, frame.shape[1], 3):
+            dst = None
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420, dst=dst)
+    return frame
 
 
 def change_window_state(window_name: str, state):
@@ -171,35 +228,94 @@ def stretch_to(list_, target_length: int):
     return out
 
 
-def get_marker_white_color(image, marker_corners):
+def get_markers_white_colors(image, markers_corners):
     """
-    Calculates average color of "white" pixels inside marker
+    Calculates average colors of "white" pixels inside markers (on sparse grid of pixels of all markers at once)
     :param image: source image from which corners is found
-    :param marker_corners: corners of the marker
-    :return:
+    :param markers_corners: list of markers corners
+    :return: (markers number, 3) uint8 array of BGR colors
     """
-    # Find marker bounding rectangle
-    rect = cv2.boundingRect(marker_corners)
-    x, y, w, h = rect
-
-    # Create marker mask
-    mask = np.zeros((h, w), dtype=image.dtype)
-    cv2.drawContours(mask, [np.array([marker_corners], dtype=int)], -1, 255, -1, offset=(-x, -y))
-
-    # Create masked marker image
-    marker_masked = image[y: y + h, x: x + w]
-    marker_masked = cv2.bitwise_or(marker_masked, marker_masked, mask=mask)
-    marker_masked_gray = cv2.cvtColor(marker_masked, cv2.COLOR_BGR2GRAY)
+    corners = np.asarray(markers_corners, dtype=np.float32).reshape((-1, 4, 2))
+
+    # Sampling grid inside bounding rectangle of each marker
+    steps = (np.arange(GRADIENT_SAMPLE_SIZE, dtype=np.float32) + 0.5) / GRADIENT_SAMPLE_SIZE
+    corners_min = corners.min(axis=1)
+    corners_max = corners.max(axis=1)
+    samples_x = corners_min[:, 0, None] + (corners_max[:, 0, None] - corners_min[:, 0, None]) * steps
+    samples_y = corners_min[:, 1, None] + (corners_max[:, 1, None] - corners_min[:, 1, None]) * steps
+
+    # Pixels inside markers (all edge cross products have the same sign)
+    edges = np.roll(corners, -1, axis=1) - corners
+    cross = edges[:, :, None, None, 0] * (samples_y[:, None, :, None] - corners[:, :, None, None, 1]) \
+        - edges[:, :, None, None, 1] * (samples_x[:, None, None, :] - corners[:, :, None, None, 0])
+    masks = np.all(cross >= 0, axis=1) | np.all(cross <= 0, axis=1)
+
+    # Sample pixels
+    indexes_x = np.clip(samples_x.astype(np.int32), 0, image.shape[1] - 1)
+    indexes_y = np.clip(samples_y.astype(np.int32), 0, image.shape[0] - 1)
+    patches = image[indexes_y[:, :, None], indexes_x[:, None, :]]
+
+    # Mean brightness inside each marker
+    gray = patches.astype(np.float32) @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+    pixels_number = np.maximum(np.count_nonzero(masks, axis=(1, 2)), 1)
+    mean_gray = np.floor(np.sum(gray * masks, axis=(1, 2)) / pixels_number)
+
+    # Mean color of pixels brighter than mean
+    white_masks = masks & (gray > mean_gray[:, None, None])
+    white_pixels_number = np.maximum(np.count_nonzero(white_masks, axis=(1, 2)), 1)
+    colors = np.sum(patches * white_masks[:, :, :, None], axis=(1, 2), dtype=np.uint32) \
+        / white_pixels_number[:, None]
+
+    return colors.astype(np.uint8)
+
+
+class FrameData:
+    def __init__(self, buffer_pool):
+        """
+        Initializes FrameData class (single frame passing through the pipeline stages)
+        :param buffer_pool: BufferPool class for frame buffers
+        """
+        self.buffer_pool = buffer_pool
+        self.buffers = []
+        self.time_started = time.time()
+        self.error = False
+        self.allow_fake_screen = True
+        self.window_image = None
+        self.window_version = 0
+        self.input_frame = None
+        self.capture_timestamp = 0.
+        self.output_frame = None
+        self.paused_version = -1
+        self.corners = None
+        self.ids = None
 
-    # Create mask of white pixels inside marker
-    mask_threshold = cv2.threshold(marker_masked_gray,
-                                   int(cv2.mean(marker_masked_gray, mask)[0]), 255, cv2.THRESH_BINARY)[1]
+    def get_buffer(self, shape, dtype=np.uint8):
+        """
+        Takes buffer from pool. Buffer will be returned to pool with release()
+        :param shape: buffer shape
+        :param dtype: buffer data type
+        :return: uninitialized numpy array
+        """
+        buffer = self.buffer_pool.acquire(shape, dtype)
+        self.buffers.append(buffer)
+        return buffer
 
-    # Find mean white color
-    mean_color = cv2.mean(marker_masked, mask_threshold)
+    def adopt_buffer(self, buffer):
+        """
+        Adds buffer allocated outside the pool. Buffer will be moved to pool with release()
+        :param buffer: numpy array
+        :return:
+        """
+        self.buffers.append(buffer)
 
-    # Return BGR color as integer
-    return int(mean_color[0]), int(mean_color[1]), int(mean_color[2])
+    def release(self):
+        """
+        Returns all frame buffers to pool
+        :return:
+        """
+        for buffer in self.buffers:
+            self.buffer_pool.release(buffer)
+        self.buffers = []
 
 
 class OpenCVHandler:
@@ -227,6 +343,7 @@ class OpenCVHandler:
         self.window_capture_allowed = False
         self.output_allowed = False
         self.video_capture = None
+        self.camera_source = None
         self.input_camera_exposure = 0
         self.input_camera_exposure_auto = False
         self.input_camera_focus = 0
@@ -259,17 +376,21 @@ class OpenCVHandler:
         self.dc_object = None
         self.data_bitmap = None
         self.window_capture_method = 0
+        self.window_capture_fps = 0
+        self.window_capture = WindowCapture.WindowCapture()
         self.window_image = None
         self.frame_blending = False
         self.brightness_gradient_enabled = False
         self.pause_output = False
-        self.tl_filtered = [0., 0.]
-        self.tr_filtered = [0., 0.]
-        self.br_filtered = [0., 0.]
-        self.bl_filtered = [0., 0.]
+        self.corner_filter = CornerFilter.CornerFilter()
+        self.corner_prediction = 0.
+        self.output_latency = 0.
         self.camera_matrix = None
         self.camera_distortions = None
-        self.aruco_filter_scale = 0
+        self.calibration = Calibration.Calibration(CAMERA_CALIBRATION_FILE)
+        self.lens_correction_enabled = False
+        self.output_resolution_compositing = False
+        self.yuv_pipeline_enabled = False
         self.aruco_filter_enabled = False
         self.aruco_image = None
         self.window_contrast = 0.
@@ -279,6 +400,51 @@ class OpenCVHandler:
         self.maximum_fps = 0
         self.real_fps = 0
         self.cuda_enabled = False
+        self.pipeline_mode = PIPELINE_MULTI_THREAD
+
+        # Stages variables
+        self.input_ret = False
+        self.black_frame = None
+        self.flicker_key_frame_1 = None
+        self.flicker_key_frame_2 = None
+        self.noise_counter = 0
+        self.output_frame_paused = None
+        self.output_frame_paused_version = 0
+        self.paused_effects_frame = None
+        self.paused_effects_key = None
+        self.paused_effects_black = False
+        self.cuda_thread_id = None
+        self.gpu_output_frame = None
+        self.gpu_noise_frame = None
+        self.gpu_h = None
+        self.gpu_s = None
+        self.gpu_v = None
+        self.last_capture_time = 0
+        self.last_publish_time = 0
+        self.buffer_pool = BufferPool.BufferPool()
+        self.window_compositor = WindowCompositor.WindowCompositor(self.buffer_pool)
+        self.output_effects = OutputEffects.OutputEffects(self.buffer_pool)
+        self.noise_bank = NoiseBank.NoiseBank(VIDEO_NOISE_FILE)
+        self.noise_generator = NoiseGenerator.NoiseGenerator()
+        self.frame_pacer = FramePacer.FramePacer()
+        self.quality_governor = QualityGovernor.QualityGovernor()
+        self.aruco_pyramid_scale = 1
+        self.noise_interval = 1
+
+        # Quality level changes are applied by detect and effects stages (they use changed objects)
+        self.quality_lock = threading.Lock()
+        self.quality_version = 0
+        self.detect_quality_version = -1
+        self.effects_quality_version = -1
+        self.noise_frame = None
+        self.pipeline = None
+        self.noise_source = NOISE_SOURCE_FILE
+        self.input_shape = None
+        self.final_output_frames = [None] * FINAL_OUTPUT_BUFFERS
+        self.final_output_bgr_frames = [None] * FINAL_OUTPUT_BUFFERS
+        self.final_output_index = 0
+        self.preview_frame = None
+        self.last_allocations_counter = 0
 
         self.new_time = 0
 
@@ -288,6 +454,9 @@ class OpenCVHandler:
         # ARUco detection parameters
         self.parameters = cv2.aruco.DetectorParameters_create()
 
+        # ARUco detector with tracking
+        self.marker_detector = MarkerDetector.MarkerDetector(self.aruco_dict, self.parameters)
+
     def time_debug(self, tag: str, time_started):
         """
         Prints debug messages with time for performance debugging
@@ -303,7 +472,10 @@ class OpenCVHandler:
             self.new_time = time_now
 
     def get_final_output_frame(self):
-        return self.final_output_frame
+        """
+        :return: final output frame as BGR image
+        """
+        return get_bgr_frame(self.final_output_frame)
 
     def get_window_image(self):
         return self.window_image
@@ -313,15 +485,13 @@ class OpenCVHandler:
         Starts OpenCV loop as background thread
         :return:
         """
-        # Read camera calibration
-        if os.path.exists("camera_calibration.yaml"):
-            cv_file = cv2.FileStorage("camera_calibration.yaml", cv2.FILE_STORAGE_READ)
-            self.camera_matrix = cv_file.getNode("camera_matrix").mat()
-            self.camera_distortions = cv_file.getNode("dist_coeff").mat()
-            cv_file.release()
-        else:
-            self.camera_matrix = None
-            self.camera_distortions = None
+        # Read camera calibration (distortion tables are built on the first frame)
+        self.calibration.load()
+        self.camera_matrix = self.calibration.get_camera_matrix()
+        self.camera_distortions = self.calibration.get_camera_distortions()
+        self.marker_detector.set_calibration(self.camera_matrix, self.camera_distortions)
+        self.window_compositor.set_calibration(self.calibration if self.lens_correction_enabled
+                                               and self.camera_matrix is not None else None)
 
         # Set flags
         self.opencv_thread_running = True
@@ -352,6 +522,7 @@ class OpenCVHandler:
         self.marker_ids = self.settings_handler.settings["aruco_ids"]
         self.window_title = str(self.settings_handler.settings["window_title"])
         self.window_capture_method = int(self.settings_handler.settings["window_capture_method"])
+        self.window_capture_fps = int(self.settings_handler.settings["window_capture_fps"])
         self.window_capture_allowed = self.settings_handler.settings["fake_screen"]
         self.crop_left = int(self.settings_handler.settings["window_crop"][0])
         self.crop_top = int(self.settings_handler.settings["window_crop"][1])
@@ -369,14 +540,44 @@ class OpenCVHandler:
         self.flicker_interval = int(self.settings_handler.settings["flicker_interval"])
         self.frame_blending = self.settings_handler.settings["frame_blending"]
         self.brightness_gradient_enabled = self.settings_handler.settings["brightness_gradient"]
-        self.aruco_filter_scale = float(self.settings_handler.settings["aruco_filter_scale"])
         self.aruco_filter_enabled = self.settings_handler.settings["aruco_filter_enabled"]
+        self.corner_filter.set_parameters(float(self.settings_handler.settings["aruco_filter_min_cutoff"]),
+                                          float(self.settings_handler.settings["aruco_filter_beta"]),
+                                          float(self.settings_handler.settings["aruco_filter_derivative_cutoff"]))
+        self.corner_prediction = float(self.settings_handler.settings["aruco_filter_prediction"])
+        self.window_compositor.warp_cache.set_parameters(self.settings_handler.settings["warp_cache_enabled"],
+                                                         float(self.settings_handler.settings["warp_cache_epsilon"]))
+        self.lens_correction_enabled = self.settings_handler.settings["lens_correction_enabled"]
+        self.output_resolution_compositing = self.settings_handler.settings["output_resolution_compositing"]
+        self.yuv_pipeline_enabled = self.settings_handler.settings["yuv_pipeline_enabled"]
+        self.window_compositor.set_calibration(self.calibration if self.lens_correction_enabled
+                                               and self.camera_matrix is not None else None)
+        self.window_compositor.set_tile_size(int(self.settings_handler.settings["window_tile_size"]))
+        self.window_capture.set_tile_size(int(self.settings_handler.settings["window_tile_size"]))
+        self.marker_detector.set_tracking(self.settings_handler.settings["aruco_tracking_enabled"], self.marker_ids,
+                                          float(self.settings_handler.settings["aruco_roi_padding"]),
+                                          int(self.settings_handler.settings["aruco_full_scan_interval"]))
+        self.marker_detector.set_flow(int(self.settings_handler.settings["aruco_flow_frames"]),
+                                      float(self.settings_handler.settings["aruco_flow_max_error"]))
+        self.marker_detector.set_parallel(int(self.settings_handler.settings["aruco_detection_threads"]),
+                                          float(self.settings_handler.settings["aruco_tile_overlap"]))
+        if int(self.settings_handler.settings["opencv_threads"]) >= 0:
+            cv2.setNumThreads(int(self.settings_handler.settings["opencv_threads"]))
         self.window_contrast = float(self.settings_handler.settings["window_contrast"])
         self.window_brightness = int(self.settings_handler.settings["window_brightness"])
         self.output_brightness = int(self.settings_handler.settings["output_brightness"])
         self.output_contrast = float(self.settings_handler.settings["output_contrast"])
+        self.noise_bank.set_parameters(int(self.settings_handler.settings["noise_bank_frames"]),
+                                       self.settings_handler.settings["noise_bank_cache_enabled"])
+        self.noise_generator.set_parameters(int(self.settings_handler.settings["noise_tile_size"]),
+                                            int(self.settings_handler.settings["noise_seed"]))
+        self.noise_source = int(self.settings_handler.settings["noise_source"])
         self.maximum_fps = int(self.settings_handler.settings["max_fps"])
+        self.frame_pacer.set_parameters(self.maximum_fps, int(self.settings_handler.settings["frame_pacing_policy"]))
+        self.quality_governor.set_parameters(self.settings_handler.settings["quality_governor_enabled"],
+                                             self.maximum_fps)
         self.cuda_enabled = self.settings_handler.settings["cuda_enabled"]
+        self.pipeline_mode = int(self.settings_handler.settings["pipeline_mode"])
 
         parameters = str(self.settings_handler.settings["aruco_detector_parameters"]).replace(" ", "").split(",")
         if len(parameters) is not 11:
@@ -388,15 +589,18 @@ class OpenCVHandler:
             logging.exception(e)
             logging.error("Wrong detector parameters! Using default...")
             self.update_detector_parameters(DEFAULT_DETECTOR_PARAMETERS)
+        self.aruco_pyramid_scale = int(self.settings_handler.settings["aruco_pyramid_scale"])
 
-        if self.video_capture is not None:
+        # Camera properties are queued to grabber (VideoCapture must not be used from GUI thread while grabbing)
+        camera = self.camera_source if self.camera_source is not None else self.video_capture
+        if camera is not None:
             # Focus
-            self.video_capture.set(cv2.CAP_PROP_AUTOFOCUS, 1 if self.input_camera_focus_auto else 0)
-            self.video_capture.set(cv2.CAP_PROP_FOCUS, self.input_camera_focus)
+            camera.set(cv2.CAP_PROP_AUTOFOCUS, 1 if self.input_camera_focus_auto else 0)
+            camera.set(cv2.CAP_PROP_FOCUS, self.input_camera_focus)
 
             # Exposure
-            self.video_capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1 if self.input_camera_exposure_auto else 0)
-            self.video_capture.set(cv2.CAP_PROP_EXPOSURE, self.input_camera_exposure)
+            camera.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1 if self.input_camera_exposure_auto else 0)
+            camera.set(cv2.CAP_PROP_EXPOSURE, self.input_camera_exposure)
 
         # Release old window handlers and update hwnd
         self.hwnd = winguiauto.findTopWindow(self.window_title)
@@ -410,6 +614,69 @@ class OpenCVHandler:
             pass
         # change_window_state(self.window_title, win32con.SW_SHOWMAXIMIZED)
 
+        # Update window capture now, detector and effects on the next frame
+        self.apply_window_capture_quality()
+        self.request_quality_update()
+
+    def request_quality_update(self):
+        """
+        Asks detect and effects stages to apply settings and quality governor level on their next frame
+        :return:
+        """
+        with self.quality_lock:
+            self.quality_version += 1
+
+    def apply_detect_quality(self):
+        """
+        Updates pyramid scale and window capture rate according to quality governor level (called by detect stage)
+        :return:
+        """
+        quality_version = self.quality_version
+        if self.detect_quality_version == quality_version:
+            return
+        self.detect_quality_version = quality_version
+
+        # Detect markers on 2x smaller image
+        pyramid_scale = self.aruco_pyramid_scale
+        if self.quality_governor.is_step_active(QualityGovernor.STEP_PYRAMID):
+            pyramid_scale = min(pyramid_scale * 2, max(MarkerDetector.PYRAMID_SCALES))
+        self.marker_detector.set_pyramid_scale(pyramid_scale)
+
+        self.apply_window_capture_quality()
+
+    def apply_window_capture_quality(self):
+        """
+        Updates window capture parameters and its rate according to quality governor level
+        :return:
+        """
+        # Update window capture (0 fps means the same rate as OpenCV loop) with 2x lower rate
+        window_capture_fps = self.window_capture_fps if self.window_capture_fps > 0 else self.maximum_fps
+        if self.quality_governor.is_step_active(QualityGovernor.STEP_WINDOW_FPS):
+            window_capture_fps = max(window_capture_fps // 2, 1)
+        self.window_capture.set_parameters(self.hwnd, self.window_capture_allowed, self.window_capture_method,
+                                           window_capture_fps,
+                                           self.crop_left, self.crop_top, self.crop_right, self.crop_bottom)
+
+    def apply_effects_quality(self):
+        """
+        Updates blur and noise rate according to quality governor level (called by effects stage)
+        :return:
+        """
+        quality_version = self.quality_version
+        if self.effects_quality_version == quality_version:
+            return
+        self.effects_quality_version = quality_version
+
+        # Skip blur
+        blur_radius = self.blur_radius
+        if self.quality_governor.is_step_active(QualityGovernor.STEP_BLUR):
+            blur_radius = 1
+        self.output_effects.set_parameters(blur_radius, self.output_contrast, self.output_brightness,
+                                           self.output_noise_amount)
+
+        # Update noise every second frame
+        self.noise_interval = 2 if self.quality_governor.is_step_active(QualityGovernor.STEP_NOISE_RATE) else 1
+
     def update_detector_parameters(self, parameters: str):
         """
         Updates detector parameters
@@ -465,6 +732,9 @@ class OpenCVHandler:
             # Read first frame
             ret, _ = self.video_capture.read()
             if ret:
+                # Start grabbing frames in background
+                self.camera_source = CameraSource.CameraSource(self.video_capture)
+                self.camera_source.start()
                 self.camera_capture_allowed = True
             else:
                 logging.error("Can't read camera frame!")
@@ -483,6 +753,11 @@ class OpenCVHandler:
         # Stop capturing frames
         self.camera_capture_allowed = False
         try:
+            if self.camera_source is not None:
+                self.camera_source.stop()
+                logging.info("Camera frames captured: " + str(self.camera_source.get_frames_captured())
+                             + ", dropped: " + str(self.camera_source.get_frames_dropped()))
+            self.camera_source = None
             self.video_capture.release()
         except Exception as e:
             logging.exception(e)
@@ -493,628 +768,776 @@ class OpenCVHandler:
         Main OpenCV thread
         :return:
         """
-
+        # Reset frames and stages states
         self.flick_counter = 0
-        input_ret = False
+        self.input_ret = False
+        self.input_frame = None
         self.window_image = None
-        black_frame = np.zeros((1280, 720, 3), dtype=np.uint8)
-        flicker_key_frame_1 = None
-        flicker_key_frame_2 = None
-        self.aruco_image = black_frame.copy()
-        noise_frame = np.zeros((1280, 720), dtype=np.uint8)
-        cuda_enabled = False
-        noise_stream = FileVideoStream(VIDEO_NOISE_FILE).start()
-        output_frame_paused = black_frame.copy()
+        self.black_frame = np.zeros((1280, 720, 3), dtype=np.uint8)
+        self.flicker_key_frame_1 = None
+        self.flicker_key_frame_2 = None
+        self.aruco_image = self.black_frame.copy()
+        self.noise_counter = 0
+        self.noise_frame = None
+        self.cuda_thread_id = None
+        self.output_frame_paused = self.black_frame.copy()
+        self.output_frame_paused_version += 1
+        self.paused_effects_key = None
+        self.last_capture_time = 0
+        self.last_publish_time = 0
+        self.buffer_pool.clear()
+        self.frame_pacer.reset()
+        self.input_shape = None
+        self.final_output_frames = [None] * FINAL_OUTPUT_BUFFERS
+        self.final_output_bgr_frames = [None] * FINAL_OUTPUT_BUFFERS
+
+        # Start window capture
+        self.window_capture.start()
+
+        # Create pipeline
+        pipeline = FramePipeline.FramePipeline([("Capture", self.stage_capture),
+                                                ("Detect", self.stage_detect),
+                                                ("Composite", self.stage_composite),
+                                                ("Effects", self.stage_effects),
+                                                ("Publish", self.stage_publish)],
+                                               on_drop=FrameData.release)
+        self.pipeline = pipeline
 
         while self.opencv_thread_running:
             try:
-                # Start without error
-                error = False
-
-                # Allow aruco detection and screen faking
-                allow_fake_screen = True
-
-                # Record time
-                time_started = time.time()
-
-                # Initialize CUDA
-                cuda_enabled_new = self.cuda_enabled
-                if cuda_enabled_new and not cuda_enabled:
-                    logging.info("Initializing CUDA...")
-                    cv2.cuda.setDevice(0)
-                    gpu_output_frame = cv2.cuda_GpuMat()
-                    gpu_noise_frame = cv2.cuda_GpuMat()
-                    gpu_h = cv2.cuda_GpuMat(gpu_output_frame.size(), cv2.CV_8UC1)
-                    gpu_s = cv2.cuda_GpuMat(gpu_output_frame.size(), cv2.CV_8UC1)
-                    gpu_v = cv2.cuda_GpuMat(gpu_output_frame.size(), cv2.CV_8UC1)
-
-                cuda_enabled = cuda_enabled_new
-
-                self.time_debug("Initializing", time_started)
-
-                # Pause camera
-                if self.controller.get_request_camera_pause() or self.serial_controller.get_request_camera_pause():
-                    self.pause_output = True
-                    self.controller.clear_request_camera_pause()
-                    self.serial_controller.clear_request_camera_pause()
-                    logging.info("Camera paused")
-
-                # Resume camera
-                if self.controller.get_request_camera_resume() or self.serial_controller.get_request_camera_resume():
-                    self.pause_output = False
-                    self.controller.clear_request_camera_resume()
-                    self.serial_controller.clear_request_camera_resume()
-                    logging.info("Camera resumed")
-
-                # Grab window image
-                window_image = None
-                # noinspection PyBroadException
-                try:
-                    if self.window_capture_allowed and self.hwnd is not None:
-                        if self.window_capture_method == WINDOW_CAPTURE_OLD:
-                            rect = win32gui.GetWindowPlacement(self.hwnd)[-1]
-                            window_image = cv2.cvtColor(np.array(ImageGrab.grab(rect)), cv2.COLOR_RGB2BGR)
-                        elif self.window_capture_method == WINDOW_CAPTURE_QT:
-                            # Get window image using PyQt5 grabWindow() function
-                            window_image = qimage2ndarray. \
-                                rgb_view(QPixmap(QApplication.primaryScreen().grabWindow(self.hwnd)).toImage())
-
-                            # Check image
-                            if window_image is not None \
-                                    and window_image.shape[0] > 10 and window_image.shape[1] > 10 \
-                                    and window_image.shape[2] == 3 \
-                                    and (cv2.countNonZero(window_image[:, :, 0]) > 0
-                                         or cv2.countNonZero(window_image[:, :, 1]) > 0
-                                         or cv2.countNonZero(window_image[:, :, 2]) > 0):
-
-                                # Convert to BGR
-                                window_image = cv2.cvtColor(window_image, cv2.COLOR_RGB2BGR)
-
-                            # No window image -> error
-                            else:
-                                window_image = black_frame.copy()
-                                error = True
-                    else:
-                        allow_fake_screen = False
-                except Exception as e:
-                    logging.exception(e)
-                    logging.error("Can't get window image!")
-                    window_image = black_frame.copy()
-                    error = True
-
-                # Replace window image with black if error occurs
-                if window_image is None:
-                    window_image = black_frame.copy()
-
-                # Crop window image
-                window_image = window_image[
-                               self.crop_top:window_image.shape[0] - self.crop_bottom,
-                               self.crop_left:window_image.shape[1] - self.crop_right]
-                self.window_image = window_image
-
-                self.time_debug("Screen captured", time_started)
-
-                # Grab the current camera frame
-                # noinspection PyBroadException
-                try:
-                    if self.camera_capture_allowed \
-                            and self.video_capture is not None and self.video_capture.isOpened() and not error:
-                        if self.fake_mode == FAKE_MODE_FLICKER and self.fake_screen:
-                            # Count flicker frames
-                            self.flick_counter += 1
-
-                            # Flick!
-                            if self.flick_counter == self.flicker_interval:
-                                self.flicker.open_()
-
-                            # Counter ended
-                            elif self.flick_counter >= self.flicker_interval + self.flicker_duration:
-                                # Update frame blending
-                                if flicker_key_frame_2 is not None:
-                                    flicker_key_frame_1 = flicker_key_frame_2.copy()
-                                flicker_key_frame_2 = None
-
-                                # Retrieve frame
-                                input_ret, flicker_key_frame_2 = self.video_capture.read()
-
-                                # Stop flicking
-                                self.flicker.close_()
-
-                                # Reset counter
-                                self.flick_counter = 0
-
-                            # Frame blending
-                            if flicker_key_frame_1 is not None and flicker_key_frame_2 is not None \
-                                    and self.frame_blending:
-                                # Calculate input_frame_counter for frame blending
-                                input_frame_factor = _map(self.flick_counter,
-                                                          0., self.flicker_interval + self.flicker_duration, 0., 1.)
-                                self.input_frame = cv2.addWeighted(flicker_key_frame_1,
-                                                                   1. - input_frame_factor,
-                                                                   flicker_key_frame_2, input_frame_factor, 0.)
-                            else:
-                                self.input_frame = flicker_key_frame_2
-
-                        # No flicker fake
-                        else:
-                            # Stop flicking
-                            self.flicker.close_()
+                # Each stage in its own thread
+                if self.pipeline_mode == PIPELINE_MULTI_THREAD:
+                    pipeline.start()
+                    time.sleep(PIPELINE_MODE_CHECK_INTERVAL)
 
-                            # Reset flick variables
-                            self.flick_counter = 0
-                            flicker_key_frame_1 = None
-                            flicker_key_frame_2 = None
+                # All stages one after another
+                else:
+                    pipeline.stop()
+                    pipeline.process_sequential()
 
-                            # Retrieve frame
-                            input_ret, self.input_frame = self.video_capture.read()
+            # OpenCV loop error
+            except Exception as e:
+                logging.exception(e)
 
-                    # No camera image
-                    else:
-                        # Set error flag
-                        error = True
+        # End of while loop
+        pipeline.stop()
+        self.window_capture.stop()
+        self.noise_bank.stop()
+        self.calibration.stop()
+        cv2.destroyAllWindows()
+        logging.warning("OpenCV loop exited")
+
+    def wait_for_next_cycle(self):
+        """
+        Waits for the next frame deadline (1 / max_fps schedule). Stops waiting if loop or pipeline is stopped or
+        pipeline mode is changed (otherwise capture thread can't be joined while max_fps <= 0)
+        :return: True if it's time to start new frame, False if waiting was interrupted
+        """
+        pipeline_mode = self.pipeline_mode
+        pipeline_running = self.pipeline.is_running()
+        while not self.frame_pacer.wait():
+            if not self.opencv_thread_running or self.pipeline_mode != pipeline_mode \
+                    or self.pipeline.is_running() != pipeline_running:
+                return False
+        return True
+
+    def stage_capture(self, _):
+        """
+        Pipeline stage: grabs window image and camera frame
+        :return: FrameData
+        """
+        # Control cycle time
+        if not self.wait_for_next_cycle():
+            return None
+
+        # Start without error
+        frame = FrameData(self.buffer_pool)
+        self.last_capture_time = frame.time_started
+
+        self.time_debug("Initializing", frame.time_started)
+
+        # Pause camera
+        if self.controller.get_request_camera_pause() or self.serial_controller.get_request_camera_pause():
+            self.pause_output = True
+            self.controller.clear_request_camera_pause()
+            self.serial_controller.clear_request_camera_pause()
+            logging.info("Camera paused")
+
+        # Resume camera
+        if self.controller.get_request_camera_resume() or self.serial_controller.get_request_camera_resume():
+            self.pause_output = False
+            self.controller.clear_request_camera_resume()
+            self.serial_controller.clear_request_camera_resume()
+            logging.info("Camera resumed")
+
+        # Get the latest window image (window capture reuses last image until a new version arrives)
+        window_image = None
+        if self.window_capture_allowed and self.hwnd is not None:
+            window_image, frame.window_version, window_error = self.window_capture.get()
+            if window_image is None or window_error:
+                frame.error = True
+        else:
+            frame.allow_fake_screen = False
+
+        # Replace window image with black if error occurs
+        if window_image is None:
+            window_image = self.black_frame
+        self.window_image = window_image
+        frame.window_image = window_image
+
+        self.time_debug("Screen captured", frame.time_started)
+
+        # Grab the current camera frame
+        camera_source = self.camera_source
+        # noinspection PyBroadException
+        try:
+            if self.camera_capture_allowed and camera_source is not None \
+                    and self.video_capture is not None and self.video_capture.isOpened() and not frame.error:
+                if self.fake_mode == FAKE_MODE_FLICKER and self.fake_screen:
+                    # Count flicker frames
+                    self.flick_counter += 1
+
+                    # Flick!
+                    if self.flick_counter == self.flicker_interval:
+                        self.flicker.open_()
+
+                    # Counter ended
+                    elif self.flick_counter >= self.flicker_interval + self.flicker_duration:
+                        # Update frame blending (swap key frames buffers and reuse the oldest one)
+                        if self.flicker_key_frame_2 is not None:
+                            self.flicker_key_frame_1, self.flicker_key_frame_2 = \
+                                self.flicker_key_frame_2, self.flicker_key_frame_1
+
+                        # Retrieve frame
+                        self.input_ret, self.flicker_key_frame_2, frame.capture_timestamp = \
+                            camera_source.read(self.flicker_key_frame_2)
 
                         # Stop flicking
-                        if self.fake_mode == FAKE_MODE_FLICKER:
-                            self.flicker.close_()
+                        self.flicker.close_()
+
+                        # Reset counter
+                        self.flick_counter = 0
+
+                    # Frame blending
+                    if self.flicker_key_frame_1 is not None and self.flicker_key_frame_2 is not None \
+                            and self.frame_blending:
+                        # Calculate input_frame_counter for frame blending
+                        input_frame_factor = _map(self.flick_counter,
+                                                  0., self.flicker_interval + self.flicker_duration, 0., 1.)
+                        self.input_frame = cv2.addWeighted(self.flicker_key_frame_1,
+                                                           1. - input_frame_factor,
+                                                           self.flicker_key_frame_2, input_frame_factor, 0.,
+                                                           dst=frame.get_buffer(self.flicker_key_frame_2.shape))
+
+                    # Copy key frame, because it will be overwritten by the next key frame
+                    elif self.flicker_key_frame_2 is not None:
+                        self.input_frame = frame.get_buffer(self.flicker_key_frame_2.shape)
+                        np.copyto(self.input_frame, self.flicker_key_frame_2)
+                    else:
+                        self.input_frame = None
 
-                        # Reset flicker variables
-                        flicker_key_frame_1 = None
-                        flicker_key_frame_2 = None
+                # No flicker fake
+                else:
+                    # Stop flicking
+                    self.flicker.close_()
+
+                    # Reset flick variables
+                    self.flick_counter = 0
+                    self.flicker_key_frame_1 = None
+                    self.flicker_key_frame_2 = None
+
+                    # Retrieve frame into buffer from pool
+                    input_buffer = frame.get_buffer(self.input_shape) if self.input_shape is not None else None
+                    self.input_ret, self.input_frame, frame.capture_timestamp = camera_source.read(input_buffer)
+                    if self.input_ret and self.input_frame is not input_buffer:
+                        self.input_shape = self.input_frame.shape
+                        frame.adopt_buffer(self.input_frame)
+
+            # No camera image
+            else:
+                # Set error flag
+                self.input_ret = False
+                frame.error = True
 
-                        # Disable fake screen
-                        allow_fake_screen = False
-                except:
-                    input_ret = False
-                    error = True
+                # Stop flicking
+                if self.fake_mode == FAKE_MODE_FLICKER:
+                    self.flicker.close_()
 
-                # Replace frame with black if error occurs
-                if self.input_frame is None or not input_ret:
-                    self.input_frame = black_frame.copy()
+                # Reset flicker variables
+                self.flicker_key_frame_1 = None
+                self.flicker_key_frame_2 = None
 
-                self.time_debug("Camera captured", time_started)
+                # Disable fake screen
+                frame.allow_fake_screen = False
+        except:
+            self.input_ret = False
+            frame.error = True
 
-                # Create copy of input frame
-                output_frame = self.input_frame.copy()
+        # Replace frame with black if error occurs
+        if self.input_frame is None or not self.input_ret:
+            self.input_frame = self.black_frame
+        frame.input_frame = self.input_frame
 
-                self.time_debug("Frame copied", time_started)
+        self.time_debug("Camera captured", frame.time_started)
 
-                # Disallow faking screen
-                if not self.fake_screen or error:
-                    allow_fake_screen = False
+        # Disallow faking screen
+        if not self.fake_screen or frame.error:
+            frame.allow_fake_screen = False
 
-                # Convert input camera image to gray
-                input_gray = cv2.cvtColor(self.input_frame, cv2.COLOR_BGR2GRAY)
+        return frame
 
-                self.time_debug("Converted to gray", time_started)
+    def stage_detect(self, frame):
+        """
+        Pipeline stage: finds ARUco markers on the input frame
+        :param frame: FrameData
+        :return: FrameData
+        """
+        # Apply changed settings and quality level
+        self.apply_detect_quality()
 
-                # Invert frame if needed
-                if self.aruco_invert:
-                    gray_for_aruco = cv2.bitwise_not(input_gray)
-                else:
-                    gray_for_aruco = input_gray
-
-                # Find aruco markers
-                if self.fake_screen and self.fake_mode == FAKE_MODE_ARUCO:
-                    if self.camera_matrix is not None and self.camera_distortions is not None:
-                        corners, ids, _ = cv2.aruco.detectMarkers(image=gray_for_aruco, dictionary=self.aruco_dict,
-                                                                  parameters=self.parameters,
-                                                                  cameraMatrix=self.camera_matrix,
-                                                                  distCoeff=self.camera_distortions)
-                    else:
-                        corners, ids, _ = cv2.aruco.detectMarkers(gray_for_aruco, self.aruco_dict,
-                                                                  parameters=self.parameters)
+        # Find aruco markers
+        if self.fake_screen and self.fake_mode == FAKE_MODE_ARUCO:
+            # Convert input camera image to gray
+            gray_for_aruco = frame.get_buffer(frame.input_frame.shape[:2])
+            cv2.cvtColor(frame.input_frame, cv2.COLOR_BGR2GRAY, dst=gray_for_aruco)
 
-                    # Get preview of first marker
-                    if np.all(ids is not None):
-                        rect = cv2.boundingRect(corners[0][0])
-                        self.aruco_image = cv2.resize(self.input_frame[rect[1]: rect[1] + rect[3],
-                                                      rect[0]: rect[0] + rect[2]],
-                                                      (self.aruco_size, self.aruco_size))
+            self.time_debug("Converted to gray", frame.time_started)
 
-                    self.time_debug("Markers detected", time_started)
-                else:
-                    corners = None
-                    ids = None
-
-                if self.fake_screen \
-                        and self.fake_mode == FAKE_MODE_ARUCO \
-                        and allow_fake_screen \
-                        and not self.flicker.is_force_fullscreen_enabled():
-                    if np.all(ids is not None):
-                        # Check number of markers
-                        if ids.size == 4:
-                            # Convert ids to list
-                            ids_list = ids.reshape((len(ids))).tolist()
-
-                            # Check all IDs
-                            markers_in_list = True
-                            for marker_id in self.marker_ids:
-                                if marker_id not in ids_list:
-                                    markers_in_list = False
-                                    break
-
-                            if markers_in_list:
-
-                                # Get markers corners
-                                marker_tl = corners[ids_list.index(0)][0]
-                                marker_tr = corners[ids_list.index(1)][0]
-                                marker_br = corners[ids_list.index(2)][0]
-                                marker_bl = corners[ids_list.index(3)][0]
-
-                                tl = marker_tl[0]
-                                tr = marker_tr[1]
-                                br = marker_br[2]
-                                bl = marker_bl[3]
-
-                                # Filter coordinates
-                                if self.aruco_filter_enabled:
-                                    tl, tr, br, bl = self.filter_corners(tl, tr, br, bl)
-
-                                # Dimensions of the frames
-                                overlay_height = self.window_image.shape[0]
-                                overlay_width = self.window_image.shape[1]
-                                source_height = self.input_frame.shape[0]
-                                source_width = self.input_frame.shape[1]
-
-                                # Color gradient
-                                if self.brightness_gradient_enabled:
-                                    # Create 2x2 color gradient
-                                    color_gradient = np.zeros((2, 2, 3), dtype=self.input_frame.dtype)
-                                    color_gradient[0, 0, :] = get_marker_white_color(self.input_frame, marker_tl)
-                                    color_gradient[0, 1, :] = get_marker_white_color(self.input_frame, marker_tr)
-                                    color_gradient[1, 1, :] = get_marker_white_color(self.input_frame, marker_br)
-                                    color_gradient[1, 0, :] = get_marker_white_color(self.input_frame, marker_bl)
-
-                                    # Stretch to window size
-                                    color_gradient = cv2.resize(color_gradient,
-                                                                (window_image.shape[1], window_image.shape[0]),
-                                                                cv2.INTER_LINEAR)
-
-                                    # Apply brightness gradient
-                                    color_gradient = cv2.bitwise_not(color_gradient)
-                                    window_image = cv2.subtract(window_image, color_gradient)
-
-                                # Apply contrast and brightness
-                                window_image = cv2.addWeighted(window_image, self.window_contrast, window_image, 0.,
-                                                               self.window_brightness)
-
-                                # Source points (full size of overlay image)
-                                points_src = np.array([
-                                    [0, 0],
-                                    [overlay_width - 1, 0],
-                                    [overlay_width - 1, overlay_height - 1],
-                                    [0, overlay_height - 1]], dtype='float32')
-
-                                # Destination points (projection)
-                                points_dst = np.array([tl, tr, br, bl], dtype='float32')
-
-                                # Stretch window
-                                center_x, center_y = get_lines_intersection([tl, br], [tr, bl])
-                                # center_x, center_y = get_center(points_dst)
-                                for i in range(len(points_dst)):
-                                    points_dst[i][0] = self.stretch_scale_x * (points_dst[i][0] - center_x) + center_x
-                                    points_dst[i][1] = self.stretch_scale_y * (points_dst[i][1] - center_y) + center_y
-
-                                # Warp and transform window image
-                                window_matrix = cv2.getPerspectiveTransform(points_src, points_dst)
-                                window_warp = cv2.warpPerspective(window_image, window_matrix,
-                                                                  (source_width, source_height))
-
-                                # Cut black region from destination_frame
-                                contours = np.array([points_dst], dtype=int)
-                                cv2.drawContours(output_frame, [contours], -1, 0, -1)
-
-                                # Combine images
-                                output_frame = cv2.bitwise_or(output_frame, window_warp)
-
-                                # Blur contour of screen
-                                # TODO: Make faster
-                                """
-                                output_blurred = cv2.GaussianBlur(output_frame, (5, 5), 0)
-                                mask = np.zeros(output_frame.shape, np.uint8)
-
-                                center_x, center_y = get_center(points_dst)
-                                for i in range(len(points_dst)):
-                                    contours[0][i][0] = 0.992 * (contours[0][i][0] - center_x) + center_x
-                                    contours[0][i][1] = 0.992 * (contours[0][i][1] - center_y) + center_y
-
-                                cv2.drawContours(mask, [contours], -1, (255, 255, 255), 4)
-
-                                output_frame = np.where(mask == np.array([255, 255, 255]),
-                                                        output_blurred, output_frame)
-                                """
-
-                            # Not all IDs detected
-                            else:
-                                error = True
-                                logging.error("Not all markers detected!")
-
-                        # Detected != 4 markers
-                        else:
-                            error = True
-                            if ids.size > 4:
-                                logging.error("Detected more than 4 markers!")
-                            else:
-                                logging.error("Detected less than 4 markers!")
+            # Invert frame if needed
+            if self.aruco_invert:
+                cv2.bitwise_not(gray_for_aruco, dst=gray_for_aruco)
 
-                    # No markers detected
-                    else:
-                        error = True
-                        logging.error("No ARUco detected!")
+            # Search markers around previous positions or scan full frame
+            frame.corners, frame.ids = self.marker_detector.detect(gray_for_aruco)
 
-                # Fake aruco disabled
-                else:
-                    # Just copy input frame
-                    output_frame = self.input_frame.copy()
+            # Get preview of first marker
+            if np.all(frame.ids is not None):
+                rect = cv2.boundingRect(frame.corners[0][0])
+                self.aruco_image = self.buffer_pool.reuse(self.aruco_image, (self.aruco_size, self.aruco_size, 3))
+                cv2.resize(frame.input_frame[rect[1]: rect[1] + rect[3], rect[0]: rect[0] + rect[2]],
+                           (self.aruco_size, self.aruco_size), dst=self.aruco_image)
 
-                    # Detected at least 1 marker
-                    if np.all(ids is not None):
-                        error = True
-                        logging.error("ARUco was found but should not have been!")
+            self.time_debug("Markers detected", frame.time_started)
+        else:
+            frame.corners = None
+            frame.ids = None
 
-                self.time_debug("Markers processed", time_started)
+        return frame
 
-                # Real frame
-                if not self.pause_output:
-                    output_frame_paused = output_frame.copy()
+    def stage_composite(self, frame):
+        """
+        Pipeline stage: replaces screen between markers with window image
+        :param frame: FrameData
+        :return: FrameData
+        """
+        corners = frame.corners
+        ids = frame.ids
+        window_image = frame.window_image
+
+        # Create copy of input frame (or downscale it once to composite at output resolution)
+        input_height, input_width = frame.input_frame.shape[:2]
+        output_width, output_height = self.output_width, self.output_height
+        frame_scale = (1., 1.)
+        if self.output_resolution_compositing and (output_width, output_height) != (input_width, input_height):
+            frame_scale = (output_width / input_width, output_height / input_height)
+            output_frame = frame.get_buffer((output_height, output_width, 3))
+            cv2.resize(frame.input_frame, (output_width, output_height), dst=output_frame,
+                       interpolation=cv2.INTER_AREA)
+        else:
+            output_frame = frame.get_buffer(frame.input_frame.shape)
+            np.copyto(output_frame, frame.input_frame)
+
+        self.time_debug("Frame copied", frame.time_started)
+
+        if self.fake_screen \
+                and self.fake_mode == FAKE_MODE_ARUCO \
+                and frame.allow_fake_screen \
+                and not self.flicker.is_force_fullscreen_enabled():
+            if np.all(ids is not None):
+                # Check number of markers
+                if ids.size == 4:
+                    # Convert ids to list
+                    ids_list = ids.reshape((len(ids))).tolist()
+
+                    # Check all IDs
+                    markers_in_list = True
+                    for marker_id in self.marker_ids:
+                        if marker_id not in ids_list:
+                            markers_in_list = False
+                            break
+
+                    if markers_in_list:
+
+                        # Get markers corners
+                        marker_tl = corners[ids_list.index(0)][0]
+                        marker_tr = corners[ids_list.index(1)][0]
+                        marker_br = corners[ids_list.index(2)][0]
+                        marker_bl = corners[ids_list.index(3)][0]
+
+                        tl = marker_tl[0]
+                        tr = marker_tr[1]
+                        br = marker_br[2]
+                        bl = marker_bl[3]
+
+                        # Filter coordinates
+                        if self.aruco_filter_enabled:
+                            tl, tr, br, bl = self.filter_corners(tl, tr, br, bl, frame.capture_timestamp)
+
+                        # Color gradient
+                        color_gradient = None
+                        if self.brightness_gradient_enabled:
+                            # Create 2x2 color gradient
+                            colors = get_markers_white_colors(frame.input_frame,
+                                                              [marker_tl, marker_tr, marker_br, marker_bl])
+                            color_gradient = np.array([[colors[0], colors[1]], [colors[3], colors[2]]],
+                                                      dtype=np.uint8)
+
+                        # Destination points (projection)
+                        points_dst = np.array([tl, tr, br, bl], dtype='float32')
+
+                        # Stretch window
+                        center_x, center_y = get_lines_intersection([tl, br], [tr, bl])
+                        # center_x, center_y = get_center(points_dst)
+                        for i in range(len(points_dst)):
+                            points_dst[i][0] = self.stretch_scale_x * (points_dst[i][0] - center_x) + center_x
+                            points_dst[i][1] = self.stretch_scale_y * (points_dst[i][1] - center_y) + center_y
+
+                        # Output space (scaled homography, pixel centers are aligned as in resize())
+                        if frame_scale != (1., 1.):
+                            points_dst = (points_dst + 0.5) * np.array(frame_scale, dtype=np.float32) - 0.5
+
+                        # Adjust and warp window image (reuses previous result if nothing changed)
+                        window_warp, window_mask, window_rect = \
+                            self.window_compositor.render(window_image, frame.window_version, color_gradient,
+                                                          self.window_contrast, self.window_brightness,
+                                                          points_dst, output_frame.shape,
+                                                          self.window_capture.get_dirty_tiles, frame_scale)
+
+                        # Replace screen region with warped window (pixels outside the rectangle are not touched)
+                        if window_warp.size > 0:
+                            rect_x, rect_y, rect_width, rect_height = window_rect
+                            cv2.copyTo(window_warp, window_mask,
+                                       output_frame[rect_y: rect_y + rect_height, rect_x: rect_x + rect_width])
+
+                        # Blur contour of screen
+                        # TODO: Make faster
+                        """
+                        output_blurred = cv2.GaussianBlur(output_frame, (5, 5), 0)
+                        mask = np.zeros(output_frame.shape, np.uint8)
+
+                        center_x, center_y = get_center(points_dst)
+                        for i in range(len(points_dst)):
+                            contours[0][i][0] = 0.992 * (contours[0][i][0] - center_x) + center_x
+                            contours[0][i][1] = 0.992 * (contours[0][i][1] - center_y) + center_y
+
+                        cv2.drawContours(mask, [contours], -1, (255, 255, 255), 4)
+
+                        output_frame = np.where(mask == np.array([255, 255, 255]),
+                                                output_blurred, output_frame)
+                        """
+
+                    # Not all IDs detected
+                    else:
+                        frame.error = True
+                        logging.error("Not all markers detected!")
 
-                # Paused -> use previous frame
+                # Detected != 4 markers
                 else:
-                    output_frame = output_frame_paused.copy()
-
-                # Is frame totally black?
-                is_output_frame_black = cv2.countNonZero(cv2.cvtColor(output_frame, cv2.COLOR_BGR2GRAY)) == 0
-
-                # Resize output
-                output_frame = cv2.resize(output_frame, (self.output_width, self.output_height))
-                self.time_debug("Output resized", time_started)
-
-                # Add effects only on non-black output frame
-                if not is_output_frame_black:
-                    # Add blur
-                    # noinspection PyBroadException
-                    try:
-                        # Check blur radius
-                        if self.blur_radius % 2 == 0 or self.blur_radius <= 0:
-                            self.blur_radius += 1
-                        output_frame = cv2.GaussianBlur(output_frame, (self.blur_radius, self.blur_radius), 0)
-                    except:
-                        pass
-
-                    self.time_debug("Blur added", time_started)
-
-                    # Upload to gpu
-                    if cuda_enabled:
-                        gpu_output_frame.upload(output_frame)
-
-                    # Apply contrast and brightness
-                    if cuda_enabled:
-                        gpu_output_frame = cv2.cuda.addWeighted(gpu_output_frame, self.output_contrast,
-                                                                gpu_output_frame, 0., self.output_brightness)
+                    frame.error = True
+                    if ids.size > 4:
+                        logging.error("Detected more than 4 markers!")
                     else:
-                        output_frame = cv2.addWeighted(output_frame, self.output_contrast, output_frame, 0.,
-                                                       self.output_brightness)
-
-                    self.time_debug("Br. / Cont. added", time_started)
-
-                    # Add noise
-                    # noinspection PyBroadException
-                    try:
-                        # Read noise from file
-                        test_noise_frame = None
-                        try:
-                            if noise_stream.more():
-                                test_noise_frame = noise_stream.read()
-                            else:
-                                noise_stream.stop()
-                                noise_stream = FileVideoStream(VIDEO_NOISE_FILE).start()
-                                test_noise_frame = noise_stream.read()
-                        except Exception as e:
-                            logging.exception(e)
-
-                        # Check noise
-                        if test_noise_frame is not None and test_noise_frame.shape[0] > 1 \
-                                and test_noise_frame.shape[1] > 1 and test_noise_frame.shape[2] == 3:
-                            noise_frame = test_noise_frame[:, :, 0]
-
-                        # Upload to GPU
-                        if cuda_enabled:
-                            gpu_noise_frame.upload(noise_frame)
-
-                        # Crop or resize
-                        if self.output_width <= noise_frame.shape[1] and self.output_height <= noise_frame.shape[0]:
-                            if cuda_enabled:
-                                gpu_noise_frame = cv2.cuda_GpuMat(gpu_noise_frame,
-                                                                  (0, self.output_height), (0, self.output_width))
-                            else:
-                                noise_frame = noise_frame[0:self.output_height, 0:self.output_width]
-                        else:
-                            if cuda_enabled:
-                                gpu_noise_frame = cv2.cuda.resize(gpu_noise_frame,
-                                                                  (self.output_width, self.output_height),
-                                                                  interpolation=cv2.INTER_AREA)
-                            else:
-                                noise_frame = cv2.resize(noise_frame,
-                                                         (self.output_width, self.output_height),
-                                                         interpolation=cv2.INTER_AREA)
-
-                        # Add noise using GPU
-                        if cuda_enabled:
-                            # Convert output frame to HSV
-                            gpu_output_frame_hsv = cv2.cuda.cvtColor(gpu_output_frame, cv2.COLOR_BGR2HSV)
-
-                            # Resize GPU Mats
-                            if gpu_v.size() != gpu_output_frame_hsv.size():
-                                gpu_h = cv2.cuda_GpuMat(gpu_output_frame_hsv.size(), cv2.CV_8UC1)
-                                gpu_s = cv2.cuda_GpuMat(gpu_output_frame_hsv.size(), cv2.CV_8UC1)
-                                gpu_v = cv2.cuda_GpuMat(gpu_output_frame_hsv.size(), cv2.CV_8UC1)
-
-                            # Split HSV
-                            cv2.cuda.split(gpu_output_frame_hsv, [gpu_h, gpu_s, gpu_v])
-
-                            # Add noise to darken areas
-                            gpu_v_inverted = cv2.cuda.bitwise_not(gpu_v)
-                            gpu_v_noise_added = cv2.cuda.bitwise_and(gpu_v_inverted, gpu_noise_frame)
-                            gpu_v_noisy = cv2.cuda.bitwise_not(gpu_v_noise_added)
-
-                            # Combine with clear output
-                            gpu_v_noisy = cv2.cuda.addWeighted(gpu_v, 1. - self.output_noise_amount,
-                                                               gpu_v_noisy, self.output_noise_amount, 0.)
-
-                            # Merge HSV
-                            cv2.cuda.merge([gpu_h, gpu_s, gpu_v_noisy], gpu_output_frame_hsv)
-
-                            # Convert back to BGR
-                            gpu_output_frame = cv2.cuda.cvtColor(gpu_output_frame_hsv, cv2.COLOR_HSV2BGR)
-
-                            # Download from GPU
-                            output_frame = gpu_output_frame.download()
-
-                        # Add noise using CPU
+                        logging.error("Detected less than 4 markers!")
+
+            # No markers detected
+            else:
+                frame.error = True
+                logging.error("No ARUco detected!")
+
+        # Fake aruco disabled (output frame is already a copy of input frame)
+        else:
+            # Detected at least 1 marker
+            if np.all(ids is not None):
+                frame.error = True
+                logging.error("ARUco was found but should not have been!")
+
+        self.time_debug("Markers processed", frame.time_started)
+
+        # Real frame
+        if not self.pause_output:
+            self.output_frame_paused = self.buffer_pool.reuse(self.output_frame_paused, output_frame.shape)
+            np.copyto(self.output_frame_paused, output_frame)
+            self.output_frame_paused_version += 1
+
+        # Paused -> use previous frame
+        else:
+            output_frame = frame.get_buffer(self.output_frame_paused.shape)
+            np.copyto(output_frame, self.output_frame_paused)
+            frame.paused_version = self.output_frame_paused_version
+
+        frame.output_frame = output_frame
+        return frame
+
+    def stage_effects(self, frame):
+        """
+        Pipeline stage: resizes output frame and adds blur, contrast, brightness and noise
+        :param frame: FrameData
+        :return: FrameData
+        """
+        output_frame = frame.output_frame
+
+        # Apply changed settings and quality level
+        self.apply_effects_quality()
+
+        # Initialize CUDA (device must be selected in the thread that uses it)
+        cuda_enabled = self.cuda_enabled
+        if cuda_enabled and self.cuda_thread_id != threading.get_ident():
+            logging.info("Initializing CUDA...")
+            cv2.cuda.setDevice(0)
+            self.gpu_output_frame = cv2.cuda_GpuMat()
+            self.gpu_noise_frame = cv2.cuda_GpuMat()
+            self.gpu_h = cv2.cuda_GpuMat(self.gpu_output_frame.size(), cv2.CV_8UC1)
+            self.gpu_s = cv2.cuda_GpuMat(self.gpu_output_frame.size(), cv2.CV_8UC1)
+            self.gpu_v = cv2.cuda_GpuMat(self.gpu_output_frame.size(), cv2.CV_8UC1)
+            self.cuda_thread_id = threading.get_ident()
+        elif not cuda_enabled:
+            self.cuda_thread_id = None
+
+        # Output in I420 format (CPU effects only, I420 needs even size)
+        yuv_enabled = self.yuv_pipeline_enabled and not cuda_enabled \
+            and self.output_width % 2 == 0 and self.output_height % 2 == 0
+
+        # Paused frame was already resized, blurred and adjusted -> add only noise
+        effects_key = (frame.paused_version, self.output_width, self.output_height,
+                       self.output_effects.blur_radius, self.output_contrast, self.output_brightness, yuv_enabled)
+        if frame.paused_version >= 0 and not cuda_enabled and effects_key == self.paused_effects_key:
+            output_frame = frame.get_buffer(self.paused_effects_frame.shape)
+            np.copyto(output_frame, self.paused_effects_frame)
+            if not self.paused_effects_black:
+                # noinspection PyBroadException
+                try:
+                    noise_frame = self.read_noise_frame()
+                    if noise_frame is not None:
+                        if yuv_enabled:
+                            self.output_effects.add_noise_i420(output_frame, noise_frame)
                         else:
-                            # Convert output frame to HSV
-                            output_frame_hsv = cv2.cvtColor(output_frame, cv2.COLOR_BGR2HSV)
-
-                            # Add noise to darken areas
-                            output_frame_v_noisy = cv2.bitwise_not(
-                                cv2.bitwise_and(cv2.bitwise_not(output_frame_hsv[:, :, 2]), noise_frame))
-
-                            # Combine with clear output
-                            output_frame_v_noisy = cv2.addWeighted(output_frame_hsv[:, :, 2],
-                                                                   1. - self.output_noise_amount,
-                                                                   output_frame_v_noisy, self.output_noise_amount, 0.)
-                            output_frame_hsv[:, :, 2] = output_frame_v_noisy
-
-                            # Convert back to BGR
-                            output_frame = cv2.cvtColor(output_frame_hsv, cv2.COLOR_HSV2BGR)
-                    except Exception:
-                        traceback.print_exc()
-                        pass
-
-                    self.time_debug("Noise added", time_started)
-
-                # Make final frame
-                if not error:
-                    self.final_output_frame = output_frame.copy()
-
-                # Output enabled
-                if not error and not self.pause_output:
-                    # Set active state
-                    self.controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
-                    self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
-
-                # Set current camera state
-                if error:
-                    if self.pause_output:
-                        self.controller.update_state_camera(Controller.CAMERA_STATE_ERROR_PAUSED)
-                        self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ERROR_PAUSED)
-                    else:
-                        self.controller.update_state_camera(Controller.CAMERA_STATE_ERROR_ACTIVE)
-                        self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ERROR_ACTIVE)
-                else:
-                    if self.pause_output:
-                        self.controller.update_state_camera(Controller.CAMERA_STATE_PAUSED)
-                        self.serial_controller.update_state_camera(Controller.CAMERA_STATE_PAUSED)
-                    else:
-                        self.controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
-                        self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
+                            self.output_effects.add_noise(output_frame, noise_frame)
+                except Exception:
+                    traceback.print_exc()
+            self.time_debug("Noise added to paused frame", frame.time_started)
+            frame.output_frame = output_frame
+            return frame
+
+        # Resize output and convert it once to I420 (luma is used instead of gray to check black frame)
+        if yuv_enabled:
+            if output_frame.shape[:2] != (self.output_height, self.output_width):
+                output_frame = cv2.resize(output_frame, (self.output_width, self.output_height),
+                                          dst=frame.get_buffer((self.output_height, self.output_width, 3)))
+            output_size = (self.output_height * 3 // 2, self.output_width)
+            output_frame = cv2.cvtColor(output_frame, cv2.COLOR_BGR2YUV_I420, dst=frame.get_buffer(output_size))
+            is_output_frame_black = cv2.minMaxLoc(OutputEffects.get_i420_planes(output_frame)[0])[1] \
+                <= OutputEffects.LUMA_BLACK
+            self.time_debug("Output converted to I420", frame.time_started)
 
-                self.time_debug("States updated", time_started)
+        else:
+            # Is frame totally black?
+            output_gray = frame.get_buffer(output_frame.shape[:2])
+            cv2.cvtColor(output_frame, cv2.COLOR_BGR2GRAY, dst=output_gray)
+            is_output_frame_black = cv2.countNonZero(output_gray) == 0
+
+            # Resize output (frame is already at output size if it was composited at output resolution)
+            output_size = (self.output_height, self.output_width, 3)
+            if output_frame.shape != output_size:
+                output_frame = cv2.resize(output_frame, (self.output_width, self.output_height),
+                                          dst=frame.get_buffer(output_size))
+                self.time_debug("Output resized", frame.time_started)
+
+        # Add effects only on non-black output frame
+        if not is_output_frame_black:
+            # Read noise
+            noise_frame = self.read_noise_frame()
+
+            # Add effects using GPU
+            if cuda_enabled:
+                # Add blur
+                # noinspection PyBroadException
+                try:
+                    # Blur radius is already made odd (and set to 1 by quality governor) in apply_effects_quality()
+                    blur_radius = self.output_effects.blur_radius
+                    if blur_radius > 1:
+                        output_frame = cv2.GaussianBlur(output_frame, (blur_radius, blur_radius), 0,
+                                                        dst=frame.get_buffer(output_size))
+                except:
+                    pass
 
-                # Replace with black if none
-                if self.final_output_frame is None:
-                    self.final_output_frame = cv2.resize(black_frame, (self.output_width, self.output_height))
+                self.time_debug("Blur added", frame.time_started)
 
-                # Send final image
-                self.push_output_image()
-                # cv2.waitKey(1)
+                # Upload to gpu and apply contrast and brightness
+                self.gpu_output_frame.upload(output_frame)
+                self.gpu_output_frame = cv2.cuda.addWeighted(self.gpu_output_frame, self.output_contrast,
+                                                             self.gpu_output_frame, 0., self.output_brightness)
 
-                self.time_debug("Output pushed", time_started)
+                self.time_debug("Br. / Cont. added", frame.time_started)
 
-                # Control cycle time
-                if self.maximum_fps > 0:
-                    while time.time() - time_started < (1. / self.maximum_fps):
-                        time.sleep(0.001)
-                else:
-                    while self.maximum_fps <= 0:
-                        time.sleep(0.01)
+                # Add noise
+                # noinspection PyBroadException
+                try:
+                    if noise_frame is not None:
+                        self.gpu_noise_frame.upload(noise_frame)
 
-                # Calculate FPS
-                current_fps = 1. / (time.time() - time_started)
+                        # Convert output frame to HSV
+                        gpu_output_frame_hsv = cv2.cuda.cvtColor(self.gpu_output_frame, cv2.COLOR_BGR2HSV)
 
-                # Filter FPS
-                if self.real_fps == 0:
-                    self.real_fps = current_fps
-                self.real_fps = self.real_fps * 0.90 + current_fps * 0.10
+                        # Resize GPU Mats
+                        if self.gpu_v.size() != gpu_output_frame_hsv.size():
+                            self.gpu_h = cv2.cuda_GpuMat(gpu_output_frame_hsv.size(), cv2.CV_8UC1)
+                            self.gpu_s = cv2.cuda_GpuMat(gpu_output_frame_hsv.size(), cv2.CV_8UC1)
+                            self.gpu_v = cv2.cuda_GpuMat(gpu_output_frame_hsv.size(), cv2.CV_8UC1)
 
-                # Update FPS
-                get_updater().call_latest(self.label_fps.setText, "FPS: " + str(round(self.real_fps, 1)))
+                        # Split HSV
+                        cv2.cuda.split(gpu_output_frame_hsv, [self.gpu_h, self.gpu_s, self.gpu_v])
 
-                self.time_debug("Cycle finished", time_started)
-                if TIME_DEBUG:
-                    print()
+                        # Add noise to darken areas
+                        gpu_v_inverted = cv2.cuda.bitwise_not(self.gpu_v)
+                        gpu_v_noise_added = cv2.cuda.bitwise_and(gpu_v_inverted, self.gpu_noise_frame)
+                        gpu_v_noisy = cv2.cuda.bitwise_not(gpu_v_noise_added)
 
-            # OpenCV loop error
-            except Exception as e:
-                logging.exception(e)
+                        # Combine with clear output
+                        gpu_v_noisy = cv2.cuda.addWeighted(self.gpu_v, 1. - self.output_noise_amount,
+                                                           gpu_v_noisy, self.output_noise_amount, 0.)
 
-        # End of while loop
-        cv2.destroyAllWindows()
-        logging.warning("OpenCV loop exited")
+                        # Merge HSV
+                        cv2.cuda.merge([self.gpu_h, self.gpu_s, gpu_v_noisy], gpu_output_frame_hsv)
 
-    def filter_corners(self, tl, tr, br, bl):
-        # Convert to float
-        tl_f = [float(tl[0]), float(tl[1])]
-        tr_f = [float(tr[0]), float(tr[1])]
-        br_f = [float(br[0]), float(br[1])]
-        bl_f = [float(bl[0]), float(bl[1])]
+                        # Convert back to BGR
+                        self.gpu_output_frame = cv2.cuda.cvtColor(gpu_output_frame_hsv, cv2.COLOR_HSV2BGR)
 
-        # Find average difference
-        diff_tl = (abs(tl_f[0] - self.tl_filtered[0]) + abs(tl_f[1] - self.tl_filtered[1])) / 2.
-        diff_tr = (abs(tr_f[0] - self.tr_filtered[0]) + abs(tr_f[1] - self.tr_filtered[1])) / 2.
-        diff_br = (abs(br_f[0] - self.br_filtered[0]) + abs(br_f[1] - self.br_filtered[1])) / 2.
-        diff_bl = (abs(bl_f[0] - self.bl_filtered[0]) + abs(bl_f[1] - self.bl_filtered[1])) / 2.
-        diff = (diff_tl + diff_tr + diff_br + diff_bl) / 4.
-        if diff > self.aruco_filter_scale:
-            diff = self.aruco_filter_scale
+                    # Download from GPU
+                    output_frame = self.gpu_output_frame.download(frame.get_buffer(output_size))
+                except Exception:
+                    traceback.print_exc()
+                    pass
 
-        # Calculate filter factor
-        filter_factor = 1. - (diff / self.aruco_filter_scale)
-        if filter_factor >= 1.:
-            filter_factor = 0.99
+            # Add effects using CPU (blur, contrast and brightness in one pass, noise without HSV conversion)
+            else:
+                # noinspection PyBroadException
+                try:
+                    if yuv_enabled:
+                        output_frame = self.output_effects.apply_filter_i420(output_frame,
+                                                                             frame.get_buffer(output_size))
+                    else:
+                        output_frame = self.output_effects.apply_filter(output_frame, frame.get_buffer(output_size))
 
-        self.tl_filtered = [self.tl_filtered[0] * filter_factor + tl_f[0] * (1. - filter_factor),
-                            self.tl_filtered[1] * filter_factor + tl_f[1] * (1. - filter_factor)]
+                    # Keep paused frame without noise
+                    if frame.paused_version >= 0:
+                        self.store_paused_effects(output_frame, effects_key, False)
 
-        self.tr_filtered = [self.tr_filtered[0] * filter_factor + tr_f[0] * (1. - filter_factor),
-                            self.tr_filtered[1] * filter_factor + tr_f[1] * (1. - filter_factor)]
+                    if noise_frame is not None:
+                        if yuv_enabled:
+                            self.output_effects.add_noise_i420(output_frame, noise_frame)
+                        else:
+                            self.output_effects.add_noise(output_frame, noise_frame)
+                except Exception:
+                    traceback.print_exc()
+                    pass
 
-        self.br_filtered = [self.br_filtered[0] * filter_factor + br_f[0] * (1. - filter_factor),
-                            self.br_filtered[1] * filter_factor + br_f[1] * (1. - filter_factor)]
+            self.time_debug("Noise added", frame.time_started)
 
-        self.bl_filtered = [self.bl_filtered[0] * filter_factor + bl_f[0] * (1. - filter_factor),
-                            self.bl_filtered[1] * filter_factor + bl_f[1] * (1. - filter_factor)]
+        # Black paused frame
+        elif frame.paused_version >= 0:
+            self.store_paused_effects(output_frame, effects_key, True)
 
-        # Convert back to int
-        tl = [int(self.tl_filtered[0]), int(self.tl_filtered[1])]
-        tr = [int(self.tr_filtered[0]), int(self.tr_filtered[1])]
-        br = [int(self.br_filtered[0]), int(self.br_filtered[1])]
-        bl = [int(self.bl_filtered[0]), int(self.bl_filtered[1])]
+        frame.output_frame = output_frame
+        return frame
 
-        # Return filtered data
-        return tl, tr, br, bl
+    def store_paused_effects(self, output_frame, effects_key, is_black: bool):
+        """
+        Remembers paused frame with effects (except noise) to reuse it while output is paused
+        :param output_frame: resized, blurred and adjusted frame
+        :param effects_key: paused frame version, output size and effects parameters
+        :param is_black: True if frame is black (no effects will be added)
+        :return:
+        """
+        self.paused_effects_frame = self.buffer_pool.reuse(self.paused_effects_frame, output_frame.shape)
+        np.copyto(self.paused_effects_frame, output_frame)
+        self.paused_effects_key = effects_key
+        self.paused_effects_black = is_black
+
+    def read_noise_frame(self):
+        """
+        Takes next noise frame of the output size from noise bank or noise generator
+        :return: single-channel noise image or None
+        """
+        if self.output_noise_amount <= 0:
+            return None
+        # noinspection PyBroadException
+        try:
+            # Reuse previous noise frame (lower noise rate)
+            noise_frame = self.noise_frame
+            if self.noise_counter % self.noise_interval != 0 and noise_frame is not None \
+                    and noise_frame.shape == (self.output_height, self.output_width):
+                self.noise_counter += 1
+                return noise_frame
+
+            if self.noise_source == NOISE_SOURCE_GENERATED:
+                noise_frame = self.noise_generator.get_frame(self.output_width, self.output_height)
+            else:
+                noise_frame = self.noise_bank.get_frame(self.noise_counter, self.output_width, self.output_height)
+            self.noise_frame = noise_frame
+            self.noise_counter += 1
+            return noise_frame
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def stage_publish(self, frame):
+        """
+        Pipeline stage: updates states and pushes final frame to preview and outputs
+        :param frame: FrameData
+        :return: FrameData
+        """
+        # Make final frame (outputs can still send previous final frames, so they are rotated)
+        if not frame.error:
+            self.final_output_index = (self.final_output_index + 1) % len(self.final_output_frames)
+            final_output_frame = self.buffer_pool.reuse(self.final_output_frames[self.final_output_index],
+                                                        frame.output_frame.shape)
+            np.copyto(final_output_frame, frame.output_frame)
+            self.final_output_frames[self.final_output_index] = final_output_frame
+            self.final_output_frame = final_output_frame
+
+        # Output enabled
+        if not frame.error and not self.pause_output:
+            # Set active state
+            self.controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
+            self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
+
+        # Set current camera state
+        if frame.error:
+            if self.pause_output:
+                self.controller.update_state_camera(Controller.CAMERA_STATE_ERROR_PAUSED)
+                self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ERROR_PAUSED)
+            else:
+                self.controller.update_state_camera(Controller.CAMERA_STATE_ERROR_ACTIVE)
+                self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ERROR_ACTIVE)
+        else:
+            if self.pause_output:
+                self.controller.update_state_camera(Controller.CAMERA_STATE_PAUSED)
+                self.serial_controller.update_state_camera(Controller.CAMERA_STATE_PAUSED)
+            else:
+                self.controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
+                self.serial_controller.update_state_camera(Controller.CAMERA_STATE_ACTIVE)
+
+        self.time_debug("States updated", frame.time_started)
+
+        # Replace with black if none
+        if self.final_output_frame is None:
+            self.final_output_frame = cv2.resize(self.black_frame, (self.output_width, self.output_height))
+
+        # Send final image
+        self.push_output_image(frame)
+        # cv2.waitKey(1)
+
+        self.time_debug("Output pushed", frame.time_started)
+
+        # Calculate FPS (time between two published frames)
+        time_now = time.time()
+        if self.last_publish_time > 0 and time_now > self.last_publish_time:
+            current_fps = 1. / (time_now - self.last_publish_time)
+
+            # Filter FPS
+            if self.real_fps == 0:
+                self.real_fps = current_fps
+            self.real_fps = self.real_fps * 0.90 + current_fps * 0.10
+
+            # Update FPS and quality level
+            fps_text = "FPS: " + str(round(self.real_fps, 1))
+            if self.quality_governor.get_level() > 0:
+                fps_text += " (" + self.quality_governor.get_description() + ")"
+            get_updater().call_latest(self.label_fps.setText, fps_text)
+        self.last_publish_time = time_now
+
+        # Lower or restore quality (capture stage is excluded because it waits for the next frame)
+        pipeline = self.pipeline
+        if pipeline is not None:
+            stage_times = pipeline.get_stage_times()
+            stage_times.pop("Capture", None)
+            if self.quality_governor.update(stage_times, not pipeline.is_running()):
+                # Measure new level from scratch
+                pipeline.reset_stage_times()
+                self.request_quality_update()
+
+        # Filter latency between frame capture and output
+        if frame.capture_timestamp > 0 and time_now > frame.capture_timestamp:
+            if self.output_latency == 0:
+                self.output_latency = time_now - frame.capture_timestamp
+            self.output_latency = self.output_latency * 0.90 + (time_now - frame.capture_timestamp) * 0.10
+
+        self.time_debug("Cycle finished", frame.time_started)
+        if TIME_DEBUG:
+            print("Buffers allocated: " + str(self.buffer_pool.get_allocations_counter()
+                                              - self.last_allocations_counter))
+            print("Warp cache hits: " + str(self.window_compositor.warp_cache.get_hits_counter())
+                  + ", misses: " + str(self.window_compositor.warp_cache.get_misses_counter())
+                  + ", tiled updates: " + str(self.window_compositor.get_tiled_updates_counter()[0]))
+            jitter_mean, jitter_max, overruns, dropped = self.frame_pacer.get_statistics()
+            print("Pacing jitter: {:.2f} ms (max {:.2f} ms), overruns: {}, dropped: {}"
+                  .format(jitter_mean, jitter_max, overruns, dropped))
+            degrades, restores = self.quality_governor.get_counters()
+            print("Quality level: " + str(self.quality_governor.get_level())
+                  + ", lowered: " + str(degrades) + ", restored: " + str(restores))
+            print()
+        self.last_allocations_counter = self.buffer_pool.get_allocations_counter()
+
+        # Return buffers to the pool
+        frame.release()
+
+        return frame
+
+    def filter_corners(self, tl, tr, br, bl, timestamp: float):
+        """
+        Filters screen corners and extrapolates them to the time of display
+        :param tl: top left corner
+        :param tr: top right corner
+        :param br: bottom right corner
+        :param bl: bottom left corner
+        :param timestamp: capture time of the frame (in seconds)
+        :return: filtered tl, tr, br, bl (float32 arrays)
+        """
+        self.corner_filter.update([tl, tr, br, bl], timestamp)
+
+        # Predict corners (negative prediction time - use measured pipeline latency)
+        prediction = self.corner_prediction if self.corner_prediction >= 0 else self.output_latency
+        corners = self.corner_filter.predict(timestamp + prediction)
+
+        return corners[0], corners[1], corners[2], corners[3]
 
     def set_preview_mode(self, preview_mode: int):
         self.preview_mode = preview_mode
 
-    def push_output_image(self):
+    def push_output_image(self, frame):
+        """
+        Pushes final output frame to preview and outputs
+        :param frame: FrameData
+        :return:
+        """
+        # BGR output (I420 frames are converted only for preview and HTTP stream)
+        final_output_bgr = None
+        if self.preview_mode == PREVIEW_OUTPUT or self.settings_handler.settings["http_stream_enabled"]:
+            # Converted frames are rotated with final frames (HTTP stream can still send the previous one)
+            if self.final_output_frame is not None and self.final_output_frame.ndim == 2:
+                height, width = self.final_output_frame.shape
+                self.final_output_bgr_frames[self.final_output_index] = self.buffer_pool.reuse(
+                    self.final_output_bgr_frames[self.final_output_index], (height * 2 // 3, width, 3))
+            final_output_bgr = get_bgr_frame(self.final_output_frame,
+                                             self.final_output_bgr_frames[self.final_output_index])
+
         # Preview output
         if self.preview_mode == PREVIEW_OUTPUT:
-            preview_image = self.final_output_frame
+            preview_image = final_output_bgr
 
         # Preview window
         elif self.preview_mode == PREVIEW_WINDOW:
-            preview_image = self.window_image
+            preview_image = frame.window_image
 
         # Preview aruco
         elif self.preview_mode == PREVIEW_ARUCO:
@@ -1122,12 +1545,15 @@ class OpenCVHandler:
 
         # Preview source
         else:
-            preview_image = self.input_frame
+            preview_image = frame.input_frame
 
         try:
             # Resize preview
-            preview_resized = resize_keep_ratio(preview_image, self.preview_label.size().width(),
-                                                self.preview_label.size().height())
+            preview_width = self.preview_label.size().width()
+            preview_height = self.preview_label.size().height()
+            self.preview_frame = self.buffer_pool.reuse(self.preview_frame, (preview_height, preview_width, 3))
+            preview_resized = resize_keep_ratio(preview_image, preview_width, preview_height,
+                                                dst=self.preview_frame)
 
             # Convert to pixmap
             pixmap = QPixmap.fromImage(
@@ -1140,12 +1566,13 @@ class OpenCVHandler:
             # Push to Flicker class
             # Don't update window image in fullscreen mode with old capture mode
             if not self.flicker.is_force_fullscreen_enabled():
-                self.flicker.set_frame(self.window_image)
+                self.flicker.set_frame(frame.window_image)
 
             # Push to http server
-            self.http_stream.set_frame(self.final_output_frame)
+            if final_output_bgr is not None:
+                self.http_stream.set_frame(final_output_bgr)
 
-            # Virtual camera
+            # Virtual camera (BGR or I420)
             self.virtual_camera.set_frame(self.final_output_frame)
         except Exception as e:
             logging.exception(e)
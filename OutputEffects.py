@@ -0,0 +1,216 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import cv2
+import numpy as np
+
+# Luma range of I420 frames (BT.601 limited range as in cv2.COLOR_BGR2YUV_I420)
+LUMA_BLACK = 16
+LUMA_RANGE = 219
+CHROMA_ZERO = 128
+
+
+def get_i420_planes(image):
+    """
+    Splits I420 image into planes (without copying)
+    :param image: (height * 3 / 2, width) I420 image
+    :return: Y plane (height, width), U plane and V plane (height / 2, width / 2)
+    """
+    height = image.shape[0] * 2 // 3
+    width = image.shape[1]
+    chroma = image[height:].reshape((2, height // 2, width // 2))
+    return image[:height], chroma[0], chroma[1]
+
+
+class OutputEffects:
+    def __init__(self, buffer_pool):
+        """
+        Initializes OutputEffects class (blur, contrast, brightness and noise of output frame on CPU)
+        :param buffer_pool: BufferPool for temporary buffers
+        """
+        self.buffer_pool = buffer_pool
+
+        self.blur_radius = 1
+        self.contrast = 1.
+        self.brightness = 0
+        self.noise_amount = 0.
+
+        self.blur_kernel = None
+
+    def set_parameters(self, blur_radius: int, contrast: float, brightness: int, noise_amount: float):
+        """
+        Sets effects parameters
+        :param blur_radius: Gaussian blur kernel size (will be made odd)
+        :param contrast: output contrast
+        :param brightness: output brightness
+        :param noise_amount: amount of noise in dark areas (0 - 1)
+        :return:
+        """
+        if blur_radius % 2 == 0 or blur_radius <= 0:
+            blur_radius += 1
+        # Radius is changed before kernel is cleared, so kernel is never rebuilt with previous radius
+        blur_radius = max(blur_radius, 1)
+        if blur_radius != self.blur_radius:
+            self.blur_radius = blur_radius
+            self.blur_kernel = None
+        self.contrast = contrast
+        self.brightness = brightness
+        self.noise_amount = noise_amount
+
+    def apply_filter(self, image, dst):
+        """
+        Applies blur, contrast and brightness in one pass
+        :param image: BGR image
+        :param dst: output BGR image of the same size (can't be the same as image)
+        :return: dst
+        """
+        if self.blur_radius > 1:
+            # Contrast is applied by scaled horizontal kernel and brightness by delta
+            if self.blur_kernel is None:
+                self.blur_kernel = cv2.getGaussianKernel(self.blur_radius, 0)
+            cv2.sepFilter2D(image, -1, self.blur_kernel * self.contrast, self.blur_kernel,
+                            dst=dst, delta=self.brightness)
+        else:
+            cv2.addWeighted(image, self.contrast, image, 0., self.brightness, dst=dst)
+        return dst
+
+    def add_noise(self, image, noise):
+        """
+        Adds noise to dark areas of image in place. Each pixel is scaled by the ratio of its noisy and clear
+        brightness (max of B, G, R), which is the same as changing V channel in HSV
+        :param image: BGR image
+        :param noise: single-channel noise image of the same size
+        :return: image
+        """
+        if self.noise_amount <= 0:
+            return image
+
+        shape = image.shape[:2]
+        planes = [self.buffer_pool.acquire(shape) for _ in range(3)]
+        value = self.buffer_pool.acquire(shape)
+        value_noisy = self.buffer_pool.acquire(shape)
+
+        # Brightness (V channel)
+        cv2.split(image, planes)
+        cv2.max(planes[0], planes[1], dst=value)
+        cv2.max(value, planes[2], dst=value)
+
+        # Add noise to darken areas (~(~V & noise) = V | ~noise) and combine with clear brightness
+        cv2.bitwise_not(noise, dst=value_noisy)
+        cv2.bitwise_or(value, value_noisy, dst=value_noisy)
+        cv2.addWeighted(value, 1. - self.noise_amount, value_noisy, self.noise_amount, 0., dst=value_noisy)
+
+        # Black pixels can't be scaled, so they become gray with noisy brightness (as with HSV conversion)
+        black_noisy = self.buffer_pool.acquire(shape)
+        cv2.compare(value, 0, cv2.CMP_EQ, dst=black_noisy)
+        cv2.bitwise_and(black_noisy, value_noisy, dst=black_noisy)
+
+        # Scale each plane by noisy / clear brightness (single-channel ratio in float to keep precision of dark pixels)
+        ratio = self.buffer_pool.acquire(shape, np.float32)
+        cv2.divide(value_noisy, value, dst=ratio, dtype=cv2.CV_32F)
+        for plane in planes:
+            cv2.multiply(plane, ratio, dst=plane, dtype=cv2.CV_8U)
+            cv2.add(plane, black_noisy, dst=plane)
+        cv2.merge(planes, dst=image)
+
+        for plane in planes:
+            self.buffer_pool.release(plane)
+        self.buffer_pool.release(value)
+        self.buffer_pool.release(value_noisy)
+        self.buffer_pool.release(black_noisy)
+        self.buffer_pool.release(ratio)
+        return image
+
+    def apply_filter_i420(self, image, dst):
+        """
+        Applies blur, contrast and brightness to I420 image. Luma is blurred and adjusted, chroma is only scaled
+        by contrast (that is the same as adjusting all B, G, R channels)
+        :param image: I420 image
+        :param dst: output I420 image of the same size (can't be the same as image)
+        :return: dst
+        """
+        y, u, v = get_i420_planes(image)
+        dst_y, dst_u, dst_v = get_i420_planes(dst)
+
+        # Luma: Y' = 16 + contrast * (Y - 16) + brightness (in luma range)
+        delta = LUMA_BLACK * (1. - self.contrast) + self.brightness * LUMA_RANGE / 255.
+        if self.blur_radius > 1:
+            if self.blur_kernel is None:
+                self.blur_kernel = cv2.getGaussianKernel(self.blur_radius, 0)
+            cv2.sepFilter2D(y, -1, self.blur_kernel * self.contrast, self.blur_kernel, dst=dst_y, delta=delta)
+        else:
+            cv2.addWeighted(y, self.contrast, y, 0., delta, dst=dst_y)
+
+        # Chroma: C' = 128 + contrast * (C - 128)
+        delta = CHROMA_ZERO * (1. - self.contrast)
+        cv2.addWeighted(u, self.contrast, u, 0., delta, dst=dst_u)
+        cv2.addWeighted(v, self.contrast, v, 0., delta, dst=dst_v)
+        return dst
+
+    def add_noise_i420(self, image, noise):
+        """
+        Adds noise to dark areas of I420 image in place. Brightness is taken from luma instead of max of B, G, R.
+        Chroma is scaled by the ratio of noisy and clear brightness of each 2x2 block
+        :param image: I420 image
+        :param noise: single-channel noise image with the size of Y plane
+        :return: image
+        """
+        if self.noise_amount <= 0:
+            return image
+
+        y, u, v = get_i420_planes(image)
+        shape = y.shape
+        chroma_shape = u.shape
+        value = self.buffer_pool.acquire(shape)
+        value_noisy = self.buffer_pool.acquire(shape)
+
+        # Brightness (full range luma)
+        cv2.convertScaleAbs(y, dst=value, alpha=255. / LUMA_RANGE, beta=-LUMA_BLACK * 255. / LUMA_RANGE)
+
+        # Add noise to darken areas (~(~V & noise) = V | ~noise) and combine with clear brightness
+        cv2.bitwise_not(noise, dst=value_noisy)
+        cv2.bitwise_or(value, value_noisy, dst=value_noisy)
+        cv2.addWeighted(value, 1. - self.noise_amount, value_noisy, self.noise_amount, 0., dst=value_noisy)
+
+        # Scale chroma by noisy / clear brightness (black pixels become gray, as division by 0 gives 0)
+        value_small = self.buffer_pool.acquire(chroma_shape)
+        value_noisy_small = self.buffer_pool.acquire(chroma_shape)
+        ratio = self.buffer_pool.acquire(chroma_shape, np.float32)
+        chroma = self.buffer_pool.acquire(chroma_shape, np.float32)
+        cv2.resize(value, (chroma_shape[1], chroma_shape[0]), dst=value_small, interpolation=cv2.INTER_AREA)
+        cv2.resize(value_noisy, (chroma_shape[1], chroma_shape[0]), dst=value_noisy_small,
+                   interpolation=cv2.INTER_AREA)
+        cv2.divide(value_noisy_small, value_small, dst=ratio, dtype=cv2.CV_32F)
+        for plane in (u, v):
+            cv2.subtract(plane, CHROMA_ZERO, dst=chroma, dtype=cv2.CV_32F)
+            cv2.multiply(chroma, ratio, dst=chroma)
+            cv2.add(chroma, CHROMA_ZERO, dst=plane, dtype=cv2.CV_8U)
+
+        # Noisy brightness back to luma range
+        cv2.convertScaleAbs(value_noisy, dst=y, alpha=LUMA_RANGE / 255., beta=LUMA_BLACK)
+
+        self.buffer_pool.release(value)
+        self.buffer_pool.release(value_noisy)
+        self.buffer_pool.release(value_small)
+        self.buffer_pool.release(value_noisy_small)
+        self.buffer_pool.release(ratio)
+        self.buffer_pool.release(chroma)
+        return image
@@ -200,7 +200,7 @@ class Window(QMainWindow):
         self.id_tr.valueChanged.connect(self.update_settings)
         self.id_br.valueChanged.connect(self.update_settings)
         self.id_bl.valueChanged.connect(self.update_settings)
-        self.aruco_filter_scale.valueChanged.connect(self.update_settings)
+        self.aruco_filter_min_cutoff.valueChanged.connect(self.update_settings)
         self.aruco_filter_enabled.clicked.connect(self.write_settings)
         self.aruco_detector_parameters.textChanged.connect(self.update_settings)
         self.virtual_camera_enabled.clicked.connect(self.write_settings)
@@ -298,7 +298,7 @@ class Window(QMainWindow):
             self.id_tr.setValue(int(self.settings_handler.settings["aruco_ids"][1]))
             self.id_br.setValue(int(self.settings_handler.settings["aruco_ids"][2]))
             self.id_bl.setValue(int(self.settings_handler.settings["aruco_ids"][3]))
-            self.aruco_filter_scale.setValue(float(self.settings_handler.settings["aruco_filter_scale"]))
+            self.aruco_filter_min_cutoff.setValue(float(self.settings_handler.settings["aruco_filter_min_cutoff"]))
             self.aruco_filter_enabled.setChecked(self.settings_handler.settings["aruco_filter_enabled"])
             self.aruco_detector_parameters.setText(self.settings_handler.settings["aruco_detector_parameters"])
 
@@ -395,7 +395,7 @@ class Window(QMainWindow):
         self.settings_handler.settings["aruco_ids"][1] = int(self.id_tr.value())
         self.settings_handler.settings["aruco_ids"][2] = int(self.id_br.value())
         self.settings_handler.settings["aruco_ids"][3] = int(self.id_bl.value())
-        self.settings_handler.settings["aruco_filter_scale"] = float(self.aruco_filter_scale.value())
+        self.settings_handler.settings["aruco_filter_min_cutoff"] = float(self.aruco_filter_min_cutoff.value())
         self.settings_handler.settings["aruco_filter_enabled"] = self.aruco_filter_enabled.isChecked()
         self.settings_handler.settings["aruco_detector_parameters"] = self.aruco_detector_parameters.text()
 
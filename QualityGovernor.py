@@ -0,0 +1,167 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import logging
+
+# Degradation steps (in order of activation)
+STEP_PYRAMID = 0
+STEP_WINDOW_FPS = 1
+STEP_BLUR = 2
+STEP_NOISE_RATE = 3
+STEPS_NAMES = ["pyramid", "window fps", "no blur", "noise rate"]
+
+# Degrade if frame time is above budget for this number of frames
+DEGRADE_FRAMES = 15
+
+# Restore if frame time is below HEADROOM_FACTOR * budget for this number of frames
+RESTORE_FRAMES = 90
+HEADROOM_FACTOR = 0.6
+
+# Number of frames ignored after level change (frames that are already in pipeline were processed with previous level)
+SETTLE_FRAMES = 5
+
+
+class QualityGovernor:
+    def __init__(self):
+        """
+        Initializes QualityGovernor class (lowers quality step by step if frame time exceeds 1 / max_fps)
+        """
+        self.enabled = False
+        self.frame_budget = 0.
+
+        self.level = 0
+        self.overload_frames = 0
+        self.headroom_frames = 0
+        self.settle_frames = 0
+
+        self.degrades_counter = 0
+        self.restores_counter = 0
+
+    def set_parameters(self, enabled: bool, maximum_fps: float):
+        """
+        Sets governor parameters
+        :param enabled: False to keep full quality
+        :param maximum_fps: target frame rate (<= 0 - no target)
+        :return:
+        """
+        self.enabled = enabled
+        self.frame_budget = 1. / maximum_fps if maximum_fps > 0 else 0.
+        if not self.enabled or self.frame_budget <= 0.:
+            self.reset()
+
+    def reset(self):
+        """
+        Restores full quality
+        :return:
+        """
+        self.level = 0
+        self.overload_frames = 0
+        self.headroom_frames = 0
+        self.settle_frames = 0
+
+    def get_level(self):
+        """
+        :return: number of active degradation steps
+        """
+        return self.level
+
+    def is_step_active(self, step: int):
+        """
+        :param step: STEP_PYRAMID, STEP_WINDOW_FPS, STEP_BLUR or STEP_NOISE_RATE
+        :return: True if step is active
+        """
+        return self.level > step
+
+    def get_counters(self):
+        """
+        :return: number of degradations, number of restorations
+        """
+        return self.degrades_counter, self.restores_counter
+
+    def get_description(self):
+        """
+        :return: active steps as text (empty string on full quality)
+        """
+        if self.level == 0:
+            return ""
+        return "quality -" + str(self.level) + ": " + ", ".join(STEPS_NAMES[:self.level])
+
+    def step_changed(self):
+        """
+        Restarts counting of frames after level change
+        :return:
+        """
+        self.overload_frames = 0
+        self.headroom_frames = 0
+        self.settle_frames = SETTLE_FRAMES
+
+    def update(self, stage_times: dict, sequential: bool):
+        """
+        Checks frame time and changes quality level. Stage times filter should be restarted after level change
+        :param stage_times: dictionary of filtered stage processing times (in seconds) without waiting stages
+        :param sequential: True if stages are running one after another (frame time is the sum of stages times)
+        instead of in parallel (frame time is the time of the slowest stage)
+        :return: True if quality level changed
+        """
+        if not self.enabled or self.frame_budget <= 0. or len(stage_times) == 0:
+            return False
+
+        # Wait until frames with new level reach the output
+        if self.settle_frames > 0:
+            self.settle_frames -= 1
+            return False
+
+        if sequential:
+            frame_time = sum(stage_times.values())
+        else:
+            frame_time = max(stage_times.values())
+
+        # Count frames above budget and frames with headroom
+        if frame_time > self.frame_budget:
+            self.overload_frames += 1
+            self.headroom_frames = 0
+        elif frame_time < self.frame_budget * HEADROOM_FACTOR:
+            self.headroom_frames += 1
+            self.overload_frames = 0
+        else:
+            self.overload_frames = 0
+            self.headroom_frames = 0
+
+        # Degrade
+        if self.overload_frames >= DEGRADE_FRAMES and self.level < len(STEPS_NAMES):
+            self.level += 1
+            self.degrades_counter += 1
+            self.step_changed()
+            logging.warning("Frame time " + str(round(frame_time * 1000., 1)) + " ms exceeds "
+                            + str(round(self.frame_budget * 1000., 1)) + " ms. Quality lowered: "
+                            + STEPS_NAMES[self.level - 1])
+            return True
+
+        # Restore
+        if self.headroom_frames >= RESTORE_FRAMES and self.level > 0:
+            self.level -= 1
+            self.restores_counter += 1
+            self.step_changed()
+            logging.info("Frame time " + str(round(frame_time * 1000., 1)) + " ms. Quality restored: "
+                         + STEPS_NAMES[self.level])
+            return True
+
+        return False
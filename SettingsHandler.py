@@ -20,6 +20,7 @@
 """
 
 # Default app settings
+import copy
 import json
 import logging
 import os
@@ -36,9 +37,13 @@ SETTINGS_DEFAULT = {
     "input_camera_focus_auto": False,
     "max_fps": 10,
     "cuda_enabled": False,
+    "pipeline_mode": OpenCVHandler.PIPELINE_MULTI_THREAD,
+    "frame_pacing_policy": OpenCVHandler.PACING_DROP,
+    "quality_governor_enabled": False,
     "fake_screen": False,
     "window_title": "",
     "window_capture_method": 0,
+    "window_capture_fps": 0,
     "window_crop": [5, 8, 0, 4],
     "fake_mode": 0,
     "flicker_duration": 2,
@@ -53,8 +58,26 @@ SETTINGS_DEFAULT = {
     "aruco_margins": [0, 0, 0, 0],
     "aruco_ids": [0, 1, 2, 3],
     "aruco_detector_parameters": OpenCVHandler.DEFAULT_DETECTOR_PARAMETERS,
-    "aruco_filter_scale": 5.,
+    "aruco_pyramid_scale": 1,
+    "aruco_filter_min_cutoff": 1.,
+    "aruco_filter_beta": 0.05,
+    "aruco_filter_derivative_cutoff": 1.,
+    "aruco_filter_prediction": 0.,
+    "warp_cache_enabled": True,
+    "warp_cache_epsilon": 0.25,
+    "window_tile_size": 64,
     "aruco_filter_enabled": True,
+    "aruco_tracking_enabled": False,
+    "aruco_roi_padding": 0.5,
+    "aruco_full_scan_interval": 30,
+    "aruco_flow_frames": 0,
+    "aruco_flow_max_error": 1.,
+    "aruco_detection_threads": 0,
+    "aruco_tile_overlap": 0.25,
+    "opencv_threads": -1,
+    "lens_correction_enabled": False,
+    "output_resolution_compositing": False,
+    "yuv_pipeline_enabled": False,
     "virtual_camera_enabled": False,
     "http_stream_enabled": False,
     "output_size": [960, 540],
@@ -62,6 +85,11 @@ SETTINGS_DEFAULT = {
     "output_contrast": 1.,
     "output_blur_radius": 1,
     "output_noise_amount": 0.,
+    "noise_bank_frames": 150,
+    "noise_bank_cache_enabled": False,
+    "noise_source": OpenCVHandler.NOISE_SOURCE_FILE,
+    "noise_tile_size": 0,
+    "noise_seed": -1,
     "http_server_ip": "localhost",
     "http_server_port": 8080,
     "jpeg_quality": 50,
@@ -112,11 +140,17 @@ class SettingsHandler:
                 self.write_to_file()
 
             # Check settings
-            if not self.check_settings():
+            if not isinstance(self.settings, dict):
                 logging.warning("Settings corrupted! Using default settings")
                 self.settings = SETTINGS_DEFAULT
                 self.write_to_file()
 
+            # Add missing keys (for example, new settings after update) without resetting other settings
+            elif not self.check_settings():
+                logging.warning("Some settings are missing! Adding default values of them")
+                self.add_missing_settings()
+                self.write_to_file()
+
             # Print final message
             logging.info("Settings loaded")
 
@@ -138,6 +172,16 @@ class SettingsHandler:
             logging.exception(e)
             return False
 
+    def add_missing_settings(self):
+        """
+        Adds keys that are missing in settings from SETTINGS_DEFAULT
+        :return:
+        """
+        for key in SETTINGS_DEFAULT:
+            if key not in self.settings:
+                logging.info("Adding missing setting " + key)
+                self.settings[key] = copy.deepcopy(SETTINGS_DEFAULT[key])
+
     def write_to_file(self):
         """
         Writes settings to JSON file
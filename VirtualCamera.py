@@ -22,6 +22,7 @@ import logging
 import threading
 import time
 
+import cv2
 import pyvirtualcam
 from pyvirtualcam import PixelFormat
 
@@ -37,6 +38,7 @@ class VirtualCamera:
         self.settings_handler = settings_handler
         self.virtual_camera = None
         self.virtual_camera_driver = ""
+        self.pixel_format = PixelFormat.BGR
         self.camera_thread_running = False
         self.frame = None
 
@@ -52,7 +54,22 @@ class VirtualCamera:
             try:
                 width = int(self.settings_handler.settings["output_size"][0])
                 height = int(self.settings_handler.settings["output_size"][1])
-                self.virtual_camera = pyvirtualcam.Camera(width=width, height=height, fps=30, fmt=PixelFormat.BGR)
+                # I420 frames are sent to driver without conversion from BGR
+                self.pixel_format = PixelFormat.I420 \
+                    if self.settings_handler.settings["yuv_pipeline_enabled"] and width % 2 == 0 and height % 2 == 0 \
+                    else PixelFormat.BGR
+                try:
+                    self.virtual_camera = pyvirtualcam.Camera(width=width, height=height, fps=30,
+                                                              fmt=self.pixel_format)
+                except (RuntimeError, ValueError) as e:
+                    if self.pixel_format != PixelFormat.I420:
+                        raise
+
+                    # Driver doesn't support I420 (pyvirtualcam raises RuntimeError with errors of all backends)
+                    logging.warning("Can't open virtual camera in I420 format: " + str(e) + ". Using BGR format")
+                    self.pixel_format = PixelFormat.BGR
+                    self.virtual_camera = pyvirtualcam.Camera(width=width, height=height, fps=30,
+                                                              fmt=self.pixel_format)
                 if self.virtual_camera.device is not None:
                     # Get driver name
                     self.virtual_camera_driver = str(self.virtual_camera.device)
@@ -88,7 +105,7 @@ class VirtualCamera:
     def set_frame(self, frame):
         """
         Sets frame
-        :param frame:
+        :param frame: BGR or I420 (2D) image
         :return:
         """
         if frame is not None:
@@ -102,7 +119,13 @@ class VirtualCamera:
         while self.camera_thread_running:
             try:
                 if self.virtual_camera is not None and self.frame is not None:
-                    self.virtual_camera.send(self.frame)
+                    # Convert frame if output format was changed after camera was opened
+                    frame = self.frame
+                    if self.pixel_format == PixelFormat.I420 and frame.ndim == 3:
+                        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+                    elif self.pixel_format != PixelFormat.I420 and frame.ndim == 2:
+                        frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+                    self.virtual_camera.send(frame)
                     self.virtual_camera.sleep_until_next_frame()
                 else:
                     time.sleep(0.1)
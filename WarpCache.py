@@ -0,0 +1,184 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import numpy as np
+
+# Maximum difference of brightness gradient colors to reuse warped window
+COLOR_EPSILON = 2
+
+
+class WarpCache:
+    def __init__(self):
+        """
+        Initializes WarpCache class (keeps warped window layer and its mask while screen and window don't change)
+        """
+        self.enabled = False
+        self.corners_epsilon = 0.
+
+        # Cached layer and key
+        self.warp = None
+        self.mask = None
+        self.rect = None
+        self.matrix = None
+        self.corners = None
+        self.window_version = -1
+        self.gradient = None
+        self.adjustment = None
+        self.frame_shape = None
+
+        # Cached adjusted window image and key
+        self.window = None
+        self.window_gradient = None
+        self.window_key = None
+
+        self.hits_counter = 0
+        self.misses_counter = 0
+
+    def set_parameters(self, enabled: bool, corners_epsilon: float):
+        """
+        Sets cache parameters
+        :param enabled: reuse warped window if nothing changed
+        :param corners_epsilon: maximum movement of screen corners (in pixels) to reuse warped window
+        :return:
+        """
+        self.enabled = enabled
+        self.corners_epsilon = corners_epsilon
+        if not self.enabled:
+            self.invalidate()
+
+    def get_hits_counter(self):
+        """
+        :return: number of frames with reused warped window
+        """
+        return self.hits_counter
+
+    def get_misses_counter(self):
+        """
+        :return: number of frames with warped window rendered again
+        """
+        return self.misses_counter
+
+    def invalidate(self):
+        """
+        Forces warp on the next frame
+        :return:
+        """
+        self.corners = None
+        self.window_key = None
+
+    def lookup_window(self, window_version: int, gradient, adjustment):
+        """
+        Checks if cached adjusted window image (before warp) can be used
+        :param window_version: version of captured window image
+        :param gradient: brightness gradient colors (or None)
+        :param adjustment: tuple of window image adjustments (contrast, brightness)
+        :return: adjusted window image or None
+        """
+        if self.enabled and self.window_key is not None \
+                and window_version == self.window_key[0] \
+                and adjustment == self.window_key[2] \
+                and (gradient is None) == (self.window_key[1] is None) \
+                and (gradient is None
+                     or np.max(np.abs(gradient.astype(np.int16) - self.window_key[1])) <= COLOR_EPSILON):
+            return self.window
+        return None
+
+    def store_window(self, window_version: int, gradient, adjustment, window, window_gradient):
+        """
+        Remembers adjusted window image. Images are owned by cache until the next store_window()
+        :param window_version: version of captured window image
+        :param gradient: brightness gradient colors (or None)
+        :param adjustment: tuple of window image adjustments (contrast, brightness)
+        :param window: adjusted window image
+        :param window_gradient: inverted brightness gradient stretched to window size (or None)
+        :return:
+        """
+        self.window_key = (window_version, None if gradient is None else gradient.astype(np.int16), adjustment)
+        self.window = window
+        self.window_gradient = window_gradient
+
+    def update_window_version(self, window_version: int):
+        """
+        Marks cached adjusted window and warped layer as updated to the new window version
+        :param window_version: version of captured window image
+        :return:
+        """
+        self.window_key = (window_version, self.window_key[1], self.window_key[2])
+        self.window_version = window_version
+
+    def matches(self, corners, gradient, adjustment, frame_shape):
+        """
+        Checks if cached warped layer has the same geometry and adjustments (window image can be different)
+        :param corners: (4, 2) destination corners of the window
+        :param gradient: brightness gradient colors (or None)
+        :param adjustment: tuple of window image adjustments (contrast, brightness)
+        :param frame_shape: shape of the output frame
+        :return: True if only window content has to be updated
+        """
+        return self.enabled and self.corners is not None \
+            and adjustment == self.adjustment \
+            and frame_shape == self.frame_shape \
+            and (gradient is None) == (self.gradient is None) \
+            and np.max(np.abs(corners - self.corners)) <= self.corners_epsilon \
+            and (gradient is None
+                 or np.max(np.abs(gradient.astype(np.int16) - self.gradient)) <= COLOR_EPSILON)
+
+    def lookup(self, corners, window_version: int, gradient, adjustment, frame_shape):
+        """
+        Checks if cached warped window can be used
+        :param corners: (4, 2) destination corners of the window
+        :param window_version: version of captured window image
+        :param gradient: brightness gradient colors (or None)
+        :param adjustment: tuple of window image adjustments (contrast, brightness)
+        :param frame_shape: shape of the output frame
+        :return: warp, mask, rect (x, y, width, height of the layer inside the frame) if cached layer is valid
+        or None, None, None
+        """
+        if window_version == self.window_version and self.matches(corners, gradient, adjustment, frame_shape):
+            self.hits_counter += 1
+            return self.warp, self.mask, self.rect
+
+        self.misses_counter += 1
+        return None, None, None
+
+    def store(self, corners, window_version: int, gradient, adjustment, frame_shape, warp, mask, rect, matrix):
+        """
+        Remembers warped window and its key. warp and mask are owned by cache until the next store()
+        :param corners: (4, 2) destination corners of the window
+        :param window_version: version of captured window image
+        :param gradient: brightness gradient colors (or None)
+        :param adjustment: tuple of window image adjustments (contrast, brightness)
+        :param frame_shape: shape of the output frame
+        :param warp: warped window image
+        :param mask: mask of the window (255 - inside the screen)
+        :param rect: x, y, width, height of warp and mask inside the frame
+        :param matrix: perspective transform from window image to the rectangle
+        :return:
+        """
+        self.corners = np.array(corners, dtype=np.float32)
+        self.window_version = window_version
+        self.gradient = None if gradient is None else gradient.astype(np.int16)
+        self.adjustment = adjustment
+        self.frame_shape = frame_shape
+        self.warp = warp
+        self.mask = mask
+        self.rect = rect
+        self.matrix = matrix
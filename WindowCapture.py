@@ -0,0 +1,263 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import logging
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+import qimage2ndarray
+import win32gui
+from PIL import ImageGrab
+from PyQt5.QtGui import QPixmap
+from PyQt5.QtWidgets import QApplication
+
+import WindowCompositor
+
+WINDOW_CAPTURE_QT = 0
+WINDOW_CAPTURE_OLD = 1
+
+# Sleep time while capture is not allowed (in seconds)
+IDLE_DELAY = 0.1
+
+# How long to wait for capture thread on stop (in seconds)
+STOP_TIMEOUT = 2.
+
+# Number of window versions with known changed tiles
+TILES_HISTORY_LENGTH = 32
+
+
+class WindowCapture:
+    def __init__(self):
+        """
+        Initializes WindowCapture class (captures window image in background thread with its own rate)
+        """
+        self.hwnd = None
+        self.capture_allowed = False
+        self.capture_method = WINDOW_CAPTURE_QT
+        self.capture_fps = 0
+        self.crop_left = 0
+        self.crop_top = 0
+        self.crop_right = 0
+        self.crop_bottom = 0
+
+        self.black_frame = np.zeros((1280, 720, 3), dtype=np.uint8)
+        self.window_image = None
+        self.window_version = 0
+        self.window_fingerprint = None
+        self.window_error = False
+        self.unchanged_counter = 0
+        self.tile_size = 0
+        self.tiles_history = {}
+        self.lock = threading.Lock()
+        self.capture_thread_running = False
+        self.thread = None
+
+    def set_parameters(self, hwnd, capture_allowed: bool, capture_method: int, capture_fps: int,
+                       crop_left: int, crop_top: int, crop_right: int, crop_bottom: int):
+        """
+        Updates capture parameters
+        :param hwnd: window handle
+        :param capture_allowed: False to stop capturing
+        :param capture_method: WINDOW_CAPTURE_QT or WINDOW_CAPTURE_OLD
+        :param capture_fps: maximum capture rate (0 or less - capture paused)
+        :param crop_left: pixels to crop from the left side
+        :param crop_top: pixels to crop from the top side
+        :param crop_right: pixels to crop from the right side
+        :param crop_bottom: pixels to crop from the bottom side
+        :return:
+        """
+        self.hwnd = hwnd
+        self.capture_allowed = capture_allowed
+        self.capture_method = capture_method
+        self.capture_fps = capture_fps
+        self.crop_left = crop_left
+        self.crop_top = crop_top
+        self.crop_right = crop_right
+        self.crop_bottom = crop_bottom
+
+    def get(self):
+        """
+        :return: the latest cropped BGR window image, its version (changes only with window content) and error flag
+        """
+        with self.lock:
+            return self.window_image, self.window_version, self.window_error
+
+    def set_tile_size(self, tile_size: int):
+        """
+        Sets size of tiles for changes detection
+        :param tile_size: tile size (in pixels). 0 - don't detect changed tiles
+        :return:
+        """
+        with self.lock:
+            if tile_size != self.tile_size:
+                self.tile_size = tile_size
+                self.tiles_history.clear()
+
+    def get_dirty_tiles(self, from_version: int, to_version: int, tile_size: int):
+        """
+        Combines changed tiles of all window versions between from_version and to_version
+        :param from_version: version of image that is already processed
+        :param to_version: version of new image
+        :param tile_size: expected tile size (in pixels)
+        :return: boolean array (rows, columns) of changed tiles or None if unknown
+        """
+        with self.lock:
+            if tile_size != self.tile_size or from_version >= to_version:
+                return None
+            dirty_tiles = None
+            for version in range(from_version + 1, to_version + 1):
+                changed_tiles = self.tiles_history.get(version)
+                if changed_tiles is None:
+                    return None
+                if dirty_tiles is None:
+                    dirty_tiles = changed_tiles.copy()
+                else:
+                    dirty_tiles |= changed_tiles
+            return dirty_tiles
+
+    def get_unchanged_counter(self):
+        """
+        :return: number of captures with the same content as previous one
+        """
+        return self.unchanged_counter
+
+    def start(self):
+        """
+        Starts capture thread
+        :return:
+        """
+        if self.capture_thread_running:
+            return
+        self.capture_thread_running = True
+        self.thread = threading.Thread(target=self.capture_thread)
+        self.thread.start()
+        logging.info("Window capture thread: " + self.thread.getName())
+
+    def stop(self):
+        """
+        Stops capture thread
+        :return:
+        """
+        self.capture_thread_running = False
+        if self.thread is not None:
+            self.thread.join(STOP_TIMEOUT)
+            self.thread = None
+
+    def grab_window(self):
+        """
+        Captures window image
+        :return: BGR image (uncropped), error flag
+        """
+        window_image = None
+        error = False
+        # noinspection PyBroadException
+        try:
+            if self.capture_method == WINDOW_CAPTURE_OLD:
+                rect = win32gui.GetWindowPlacement(self.hwnd)[-1]
+                window_image = cv2.cvtColor(np.array(ImageGrab.grab(rect)), cv2.COLOR_RGB2BGR)
+            elif self.capture_method == WINDOW_CAPTURE_QT:
+                # Get window image using PyQt5 grabWindow() function
+                window_image = qimage2ndarray. \
+                    rgb_view(QPixmap(QApplication.primaryScreen().grabWindow(self.hwnd)).toImage())
+
+                # Check image
+                if window_image is not None \
+                        and window_image.shape[0] > 10 and window_image.shape[1] > 10 \
+                        and window_image.shape[2] == 3 \
+                        and (cv2.countNonZero(window_image[:, :, 0]) > 0
+                             or cv2.countNonZero(window_image[:, :, 1]) > 0
+                             or cv2.countNonZero(window_image[:, :, 2]) > 0):
+
+                    # Convert to BGR
+                    window_image = cv2.cvtColor(window_image, cv2.COLOR_RGB2BGR)
+
+                # No window image -> error
+                else:
+                    window_image = None
+                    error = True
+        except Exception as e:
+            logging.exception(e)
+            logging.error("Can't get window image!")
+            window_image = None
+            error = True
+
+        # Replace window image with black if error occurs
+        if window_image is None:
+            window_image = self.black_frame
+
+        return window_image, error
+
+    def capture_thread(self):
+        """
+        Window capture loop
+        :return:
+        """
+        while self.capture_thread_running:
+            try:
+                time_started = time.time()
+
+                # Capture not allowed
+                if not self.capture_allowed or self.hwnd is None or self.capture_fps <= 0:
+                    time.sleep(IDLE_DELAY)
+                    continue
+
+                # Grab and crop window image
+                window_image, error = self.grab_window()
+                window_image = np.ascontiguousarray(window_image[
+                                                    self.crop_top:window_image.shape[0] - self.crop_bottom,
+                                                    self.crop_left:window_image.shape[1] - self.crop_right])
+
+                # Publish new version only if content changed
+                fingerprint = (window_image.shape, zlib.crc32(window_image))
+                if fingerprint == self.window_fingerprint and error == self.window_error:
+                    self.unchanged_counter += 1
+                else:
+                    # Find changed tiles
+                    changed_tiles = None
+                    tile_size = self.tile_size
+                    if tile_size > 0 and self.window_image is not None \
+                            and self.window_image.shape == window_image.shape:
+                        changed_tiles = WindowCompositor.get_changed_tiles(self.window_image, window_image, tile_size)
+
+                    with self.lock:
+                        self.window_image = window_image
+                        self.window_fingerprint = fingerprint
+                        self.window_error = error
+                        self.window_version += 1
+
+                        # Keep changed tiles of the latest versions
+                        if tile_size == self.tile_size:
+                            self.tiles_history[self.window_version] = changed_tiles
+                            self.tiles_history.pop(self.window_version - TILES_HISTORY_LENGTH, None)
+
+                # Control capture rate
+                time_left = (1. / self.capture_fps) - (time.time() - time_started)
+                if time_left > 0:
+                    time.sleep(time_left)
+
+            except Exception as e:
+                logging.exception(e)
+                time.sleep(IDLE_DELAY)
+
+        logging.warning("Window capture thread exited")
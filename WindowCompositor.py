@@ -0,0 +1,404 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import cv2
+import numpy as np
+
+import Calibration
+import WarpCache
+
+# Maximum part of changed tiles to update warped window tile by tile (otherwise whole window is warped again)
+MAX_DIRTY_FRACTION = 0.5
+
+# Padding of re-warped region around transformed tiles (in pixels)
+TILE_WARP_PADDING = 2
+
+# Number of points on each screen edge (straight edges are curved by lens distortion)
+OUTLINE_EDGE_POINTS = 16
+
+# Number of rows processed at once by color transform (gradient, contrast and brightness of each band are applied
+# while it's in cache)
+TRANSFORM_BAND_ROWS = 64
+
+
+def get_changed_tiles(previous_image, image, tile_size: int):
+    """
+    Compares two images tile by tile
+    :param previous_image: previous BGR image
+    :param image: current BGR image with the same shape
+    :param tile_size: tile size (in pixels)
+    :return: boolean array (rows, columns) of changed tiles
+    """
+    height, width = image.shape[:2]
+    difference = cv2.absdiff(previous_image, image).reshape((height, -1))
+    channels = difference.shape[1] // width
+    tile_width = tile_size * channels
+
+    rows = (height + tile_size - 1) // tile_size
+    columns = (width + tile_size - 1) // tile_size
+    full_rows = height // tile_size
+    full_columns = width // tile_size
+    changed_tiles = np.zeros((rows, columns), dtype=bool)
+
+    # Full tiles at once
+    if full_rows > 0 and full_columns > 0:
+        changed_tiles[:full_rows, :full_columns] = \
+            difference[:full_rows * tile_size, :full_columns * tile_width] \
+            .reshape((full_rows, tile_size, full_columns, tile_width)).max(axis=(1, 3)) > 0
+
+    # Partial tiles on the right and bottom edges
+    for row in range(rows):
+        for column in range(full_columns, columns):
+            changed_tiles[row, column] = difference[row * tile_size: (row + 1) * tile_size,
+                                                    column * tile_width: (column + 1) * tile_width].max() > 0
+    for row in range(full_rows, rows):
+        for column in range(full_columns):
+            changed_tiles[row, column] = difference[row * tile_size: (row + 1) * tile_size,
+                                                    column * tile_width: (column + 1) * tile_width].max() > 0
+
+    return changed_tiles
+
+
+def get_bounding_rect(points, frame_shape):
+    """
+    Calculates bounding rectangle of points clipped to the frame
+    :param points: (N, 2) float32 points
+    :param frame_shape: shape of the frame
+    :return: x, y, width, height
+    """
+    frame_height, frame_width = frame_shape[:2]
+    rect_x, rect_y, rect_width, rect_height = cv2.boundingRect(points)
+    rect_x_end = min(rect_x + rect_width, frame_width)
+    rect_y_end = min(rect_y + rect_height, frame_height)
+    rect_x = max(rect_x, 0)
+    rect_y = max(rect_y, 0)
+    return rect_x, rect_y, max(rect_x_end - rect_x, 0), max(rect_y_end - rect_y, 0)
+
+
+class WindowCompositor:
+    def __init__(self, buffer_pool):
+        """
+        Initializes WindowCompositor class (adjusts and warps window image into the screen region)
+        :param buffer_pool: BufferPool for temporary and cached buffers
+        """
+        self.buffer_pool = buffer_pool
+        self.warp_cache = WarpCache.WarpCache()
+        self.tile_size = 0
+
+        # Inverted brightness gradient stretched to window size and its colors
+        self.window_gradient = None
+        self.gradient_colors = None
+
+        # Lens distortion tables
+        self.calibration = None
+        self.calibration_ready = False
+        self.window_map = None
+
+        self.tiled_updates_counter = 0
+        self.tiles_counter = 0
+
+    def set_tile_size(self, tile_size: int):
+        """
+        Sets size of window tiles for partial updates
+        :param tile_size: tile size (in pixels). 0 - always update whole window
+        :return:
+        """
+        self.tile_size = tile_size
+
+    def set_calibration(self, calibration):
+        """
+        Sets camera calibration to warp window with lens distortion
+        :param calibration: Calibration or None to warp with perspective transform only
+        :return:
+        """
+        if calibration is not self.calibration:
+            self.calibration = calibration
+            self.calibration_ready = False
+            self.warp_cache.invalidate()
+
+    def get_tiled_updates_counter(self):
+        """
+        :return: number of frames with only changed tiles updated and total number of updated tiles
+        """
+        return self.tiled_updates_counter, self.tiles_counter
+
+    def render(self, window_image, window_version: int, color_gradient, contrast: float, brightness: int,
+               points_dst, frame_shape, get_dirty_tiles=None, frame_scale=(1., 1.)):
+        """
+        Adjusts and warps window image into the screen region (reuses cached layer if possible)
+        :param window_image: BGR window image
+        :param window_version: version of window image
+        :param color_gradient: 2x2 brightness gradient colors or None
+        :param contrast: window contrast
+        :param brightness: window brightness
+        :param points_dst: (4, 2) float32 screen corners in frame
+        :param frame_shape: shape of the output frame
+        :param get_dirty_tiles: function (from_version, to_version, tile_size) that returns boolean array of
+        changed tiles or None if unknown
+        :param frame_scale: (x, y) scale of the output frame relative to camera frame (for lens distortion tables)
+        :return: warped window, its mask, rect (x, y, width, height inside the frame). Buffers are owned by compositor
+        """
+        adjustment = (contrast, brightness)
+
+        # Warp again when distortion tables become ready
+        if self.calibration is not None:
+            calibration_ready = self.calibration.get_tables(frame_shape[1], frame_shape[0], frame_scale) is not None
+            if calibration_ready != self.calibration_ready:
+                self.calibration_ready = calibration_ready
+                self.warp_cache.invalidate()
+
+        # Nothing changed
+        warp, mask, rect = self.warp_cache.lookup(points_dst, window_version, color_gradient, adjustment,
+                                                  frame_shape)
+        if warp is not None:
+            return warp, mask, rect
+
+        # Only window content changed -> try to update changed tiles
+        if self.tile_size > 0 and get_dirty_tiles is not None \
+                and self.warp_cache.matches(points_dst, color_gradient, adjustment, frame_shape) \
+                and self.warp_cache.window is not None \
+                and self.warp_cache.matrix is not None \
+                and self.warp_cache.window.shape == window_image.shape \
+                and self.warp_cache.window_key[0] == self.warp_cache.window_version:
+            dirty_tiles = get_dirty_tiles(self.warp_cache.window_version, window_version, self.tile_size)
+            if dirty_tiles is not None and np.count_nonzero(dirty_tiles) <= dirty_tiles.size * MAX_DIRTY_FRACTION:
+                self.update_tiles(window_image, dirty_tiles, contrast, brightness)
+                self.warp_cache.update_window_version(window_version)
+                return self.warp_cache.warp, self.warp_cache.mask, self.warp_cache.rect
+
+        # Adjust window image only if it changed
+        window_adjusted = self.warp_cache.lookup_window(window_version, color_gradient, adjustment)
+        if window_adjusted is None:
+            window_adjusted = self.adjust_window(window_image, window_version, color_gradient, contrast, brightness)
+
+        return self.warp_window(window_adjusted, window_version, color_gradient, adjustment, points_dst, frame_shape,
+                                frame_scale)
+
+    def adjust_window(self, window_image, window_version: int, color_gradient, contrast: float, brightness: int):
+        """
+        Applies brightness gradient, contrast and brightness to the whole window image
+        :return: adjusted window image (owned by cache)
+        """
+        window_gradient = None
+        if color_gradient is not None:
+            window_gradient = self.get_window_gradient(color_gradient, window_image.shape)
+
+        window_adjusted = self.buffer_pool.reuse(self.warp_cache.window, window_image.shape)
+        self.transform(window_image, window_gradient, window_adjusted, contrast, brightness)
+
+        self.warp_cache.store_window(window_version, color_gradient, (contrast, brightness), window_adjusted,
+                                     window_gradient)
+        return window_adjusted
+
+    def transform(self, source, gradient, destination, contrast: float, brightness: int):
+        """
+        Subtracts inverted brightness gradient and applies contrast and brightness in bands of rows
+        :param source: BGR window image (or its region)
+        :param gradient: inverted gradient of the same size or None
+        :param destination: output image of the same size
+        :param contrast: window contrast
+        :param brightness: window brightness
+        :return:
+        """
+        for row in range(0, source.shape[0], TRANSFORM_BAND_ROWS):
+            band = destination[row: row + TRANSFORM_BAND_ROWS]
+            band_source = source[row: row + TRANSFORM_BAND_ROWS]
+
+            # Subtract gradient in place
+            if gradient is not None:
+                band_source = cv2.subtract(band_source, gradient[row: row + TRANSFORM_BAND_ROWS], dst=band)
+
+            # Contrast and brightness
+            cv2.addWeighted(band_source, contrast, band_source, 0., brightness, dst=band)
+
+    def get_window_gradient(self, color_gradient, shape):
+        """
+        Stretches 2x2 gradient to window size and inverts it. Previous result is reused while gradient colors
+        don't change more than WarpCache.COLOR_EPSILON
+        :param color_gradient: 2x2 brightness gradient colors
+        :param shape: shape of window image
+        :return: inverted gradient image (owned by compositor)
+        """
+        if self.window_gradient is not None and self.window_gradient.shape == tuple(shape) \
+                and np.max(np.abs(color_gradient.astype(np.int16) - self.gradient_colors)) <= WarpCache.COLOR_EPSILON:
+            return self.window_gradient
+
+        self.window_gradient = self.buffer_pool.reuse(self.window_gradient, shape)
+        cv2.resize(color_gradient, (shape[1], shape[0]), dst=self.window_gradient, interpolation=cv2.INTER_LINEAR)
+        cv2.bitwise_not(self.window_gradient, dst=self.window_gradient)
+        self.gradient_colors = color_gradient.astype(np.int16)
+        return self.window_gradient
+
+    def warp_window(self, window_adjusted, window_version: int, color_gradient, adjustment, points_dst, frame_shape,
+                    frame_scale):
+        """
+        Warps adjusted window image into the bounding rectangle of the screen
+        :return: warped window, its mask, rect (owned by cache)
+        """
+        overlay_height, overlay_width = window_adjusted.shape[:2]
+        source_height, source_width = frame_shape[:2]
+
+        # Lens distortion
+        tables = None
+        if self.calibration is not None:
+            tables = self.calibration.get_tables(source_width, source_height, frame_scale)
+        if tables is not None:
+            return self.warp_window_distorted(window_adjusted, window_version, color_gradient, adjustment,
+                                              points_dst, frame_shape, tables)
+
+        # Source points (full size of overlay image)
+        points_src = np.array([
+            [0, 0],
+            [overlay_width - 1, 0],
+            [overlay_width - 1, overlay_height - 1],
+            [0, overlay_height - 1]], dtype='float32')
+
+        # Bounding rectangle of the screen inside the frame
+        rect = get_bounding_rect(points_dst, frame_shape)
+        rect_x, rect_y = rect[:2]
+
+        # Warp and transform window image into the rectangle
+        points_rect = points_dst - np.array([rect_x, rect_y], dtype=np.float32)
+        matrix = cv2.getPerspectiveTransform(points_src, points_rect)
+        warp = self.buffer_pool.reuse(self.warp_cache.warp, (rect[3], rect[2], 3))
+        if warp.size > 0:
+            cv2.warpPerspective(window_adjusted, matrix, (rect[2], rect[3]), dst=warp)
+
+        # Screen region inside the rectangle
+        mask = self.buffer_pool.reuse(self.warp_cache.mask, (rect[3], rect[2]))
+        mask.fill(0)
+        contours = np.array([points_dst], dtype=int)
+        cv2.drawContours(mask, [contours], -1, 255, -1, offset=(-rect_x, -rect_y))
+
+        self.warp_cache.store(points_dst, window_version, color_gradient, adjustment, frame_shape,
+                              warp, mask, rect, matrix)
+        return warp, mask, rect
+
+    def warp_window_distorted(self, window_adjusted, window_version: int, color_gradient, adjustment, points_dst,
+                              frame_shape, tables):
+        """
+        Warps adjusted window image into the screen with lens distortion. Screen is flat in undistorted space,
+        so each pixel of the bounding rectangle is looked up in undistortion table and transformed into window
+        :param tables: undistortion table, distortion table, padding from Calibration.get_tables()
+        :return: warped window, its mask, rect (owned by cache)
+        """
+        undistortion_table, distortion_table, padding = tables
+        overlay_height, overlay_width = window_adjusted.shape[:2]
+
+        # Source points (full size of overlay image)
+        points_src = np.array([
+            [0, 0],
+            [overlay_width - 1, 0],
+            [overlay_width - 1, overlay_height - 1],
+            [0, overlay_height - 1]], dtype='float32')
+
+        # Screen outline inside the frame (straight edges in undistorted space)
+        points_undistorted = Calibration.lookup(undistortion_table, points_dst, 0.)
+        steps = np.linspace(0., 1., OUTLINE_EDGE_POINTS, endpoint=False, dtype=np.float32).reshape((1, -1, 1))
+        edges_start = points_undistorted.reshape((4, 1, 2))
+        edges_end = np.roll(points_undistorted, -1, axis=0).reshape((4, 1, 2))
+        outline = Calibration.lookup(distortion_table, (edges_start + (edges_end - edges_start) * steps)
+                                     .reshape((-1, 2)), padding)
+
+        # Bounding rectangle of the screen inside the frame
+        rect = get_bounding_rect(outline, frame_shape)
+        rect_x, rect_y, rect_width, rect_height = rect
+
+        # Window position of each pixel of the rectangle
+        matrix = cv2.getPerspectiveTransform(points_undistorted, points_src)
+        self.window_map = self.buffer_pool.reuse(self.window_map, (rect_height, rect_width, 2), np.float32)
+        warp = self.buffer_pool.reuse(self.warp_cache.warp, (rect_height, rect_width, 3))
+        if warp.size > 0:
+            cv2.perspectiveTransform(undistortion_table[rect_y: rect_y + rect_height, rect_x: rect_x + rect_width],
+                                     matrix, dst=self.window_map)
+            cv2.remap(window_adjusted, self.window_map, None, cv2.INTER_LINEAR, dst=warp)
+
+        # Screen region inside the rectangle
+        mask = self.buffer_pool.reuse(self.warp_cache.mask, (rect_height, rect_width))
+        mask.fill(0)
+        contours = np.array([outline], dtype=int)
+        cv2.drawContours(mask, [contours], -1, 255, -1, offset=(-rect_x, -rect_y))
+
+        # No single perspective transform (no tiled updates)
+        self.warp_cache.store(points_dst, window_version, color_gradient, adjustment, frame_shape,
+                              warp, mask, rect, None)
+        return warp, mask, rect
+
+    def update_tiles(self, window_image, dirty_tiles, contrast: float, brightness: int):
+        """
+        Adjusts changed tiles of window image and warps them into cached layer
+        :param window_image: new BGR window image
+        :param dirty_tiles: boolean array of changed tiles (rows, columns)
+        :param contrast: window contrast
+        :param brightness: window brightness
+        :return:
+        """
+        window_adjusted = self.warp_cache.window
+        window_gradient = self.warp_cache.window_gradient
+        height, width = window_image.shape[:2]
+
+        # Merge changed tiles of each row into horizontal runs
+        regions = []
+        for tile_y in range(dirty_tiles.shape[0]):
+            row = dirty_tiles[tile_y]
+            tile_x = 0
+            while tile_x < len(row):
+                if not row[tile_x]:
+                    tile_x += 1
+                    continue
+                run_start = tile_x
+                while tile_x < len(row) and row[tile_x]:
+                    tile_x += 1
+                regions.append((run_start * self.tile_size, tile_y * self.tile_size,
+                                min(tile_x * self.tile_size, width), min((tile_y + 1) * self.tile_size, height)))
+        if not regions:
+            return
+
+        # Adjust changed regions
+        for x_start, y_start, x_end, y_end in regions:
+            self.transform(window_image[y_start: y_end, x_start: x_end],
+                           None if window_gradient is None else window_gradient[y_start: y_end, x_start: x_end],
+                           window_adjusted[y_start: y_end, x_start: x_end], contrast, brightness)
+
+        # Warp changed regions
+        warp = self.warp_cache.warp
+        matrix = self.warp_cache.matrix
+        warp_height, warp_width = warp.shape[:2]
+        for x_start, y_start, x_end, y_end in regions:
+            # Region of the layer affected by changed tiles
+            corners = np.array([[[x_start - 1, y_start - 1], [x_end, y_start - 1],
+                                 [x_end, y_end], [x_start - 1, y_end]]], dtype=np.float32)
+            corners = cv2.perspectiveTransform(corners, matrix)
+            region_x, region_y, region_width, region_height = cv2.boundingRect(corners)
+            region_x_end = min(region_x + region_width + TILE_WARP_PADDING, warp_width)
+            region_y_end = min(region_y + region_height + TILE_WARP_PADDING, warp_height)
+            region_x = max(region_x - TILE_WARP_PADDING, 0)
+            region_y = max(region_y - TILE_WARP_PADDING, 0)
+            if region_x_end <= region_x or region_y_end <= region_y:
+                continue
+
+            # Warp with offset transform
+            offset = np.array([[1, 0, -region_x], [0, 1, -region_y], [0, 0, 1]], dtype=np.float64)
+            cv2.warpPerspective(window_adjusted, offset @ matrix, (region_x_end - region_x, region_y_end - region_y),
+                                dst=warp[region_y: region_y_end, region_x: region_x_end])
+
+        self.tiled_updates_counter += 1
+        self.tiles_counter += int(np.count_nonzero(dirty_tiles))
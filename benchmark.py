@@ -0,0 +1,369 @@
+"""
+ Copyright (C) 2022 Fern Lane, Podmiha project
+
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+
+ Synthetic benchmarks of video pipeline parts. Usage: python benchmark.py [benchmark name ...]
+"""
+
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import BufferPool
+import MarkerDetector
+import NoiseBank
+import NoiseGenerator
+import OutputEffects
+import WindowCompositor
+
+# Number of measured iterations of each benchmark
+ITERATIONS = 50
+
+# Effects chains are measured in several short rounds (they are easily disturbed by other processes)
+EFFECTS_ITERATIONS = 10
+EFFECTS_ROUNDS = 10
+
+# Size of synthetic markers relative to frame height
+MARKER_SIZE = 0.12
+
+
+def measure(function, iterations=ITERATIONS, rounds=1):
+    """
+    Measures average execution time of function
+    :param function: function without arguments
+    :param iterations: number of measured calls
+    :param rounds: number of measurements (the fastest one is returned, to compare functions on busy machine)
+    :return: average time (in milliseconds), result of the last call
+    """
+    # Warm up
+    result = function()
+
+    best_time = None
+    for _ in range(rounds):
+        time_started = time.perf_counter()
+        for _ in range(iterations):
+            result = function()
+        round_time = (time.perf_counter() - time_started) * 1000. / iterations
+        if best_time is None or round_time < best_time:
+            best_time = round_time
+    return best_time, result
+
+
+def make_scene(width: int, height: int):
+    """
+    Draws camera-like frame with 4 ARUco markers (ids 0-3) around slightly rotated screen
+    :param width: frame width
+    :param height: frame height
+    :return: BGR frame, screen corners
+    """
+    aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+    marker_size = int(height * MARKER_SIZE)
+    border = marker_size // 10
+
+    # Background with horizontal gradient
+    frame = np.full((height, width, 3), 255, dtype=np.uint8)
+    frame[:, :, 2] = np.linspace(150, 255, width).astype(np.uint8)[None, :]
+
+    # Screen
+    screen = np.array([[width * 0.23, height * 0.21], [width * 0.77, height * 0.22],
+                       [width * 0.78, height * 0.78], [width * 0.22, height * 0.76]], dtype=np.int32)
+    cv2.fillPoly(frame, [screen], (90, 90, 90))
+
+    # Markers in screen corners
+    for marker_id in range(4):
+        marker = cv2.aruco.drawMarker(aruco_dict, marker_id, marker_size)
+        marker = cv2.copyMakeBorder(marker, border, border, border, border, cv2.BORDER_CONSTANT, value=255)
+        size = marker.shape[0]
+        x = screen[marker_id][0] - (0 if marker_id in (0, 3) else size)
+        y = screen[marker_id][1] - (0 if marker_id in (0, 1) else size)
+        frame[y: y + size, x: x + size] = marker[:, :, None]
+
+    # Camera-like softness
+    frame = cv2.GaussianBlur(frame, (3, 3), 0)
+    return frame, screen
+
+
+def sorted_corners(corners, ids):
+    """
+    :return: (N * 4, 2) array of markers corners sorted by marker id
+    """
+    order = np.argsort(ids.reshape(-1))
+    return np.concatenate([corners[i] for i in order]).reshape((-1, 2))
+
+
+def benchmark_pyramid():
+    """
+    Time and accuracy of each detection pyramid level (compared to full resolution detection)
+    :return:
+    """
+    print("Detection pyramid")
+    aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+    parameters = cv2.aruco.DetectorParameters_create()
+    parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+
+    for width, height in [(1280, 720), (1920, 1080)]:
+        gray = cv2.cvtColor(make_scene(width, height)[0], cv2.COLOR_BGR2GRAY)
+        reference = None
+        for scale in MarkerDetector.PYRAMID_SCALES:
+            marker_detector = MarkerDetector.MarkerDetector(aruco_dict, parameters)
+            marker_detector.set_pyramid_scale(scale)
+            scan_time, (corners, ids) = measure(lambda: marker_detector.detect(gray))
+            if ids is None or len(ids) != 4:
+                print("\t" + str(width) + "x" + str(height) + "\t1/" + str(scale) + "\tmarkers not detected")
+                continue
+            if marker_detector.get_coarse_scale() != scale:
+                print("\t" + str(width) + "x" + str(height) + "\t1/" + str(scale) + "\tlimited to 1/"
+                      + str(marker_detector.get_coarse_scale()) + " (markers are too small)")
+                continue
+            points = sorted_corners(corners, ids)
+            if reference is None:
+                reference = points
+            error = np.linalg.norm(points - reference, axis=1)
+            print("\t" + str(width) + "x" + str(height) + "\t1/" + str(scale)
+                  + "\t{:.2f} ms".format(scan_time)
+                  + "\tmean error: {:.3f} px".format(float(np.mean(error)))
+                  + "\tmax error: {:.3f} px".format(float(np.max(error))))
+
+
+def benchmark_flow():
+    """
+    Time and accuracy of optical flow tracking compared to detection on every frame of moving scene
+    :return:
+    """
+    print("Optical flow tracking")
+    aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+    parameters = cv2.aruco.DetectorParameters_create()
+    parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+
+    scene = make_scene(1280, 720)[0]
+    frames = []
+    for i in range(ITERATIONS):
+        transform = np.float32([[1, 0, i * 1.5], [0, 1, i * 0.5]])
+        frames.append(cv2.cvtColor(cv2.warpAffine(scene, transform, (1280, 720), borderValue=(255, 255, 255)),
+                                   cv2.COLOR_BGR2GRAY))
+
+    reference_detector = MarkerDetector.MarkerDetector(aruco_dict, parameters)
+    references = [reference_detector.detect_markers(gray) for gray in frames]
+
+    for flow_frames in [0, 5, 10]:
+        marker_detector = MarkerDetector.MarkerDetector(aruco_dict, parameters)
+        marker_detector.set_tracking(False, [0, 1, 2, 3], 0.5, 0)
+        marker_detector.set_flow(flow_frames, 1.)
+        errors = []
+        time_started = time.perf_counter()
+        for gray, (reference_corners, reference_ids) in zip(frames, references):
+            corners, ids = marker_detector.detect(gray)
+            if ids is not None and len(ids) == 4:
+                errors.append(np.max(np.linalg.norm(sorted_corners(corners, ids)
+                                                    - sorted_corners(reference_corners, reference_ids), axis=1)))
+        frame_time = (time.perf_counter() - time_started) * 1000. / len(frames)
+        print("\tflow frames: " + str(flow_frames)
+              + "\t{:.2f} ms".format(frame_time)
+              + "\ttracked: " + str(marker_detector.get_statistics()[2])
+              + "\tmax error: {:.3f} px".format(float(np.max(errors)) if errors else float("nan")))
+
+
+def benchmark_parallel():
+    """
+    Time of full frame detection in parallel tiles for different number of threads
+    :return:
+    """
+    print("Parallel tiled detection (CPU cores: " + str(os.cpu_count()) + ")")
+    aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+    parameters = cv2.aruco.DetectorParameters_create()
+    parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+
+    for width, height in [(1280, 720), (1920, 1080)]:
+        gray = cv2.cvtColor(make_scene(width, height)[0], cv2.COLOR_BGR2GRAY)
+        reference = None
+        for threads in [0, 1, 2, 4, 8]:
+            marker_detector = MarkerDetector.MarkerDetector(aruco_dict, parameters)
+            marker_detector.set_parallel(threads, 0.25)
+            scan_time, (corners, ids) = measure(lambda: marker_detector.detect(gray))
+            marker_detector.set_parallel(0, 0.25)
+            marker_detector.update_executor()
+            if ids is None or len(ids) != 4:
+                print("\t" + str(width) + "x" + str(height) + "\tthreads: " + str(threads)
+                      + "\tmarkers not detected")
+                continue
+            points = sorted_corners(corners, ids)
+            if reference is None:
+                reference = points
+            print("\t" + str(width) + "x" + str(height) + "\tthreads: " + str(threads)
+                  + "\t{:.2f} ms".format(scan_time)
+                  + "\tmax error: {:.3f} px".format(float(np.max(np.linalg.norm(points - reference, axis=1)))))
+
+
+def make_window(width: int, height: int):
+    """
+    Draws VM-like window with text lines
+    :param width: window width
+    :param height: window height
+    :return: BGR image
+    """
+    window = np.full((height, width, 3), 240, dtype=np.uint8)
+    cv2.rectangle(window, (0, 0), (width, 40), (120, 80, 40), -1)
+    for line in range(60, height - 30, 36):
+        cv2.putText(window, "Question " + str(line) + ": lorem ipsum dolor sit amet", (20, line),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9, (30, 30, 30), 2)
+    return window
+
+
+def benchmark_tiles():
+    """
+    Time of window update when only cursor moves: full recomposite vs changed tiles of different sizes
+    :return:
+    """
+    print("Tiled window updates (moving cursor)")
+    frame_shape = (1080, 1920, 3)
+    screen = make_scene(frame_shape[1], frame_shape[0])[1].astype(np.float32)
+    window = make_window(1920, 1080)
+    color_gradient = np.array([[[230, 230, 230], [220, 225, 230]], [[200, 210, 220], [210, 215, 220]]],
+                              dtype=np.uint8)
+
+    # Windows with cursor in different positions
+    windows = []
+    for i in range(ITERATIONS + 1):
+        cursor_window = window.copy()
+        x, y = 200 + i * 23, 300 + i * 7
+        cv2.rectangle(cursor_window, (x, y), (x + 12, y + 20), (0, 0, 0), -1)
+        windows.append(cursor_window)
+
+    for tile_size in [0, 32, 64, 128]:
+        compositor = WindowCompositor.WindowCompositor(BufferPool.BufferPool())
+        compositor.warp_cache.set_parameters(True, 0.25)
+        compositor.set_tile_size(tile_size)
+        reference = WindowCompositor.WindowCompositor(BufferPool.BufferPool())
+
+        def get_dirty_tiles(from_version, to_version, tile_size_):
+            return WindowCompositor.get_changed_tiles(windows[from_version], windows[to_version], tile_size_)
+
+        # First frame
+        compositor.render(windows[0], 0, color_gradient, 1.1, -10, screen, frame_shape, get_dirty_tiles)
+
+        update_time = 0.
+        error = 0
+        for version in range(1, len(windows)):
+            time_started = time.perf_counter()
+            warp = compositor.render(windows[version], version, color_gradient, 1.1, -10, screen, frame_shape,
+                                     get_dirty_tiles)[0]
+            update_time += time.perf_counter() - time_started
+
+            warp_reference = reference.render(windows[version], version, color_gradient, 1.1, -10, screen,
+                                              frame_shape)[0]
+            error = max(error, int(np.max(cv2.absdiff(warp, warp_reference))))
+
+        print("\ttile size: " + (str(tile_size) if tile_size > 0 else "full")
+              + "\t{:.2f} ms".format(update_time * 1000. / (len(windows) - 1))
+              + "\ttiled updates: " + str(compositor.get_tiled_updates_counter()[0])
+              + "\tmax difference: " + str(error))
+
+
+def effects_hsv(image, noise, blur_radius: int, contrast: float, brightness: int, noise_amount: float):
+    """
+    Previous output effects chain (separate blur, contrast and HSV noise passes) for comparison
+    :return: BGR image
+    """
+    image = cv2.GaussianBlur(image, (blur_radius, blur_radius), 0)
+    cv2.addWeighted(image, contrast, image, 0., brightness, dst=image)
+    image_hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    value = cv2.extractChannel(image_hsv, 2)
+    value_noisy = cv2.bitwise_not(value)
+    cv2.bitwise_and(value_noisy, noise, dst=value_noisy)
+    cv2.bitwise_not(value_noisy, dst=value_noisy)
+    cv2.addWeighted(value, 1. - noise_amount, value_noisy, noise_amount, 0., dst=value_noisy)
+    cv2.insertChannel(value_noisy, image_hsv, 2)
+    return cv2.cvtColor(image_hsv, cv2.COLOR_HSV2BGR)
+
+
+def benchmark_effects():
+    """
+    Time of output effects (blur, contrast, brightness, noise): HSV chain vs fused luminance-factor effects
+    :return:
+    """
+    print("Output effects")
+    for width, height in [(960, 540), (1920, 1080)]:
+        image = cv2.resize(make_scene(1920, 1080)[0], (width, height), interpolation=cv2.INTER_AREA)
+        noise = np.random.default_rng(0).integers(0, 256, (height, width), dtype=np.uint8)
+        for blur_radius in [1, 5]:
+            output_effects = OutputEffects.OutputEffects(BufferPool.BufferPool())
+            output_effects.set_parameters(blur_radius, 1.1, -5, 0.3)
+            output = np.empty_like(image)
+
+            # Same calls as effects stage
+            def effects_fused():
+                output_effects.apply_filter(image, output)
+                output_effects.add_noise(output, noise)
+
+            hsv_time, reference = measure(lambda: effects_hsv(image, noise, blur_radius, 1.1, -5, 0.3),
+                                          EFFECTS_ITERATIONS, EFFECTS_ROUNDS)
+            fused_time, _ = measure(effects_fused, EFFECTS_ITERATIONS, EFFECTS_ROUNDS)
+            difference = cv2.absdiff(reference, output)
+            print("\t" + str(width) + "x" + str(height) + "\tblur: " + str(blur_radius)
+                  + "\tHSV: {:.2f} ms".format(hsv_time)
+                  + "\tfused: {:.2f} ms".format(fused_time)
+                  + "\tspeedup: {:.2f}x".format(hsv_time / fused_time)
+                  + "\tmean difference: {:.2f}".format(float(np.mean(difference)))
+                  + "\tmax difference: " + str(int(np.max(difference))))
+
+
+def benchmark_noise():
+    """
+    Time of getting noise frame: noise bank (noise.avi or random frames) vs generated noise
+    :return:
+    """
+    print("Noise sources")
+    for width, height in [(960, 540), (1920, 1080)]:
+        noise_bank = NoiseBank.NoiseBank("noise.avi")
+        noise_bank.get_frame(0, width, height)
+        noise_bank.thread.join()
+        counter = [0]
+
+        def bank_frame():
+            counter[0] += 1
+            return noise_bank.get_frame(counter[0], width, height)
+
+        bank_time, _ = measure(bank_frame)
+        line = "\t" + str(width) + "x" + str(height) + "\tbank: {:.3f} ms".format(bank_time)
+        for tile_size in [0, 64, 256]:
+            noise_generator = NoiseGenerator.NoiseGenerator()
+            noise_generator.set_parameters(tile_size, 0)
+            generator_time, noise = measure(lambda: noise_generator.get_frame(width, height))
+            line += "\ttile " + str(tile_size) + ": {:.3f} ms (mean {:.1f})".format(generator_time,
+                                                                                    float(np.mean(noise)))
+        print(line)
+
+
+BENCHMARKS = {
+    "pyramid": benchmark_pyramid,
+    "flow": benchmark_flow,
+    "parallel": benchmark_parallel,
+    "tiles": benchmark_tiles,
+    "effects": benchmark_effects,
+    "noise": benchmark_noise,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
+        print()